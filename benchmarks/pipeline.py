@@ -0,0 +1,374 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Benchmarks of the processing pipeline, using the images and video in examples/ as fixtures.
+#
+# Cases:
+#  process_image: process.process_image() on each example image, already decoded.
+#  process_file_image: process.process_file() on each example image, including decoding and writing output.
+#  process_file_video: process.process_file() on the first frames of the example video.
+#  composite: process.apply_supermask() with a full size mask, and with a half size mask that's upsampled.
+#  large_image: process.process_image() on an example image upscaled to 12 megapixels.
+#  video_join: Joining the segments of a video processed in chunks, as for --video_chunks.
+#
+# Models:
+#  stub: Deterministic stand-ins for the models (see stubs.py), to measure pipeline overhead alone. Needs no
+#   checkpoints, GPU, or network access.
+#  cpu: The real models on CPU, using checkpoints already in the ezsam cache folder. Nothing is downloaded.
+#
+# Each case's time and peak memory use are measured. Peak memory is the most that resident memory grew by during a
+#  run, which is only measured on Linux.
+# Results are written as JSON, and can be compared against results from another commit with --compare.
+#
+# Usage:
+#   python benchmarks/pipeline.py
+#   python benchmarks/pipeline.py --models cpu --sam_model hq_vit_tiny
+#   python benchmarks/pipeline.py large_image --boxes 8
+#   python benchmarks/pipeline.py --compare benchmarks/results/stub-<commit>.json
+#
+
+import argparse
+import contextlib
+import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess as sub
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+
+import cv2  # noqa: E402
+import numpy as np  # noqa: E402
+import torch  # noqa: E402
+
+from ezsam.cli.chunks import join_chunked_videos, plan_jobs  # noqa: E402
+from ezsam.cli.config.defaults import (  # noqa: E402
+  DEFAULT_BOX_THRESHOLD,
+  DEFAULT_GROUNDING_DINO_CONFIG_PATH,
+  DEFAULT_NMS_THRESHOLD,
+  DEFAULT_TEXT_THRESHOLD,
+)
+from ezsam.cli.formats import OutputImageFormat, OutputVideoCodec  # noqa: E402
+from ezsam.cli.predictor import EmbeddingReusePredictor  # noqa: E402
+from ezsam.cli.process import apply_supermask, process_file, process_image, supermask_for_image  # noqa: E402
+from ezsam.cli.report import percentiles, timer  # noqa: E402
+from stubs import STUB_BOXES_PER_CLASS, StubDetector, StubPredictor  # noqa: E402
+
+RESULTS_VERSION = 1
+EXAMPLES_DIR = os.path.join(ROOT_DIR, 'examples')
+RESULTS_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'results')
+PROMPTS = ['object', 'animal']
+NEG_PROMPTS = ['wheel']
+CASES = ['process_image', 'process_file_image', 'process_file_video', 'composite', 'video_join', 'large_image']
+# Size of the upscaled image for the large_image case
+LARGE_IMAGE_SIZE = (4000, 3000)
+# Smaller increases in peak memory aren't reported as regressions, since they're within measurement noise
+MIN_MEMORY_REGRESSION_MB = 16
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the ezsam processing pipeline')
+  parser.add_argument('cases', nargs='*', help=f'Cases to run, any of: {", ".join(CASES)}. Default all')
+  parser.add_argument('--models', choices=['stub', 'cpu'], default='stub', help='Stub models, or real models on CPU')
+  parser.add_argument('--sam_model', default='hq_vit_tiny', help='SAM model for --models cpu, i.e. hq_vit_tiny or vit_b')
+  parser.add_argument('--repeat', type=int, default=3, help='Timed runs of each case, after one warmup run')
+  parser.add_argument('--boxes', type=int, default=STUB_BOXES_PER_CLASS, help='Boxes detected for each prompt by the stub models')
+  parser.add_argument('--frames', type=int, default=24, help='Number of video frames to process')
+  parser.add_argument('--chunks', type=int, default=4, help='Number of segments to join for video_join')
+  parser.add_argument('--output', help='Path to write JSON results to, default benchmarks/results/<models>-<commit>.json')
+  parser.add_argument('--compare', help='JSON results from an earlier run to compare against')
+  parser.add_argument('--threshold', type=float, default=0.1, help='Increase in a case\'s median time or peak memory, as a fraction, reported as a regression by --compare')
+  parser.add_argument('--verbose', action='store_true', help='Show logging from ezsam while benchmarking')
+  args = parser.parse_args(argv)
+  for case in args.cases:
+    if case not in CASES:
+      parser.error(f'unknown case: {case}')
+  return args
+
+
+def get_commit() -> str:
+  try:
+    result = sub.run(['git', 'rev-parse', '--short=10', 'HEAD'], cwd=ROOT_DIR, capture_output=True, text=True)
+    commit = result.stdout.strip() or 'unknown'
+    dirty = sub.run(['git', 'diff', '--quiet', 'HEAD', '--', 'src'], cwd=ROOT_DIR).returncode != 0
+    return f'{commit}-dirty' if dirty else commit
+  except OSError:
+    return 'unknown'
+
+
+def get_fixture_images() -> list[str]:
+  # Example inputs only, not the example outputs next to them, i.e. car-3.jpg but not car-3.debug.jpg
+  paths = sorted(glob.glob(os.path.join(EXAMPLES_DIR, '*.jpg')))
+  return [path for path in paths if os.path.basename(path).count('.') == 1]
+
+
+def get_fixture_video() -> str:
+  return os.path.join(EXAMPLES_DIR, 'food.mp4')
+
+
+def load_benchmark_models(models: str, sam_model: str, boxes: int = STUB_BOXES_PER_CLASS) -> tuple:
+  """
+  boxes (int): Boxes detected for each prompt by the stub models.
+
+  Returns:
+    Detector and predictor to benchmark with.
+  """
+  if models == 'stub':
+    return StubDetector(boxes_per_class=boxes), EmbeddingReusePredictor(StubPredictor())
+  from ezsam.cli.config.utils import create_gdconfig_file
+  from ezsam.cli.loader import load_models
+  from ezsam.cli.models import Model, get_default_paths_from_model
+
+  checkpoints = {}
+  for model in [Model.gd, Model(sam_model)]:
+    paths = [path for path in get_default_paths_from_model(model) if os.path.isfile(path)]
+    if not paths:
+      raise FileNotFoundError(f'No cached checkpoint for {model.value}, run ezsam with this model once to download it')
+    checkpoints[model] = paths[0]
+  gd_config_path = DEFAULT_GROUNDING_DINO_CONFIG_PATH
+  if not os.path.isfile(gd_config_path):
+    gd_config_path = create_gdconfig_file()
+  grounding_dino_model, _, sam_predictor = load_models(
+    gd_config_path=gd_config_path,
+    gd_checkpoint_path=checkpoints[Model.gd],
+    sam_model=sam_model.removeprefix('hq_'),
+    sam_checkpoint_path=checkpoints[Model(sam_model)],
+    device=torch.device('cpu'),
+  )
+  return grounding_dino_model, sam_predictor
+
+
+def get_memory_mb(field: str) -> float | None:
+  """
+  Memory use of this process from /proc on Linux, i.e. VmRSS for resident memory, or VmHWM for its peak.
+  """
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith(f'{field}:'):
+          return int(line.split()[1]) / 1024
+  except OSError:
+    pass
+  return None
+
+
+def reset_peak_memory() -> bool:
+  """
+  Reset this process's peak resident memory (VmHWM) to its current resident memory. Linux only.
+  """
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+    return True
+  except OSError:
+    return False
+
+
+class Benchmark:
+  def __init__(self, grounding_dino_model, sam_predictor, args: argparse.Namespace, tmp_dir: str):
+    self.grounding_dino_model = grounding_dino_model
+    self.sam_predictor = sam_predictor
+    self.args = args
+    self.tmp_dir = tmp_dir
+    self.segment_args = {
+      'prompts': PROMPTS,
+      'neg_prompts': NEG_PROMPTS,
+      'box_threshold': DEFAULT_BOX_THRESHOLD,
+      'text_threshold': DEFAULT_TEXT_THRESHOLD,
+      'nms_threshold': DEFAULT_NMS_THRESHOLD,
+      'sam_predictor': sam_predictor,
+      'grounding_dino_model': grounding_dino_model,
+    }
+    self.process_file_args = {
+      **self.segment_args,
+      'img_fmt': OutputImageFormat.png,
+      'codec': OutputVideoCodec.vp9,
+      'num_test_frames': args.frames,
+      'output_suffix': '.out',
+      'output_dir': tmp_dir,
+      'debug': False,
+      'cleanup': True,
+    }
+
+  def quiet(self):
+    if self.args.verbose:
+      return contextlib.nullcontext()
+    stack = contextlib.ExitStack()
+    devnull = stack.enter_context(open(os.devnull, 'w'))
+    stack.enter_context(contextlib.redirect_stdout(devnull))
+    stack.enter_context(contextlib.redirect_stderr(devnull))
+    return stack
+
+  def measure(self, run, items: int) -> dict:
+    """
+    Time run() after a warmup run.
+
+    items (int): Number of images or frames that each run processes.
+    """
+    with self.quiet():
+      run()
+      timer.reset()
+      times = []
+      peaks = []
+      for _ in range(max(1, self.args.repeat)):
+        # Embeddings from the previous run would otherwise be reused
+        self.sam_predictor.reset_image()
+        memory = get_memory_mb('VmRSS') if reset_peak_memory() else None
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+        if memory is not None:
+          peaks.append(get_memory_mb('VmHWM') - memory)
+    stages = timer.summary()['stages_seconds']
+    median = percentiles(times)['p50']
+    return {
+      'runs': len(times),
+      'items': items,
+      'median': median,
+      'min': min(times),
+      'max': max(times),
+      'items_per_second': items / median if median > 0 else 0.0,
+      'peak_mb': max(peaks) if peaks else None,
+      # Totals over all the timed runs
+      'stages_seconds': {stage: timing['total'] for stage, timing in stages.items() if timing['count'] > 0},
+    }
+
+  def process_image(self) -> dict:
+    images = [cv2.imread(path) for path in get_fixture_images()]
+
+    def run():
+      for image in images:
+        process_image(image=image, image_unchanged=None, debug=False, **self.segment_args)
+
+    return self.measure(run, items=len(images))
+
+  def process_file_image(self) -> dict:
+    srcs = get_fixture_images()
+
+    def run():
+      for src in srcs:
+        process_file(src=src, **self.process_file_args)
+
+    return self.measure(run, items=len(srcs))
+
+  def process_file_video(self) -> dict:
+    return self.measure(lambda: process_file(src=get_fixture_video(), **self.process_file_args), items=self.args.frames)
+
+  def composite(self) -> dict:
+    image = cv2.imread(os.path.join(EXAMPLES_DIR, 'animal-1.jpg'))
+    with self.quiet():
+      supermask = supermask_for_image(image=image, **self.segment_args)
+    if supermask is None:
+      supermask = np.zeros(image.shape[:2], dtype=bool)
+    h, w = image.shape[:2]
+    small_mask = cv2.resize(supermask.astype(np.uint8), (w // 2, h // 2), interpolation=cv2.INTER_NEAREST) > 0
+    runs = 10
+
+    def run():
+      for _ in range(runs):
+        apply_supermask(image=image, image_unchanged=None, supermask=supermask)
+        apply_supermask(image=image, image_unchanged=None, supermask=small_mask)
+
+    return self.measure(run, items=2 * runs)
+
+  def large_image(self) -> dict:
+    image = cv2.resize(cv2.imread(os.path.join(EXAMPLES_DIR, 'animal-1.jpg')), LARGE_IMAGE_SIZE)
+
+    def run():
+      process_image(image=image, image_unchanged=None, debug=False, **self.segment_args)
+
+    return self.measure(run, items=1)
+
+  def video_join(self) -> dict:
+    with self.quiet():
+      jobs, chunked = plan_jobs(
+        srcs=[get_fixture_video()], process_file_args=self.process_file_args, chunks=self.args.chunks
+      )
+      for job in jobs:
+        process_file(**job)
+    return self.measure(lambda: join_chunked_videos(chunked=chunked, errors=[], cleanup=False), items=self.args.frames)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+  """
+  Print the change in median time and peak memory for each case against baseline results.
+
+  Returns:
+    bool: Whether no case got slower, or used more memory, by more than threshold.
+  """
+  ok = True
+  print(f'Compared to {baseline["commit"]} ({baseline["models"]} models):')
+  for case, result in results['cases'].items():
+    base = baseline['cases'].get(case)
+    if base is None or 'median' not in base or 'median' not in result:
+      continue
+    change = result['median'] / base['median'] - 1 if base['median'] > 0 else 0.0
+    flag = ''
+    if change > threshold:
+      flag = '  <- regression'
+      ok = False
+    print(f'  {case:20} {base["median"]:8.3f}s -> {result["median"]:8.3f}s  {change:+7.1%}{flag}')
+    # Peak memory of cases that hardly allocate anything is all noise
+    if base.get('peak_mb') is not None and result.get('peak_mb') is not None and base['peak_mb'] >= 1:
+      change = result['peak_mb'] / base['peak_mb'] - 1
+      flag = ''
+      if change > threshold and result['peak_mb'] - base['peak_mb'] > MIN_MEMORY_REGRESSION_MB:
+        flag = '  <- regression'
+        ok = False
+      print(f'  {"":20} {base["peak_mb"]:7.1f}MB -> {result["peak_mb"]:7.1f}MB  {change:+7.1%}{flag}')
+  return ok
+
+
+def main(argv=None) -> int:
+  args = parse_args(argv)
+  cases = args.cases or CASES
+  if shutil.which('ffmpeg') is None:
+    print('Warning: ffmpeg not found, skipping video cases')
+    cases = [case for case in cases if case not in ['process_file_video', 'video_join']]
+  grounding_dino_model, sam_predictor = load_benchmark_models(args.models, args.sam_model, args.boxes)
+  results = {
+    'version': RESULTS_VERSION,
+    'commit': get_commit(),
+    'date': datetime.datetime.now().isoformat(timespec='seconds'),
+    'models': args.models if args.models == 'stub' else f'{args.models}:{args.sam_model}',
+    'python': platform.python_version(),
+    'torch': torch.__version__,
+    'platform': platform.platform(),
+    'cpu_count': os.cpu_count(),
+    'torch_threads': torch.get_num_threads(),
+    'repeat': args.repeat,
+    'boxes': args.boxes if args.models == 'stub' else None,
+    'cases': {},
+  }
+  with tempfile.TemporaryDirectory(prefix='ezsam-bench-') as tmp_dir:
+    benchmark = Benchmark(grounding_dino_model, sam_predictor, args, tmp_dir)
+    for case in cases:
+      print(f'Running {case} ...', end=' ', flush=True)
+      try:
+        result = getattr(benchmark, case)()
+        peak = f', peak memory {result["peak_mb"]:.1f}MB' if result['peak_mb'] is not None else ''
+        print(f'median {result["median"]:.3f}s, {result["items_per_second"]:.2f} per second{peak}')
+      except Exception as err:
+        print(f'failed: {err}')
+        result = {'error': f'{err}'}
+      results['cases'][case] = result
+  output = args.output or os.path.join(RESULTS_DIR, f'{args.models}-{results["commit"]}.json')
+  os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+  with open(output, 'w') as f:
+    json.dump(results, f, indent=2)
+  print(f'Wrote results to {output}')
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    if not compare(results, baseline, args.threshold):
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,259 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Mask quality regression check for faster processing options.
+#
+# Options like --max_side, --precision, --keyframe_interval, or --max_propagation trade some mask quality for speed.
+#  This runs ezsam over a dataset of images and videos with a baseline and a candidate set of options, and compares
+#  the foreground masks (the alpha channel) of the outputs, frame by frame for videos, using IoU and boundary F-measure.
+#  Any item scoring below --min_iou or --min_boundary_f, as a mean over frames for videos, fails the check.
+# With --golden, the candidate is compared against the dataset's stored reference outputs instead, i.e. the example
+#  outputs in examples/, for items that have one.
+#
+# The dataset is a JSON file listing each input, its ezsam options (i.e. prompts), and an optional reference output,
+#  with paths relative to the dataset file. Arguments not recognised by this script are passed to ezsam for both the
+#  baseline and the candidate, i.e. the models to use. Both sets of models are kept loaded for the whole check.
+#
+# Usage:
+#   python benchmarks/quality.py --candidate "--max_side 512"
+#   python benchmarks/quality.py --candidate "--precision int8" --hq -m vit_tiny
+#   python benchmarks/quality.py --candidate "--keyframe_interval 10" --golden --min_iou 0.8
+#
+
+import argparse
+import contextlib
+import json
+import os
+import shlex
+import subprocess as sub
+import sys
+import tempfile
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+
+import cv2  # noqa: E402
+import numpy as np  # noqa: E402
+
+from ezsam.cli.app import parse_args as parse_ezsam_args, run as run_ezsam  # noqa: E402
+from ezsam.cli.formats import OutputImageFormat, OutputVideoCodec  # noqa: E402
+from ezsam.cli.process import get_output_path  # noqa: E402
+from ezsam.cli.report import timer  # noqa: E402
+from ezsam.cli.server import ModelCache  # noqa: E402
+from ezsam.lib.file import InputMode, get_input_mode  # noqa: E402
+from ezsam.lib.metrics import boundary_f, mask_iou  # noqa: E402
+
+RESULTS_VERSION = 1
+DATASET_VERSION = 1
+DEFAULT_DATASET_PATH = os.path.join(ROOT_DIR, 'benchmarks', 'quality.json')
+OUTPUT_SUFFIX = '.out'
+# Lossless output formats, so that only the options being checked change the masks
+OUTPUT_IMAGE_FORMAT = OutputImageFormat.png
+OUTPUT_VIDEO_CODEC = OutputVideoCodec.ffv1
+# Output alpha at or above this is foreground
+ALPHA_THRESHOLD = 128
+
+
+def parse_args(argv=None) -> tuple[argparse.Namespace, list[str]]:
+  """
+  Returns:
+    argparse.Namespace: Arguments for this script.
+    list[str]: Remaining arguments, passed to ezsam for both the baseline and the candidate.
+  """
+  parser = argparse.ArgumentParser(
+    description='Compare ezsam masks from a candidate set of options against a baseline', allow_abbrev=False
+  )
+  parser.add_argument('--candidate', required=True, help='ezsam options to check, i.e. "--max_side 512"')
+  parser.add_argument('--baseline', default='', help='ezsam options for the baseline. Default none')
+  parser.add_argument('--golden', action='store_true', help='Compare against the dataset\'s reference outputs instead of running the baseline, where available')
+  parser.add_argument('--dataset', default=DEFAULT_DATASET_PATH, help='Dataset JSON file, default benchmarks/quality.json')
+  parser.add_argument('--min_iou', type=float, default=0.95, help='Lowest mask IoU that passes')
+  parser.add_argument('--min_boundary_f', type=float, default=0.9, help='Lowest mask boundary F-measure that passes')
+  parser.add_argument('--output', help='Path to write JSON results to')
+  parser.add_argument('--verbose', action='store_true', help='Show logging from ezsam')
+  return parser.parse_known_args(argv)
+
+
+def load_dataset(path: str) -> list[dict]:
+  """
+  Returns:
+    list[dict]: Items with input, args, and reference (or None), with paths resolved relative to the dataset file.
+  """
+  with open(path) as f:
+    dataset = json.load(f)
+  if dataset.get('version') != DATASET_VERSION:
+    raise ValueError(f'Unsupported dataset version in {path}: {dataset.get("version")}')
+  folder = os.path.dirname(os.path.abspath(path))
+  items = []
+  for item in dataset['items']:
+    reference = item.get('reference')
+    items.append(
+      {
+        'input': os.path.normpath(os.path.join(folder, item['input'])),
+        'args': [str(arg) for arg in item.get('args', [])],
+        'reference': os.path.normpath(os.path.join(folder, reference)) if reference else None,
+      }
+    )
+  return items
+
+
+def read_video_alphas(path: str) -> list[np.ndarray]:
+  capture = cv2.VideoCapture(path)
+  w, h = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+  capture.release()
+  if w == 0 or h == 0:
+    raise ValueError(f'Could not read video {path}')
+  # FFmpeg's native VP9 decoder drops the alpha channel
+  decoder = ['-c:v', 'libvpx-vp9'] if path.endswith('.webm') else []
+  cmd = ['ffmpeg', '-v', 'error', *decoder, '-i', path, '-vf', 'alphaextract', '-f', 'rawvideo', '-pix_fmt', 'gray', '-']
+  result = sub.run(cmd, capture_output=True)
+  if result.returncode != 0:
+    raise ValueError(f'Could not decode video {path}: {result.stderr.decode(errors="replace").strip()}')
+  return list(np.frombuffer(result.stdout, dtype=np.uint8).reshape(-1, h, w))
+
+
+def read_masks(path: str) -> list[np.ndarray]:
+  """
+  Foreground masks from the alpha channel of an output image, or of each frame of an output video.
+  """
+  if not os.path.isfile(path):
+    raise FileNotFoundError(f'No output at {path}')
+  if get_input_mode(path) == InputMode.video:
+    alphas = read_video_alphas(path)
+  else:
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None or image.ndim != 3 or image.shape[2] != 4:
+      raise ValueError(f'No alpha channel in {path}')
+    alphas = [image[:, :, 3]]
+  return [alpha >= ALPHA_THRESHOLD for alpha in alphas]
+
+
+class QualityCheck:
+  def __init__(self, args: argparse.Namespace, common_args: list[str], tmp_dir: str):
+    self.args = args
+    self.common_args = common_args
+    self.tmp_dir = tmp_dir
+    # Keeps both the baseline and candidate models loaded
+    self.model_cache = ModelCache(max_models=2)
+
+  def quiet(self):
+    if self.args.verbose:
+      return contextlib.nullcontext()
+    stack = contextlib.ExitStack()
+    devnull = stack.enter_context(open(os.devnull, 'w'))
+    stack.enter_context(contextlib.redirect_stdout(devnull))
+    stack.enter_context(contextlib.redirect_stderr(devnull))
+    return stack
+
+  def run(self, name: str, index: int, item: dict, options: list[str]) -> tuple[str, float]:
+    """
+    Process an item with ezsam.
+
+    Returns:
+      str: Path to the output.
+      float: Processing time in seconds, not including loading models.
+    """
+    src = item['input']
+    output_dir = os.path.join(self.tmp_dir, name, f'{index}')
+    # Input first, since prompts take any number of values
+    argv = [src, *item['args'], *self.common_args, *options]
+    argv += ['-o', output_dir, '-s', OUTPUT_SUFFIX, '--img', OUTPUT_IMAGE_FORMAT.value]
+    argv += ['--codec', OUTPUT_VIDEO_CODEC.value]
+    with self.quiet():
+      errors = run_ezsam(parse_ezsam_args(argv), model_cache=self.model_cache)
+    if errors:
+      raise ValueError(errors[0][1])
+    seconds = timer.summary()['wall_seconds']
+    out = get_output_path(
+      src=src,
+      input_mode=get_input_mode(src),
+      img_fmt=OUTPUT_IMAGE_FORMAT,
+      codec=OUTPUT_VIDEO_CODEC,
+      output_suffix=OUTPUT_SUFFIX,
+      output_dir=output_dir,
+      debug=False,
+    )
+    return out, seconds
+
+  def check(self, index: int, item: dict) -> dict:
+    golden = self.args.golden and item['reference'] is not None
+    if golden:
+      reference_masks = read_masks(item['reference'])
+      baseline_seconds = None
+    else:
+      baseline_out, baseline_seconds = self.run('baseline', index, item, shlex.split(self.args.baseline))
+      reference_masks = read_masks(baseline_out)
+    candidate_out, candidate_seconds = self.run('candidate', index, item, shlex.split(self.args.candidate))
+    masks = read_masks(candidate_out)
+    # Reference videos can have more frames than were processed, i.e. with --nf
+    if len(masks) == 0 or (len(masks) > len(reference_masks)) or (not golden and len(masks) != len(reference_masks)):
+      raise ValueError(f'Candidate has {len(masks)} frames, reference has {len(reference_masks)}')
+    ious = []
+    boundary_fs = []
+    for reference_mask, mask in zip(reference_masks, masks):
+      if reference_mask.shape != mask.shape:
+        raise ValueError(f'Candidate mask size {mask.shape} differs from reference {reference_mask.shape}')
+      ious.append(mask_iou(reference_mask, mask))
+      boundary_fs.append(boundary_f(reference_mask, mask))
+    result = {
+      'reference': 'golden' if golden else 'baseline',
+      'frames': len(ious),
+      'iou': float(np.mean(ious)),
+      'boundary_f': float(np.mean(boundary_fs)),
+      'min_iou': min(ious),
+      'min_boundary_f': min(boundary_fs),
+      'baseline_seconds': baseline_seconds,
+      'candidate_seconds': candidate_seconds,
+    }
+    if len(ious) > 1:
+      result['frame_iou'] = ious
+      result['frame_boundary_f'] = boundary_fs
+    result['passed'] = result['iou'] >= self.args.min_iou and result['boundary_f'] >= self.args.min_boundary_f
+    return result
+
+
+def main(argv=None) -> int:
+  args, common_args = parse_args(argv)
+  items = load_dataset(args.dataset)
+  results = {
+    'version': RESULTS_VERSION,
+    'dataset': args.dataset,
+    'baseline': 'golden' if args.golden else args.baseline,
+    'candidate': args.candidate,
+    'common_args': common_args,
+    'min_iou': args.min_iou,
+    'min_boundary_f': args.min_boundary_f,
+    'items': {},
+  }
+  ok = True
+  print(f'{"item":32} {"frames":>6} {"IoU":>6} {"BF":>6} {"min IoU":>8} {"min BF":>8} {"base s":>8} {"cand s":>8}')
+  with tempfile.TemporaryDirectory(prefix='ezsam-quality-') as tmp_dir:
+    check = QualityCheck(args, common_args, tmp_dir)
+    for index, item in enumerate(items):
+      name = os.path.relpath(item['input'], ROOT_DIR)
+      try:
+        result = check.check(index, item)
+      except Exception as err:
+        print(f'{name:32} failed: {err}')
+        results['items'][name] = {'error': f'{err}', 'passed': False}
+        ok = False
+        continue
+      results['items'][name] = result
+      ok = ok and result['passed']
+      base_s = '-' if result['baseline_seconds'] is None else f'{result["baseline_seconds"]:.2f}'
+      print(
+        f'{name:32} {result["frames"]:6d} {result["iou"]:6.3f} {result["boundary_f"]:6.3f} '
+        + f'{result["min_iou"]:8.3f} {result["min_boundary_f"]:8.3f} {base_s:>8} {result["candidate_seconds"]:8.2f}'
+        + ('' if result['passed'] else '  <- below threshold')
+      )
+  results['passed'] = ok
+  if args.output:
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+    print(f'Wrote results to {args.output}')
+  print('Passed' if ok else f'Failed: IoU below {args.min_iou} or boundary F below {args.min_boundary_f}')
+  return 0 if ok else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,119 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Startup time benchmark for the CLI and GUI.
+#
+# Times `ezsam --help` and showing the GUI's first window in fresh processes, and lists the slowest imports using
+#  `python -X importtime`. Also times a GUI executable built with make-nuitka.sh, given with --exe.
+# Neither entry point should import the machine learning libraries at startup, so any of the heavy modules imported
+#  is reported, and the benchmark exits with an error.
+#
+# Usage:
+#   python benchmarks/startup.py
+#   python benchmarks/startup.py --exe dist-nuitka/ezsam-0.0.0/app.bin
+#
+
+import argparse
+import os
+import statistics
+import subprocess as sub
+import sys
+import time
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+# Should match ezsam.gui.config.EXIT_AFTER_STARTUP_ENV
+EXIT_AFTER_STARTUP_ENV = 'EZSAM_EXIT_AFTER_STARTUP'
+HEAVY_MODULES = ['torch', 'torchvision', 'groundingdino', 'segment_anything_hq', 'supervision', 'cv2', 'onnxruntime']
+TARGETS = {
+  'cli': ['-m', 'ezsam.cli.app', '--help'],
+  'gui': ['-m', 'ezsam.gui.app'],
+}
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description='Measure ezsam startup time')
+  parser.add_argument('targets', nargs='*', help=f'Entry points to time, any of: {", ".join(TARGETS)}. Default all')
+  parser.add_argument('--runs', type=int, default=5, help='Number of times to start each entry point')
+  parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to list')
+  parser.add_argument('--exe', help='Path to a GUI executable built with make-nuitka.sh to time as well')
+  args = parser.parse_args(argv)
+  for target in args.targets:
+    if target not in TARGETS:
+      parser.error(f'unknown target: {target}')
+  return args
+
+
+def get_env() -> dict[str, str]:
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join([SRC_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+  env[EXIT_AFTER_STARTUP_ENV] = '1'
+  return env
+
+
+def run_timed(cmd: list[str], env: dict[str, str]) -> tuple[float, sub.CompletedProcess]:
+  start = time.perf_counter()
+  result = sub.run(cmd, env=env, stdout=sub.DEVNULL, stderr=sub.PIPE, text=True)
+  return time.perf_counter() - start, result
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, float, float]]:
+  """
+  Parse `python -X importtime` output.
+
+  Returns:
+    list[tuple[str, int, float, float]]: Module name, nesting depth, self and cumulative import time in seconds.
+  """
+  imports = []
+  for line in stderr.splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    self_us, cumulative_us, name = line[len('import time:') :].split('|')
+    # Names are indented by two spaces per level of nesting, after a single space
+    depth = (len(name) - len(name.lstrip()) - 1) // 2
+    imports.append((name.strip(), depth, int(self_us) / 1e6, int(cumulative_us) / 1e6))
+  return imports
+
+
+def report(name: str, times: list[float], imports: list[tuple[str, int, float, float]] | None, top: int) -> bool:
+  """
+  Print timings for an entry point.
+
+  Returns:
+    bool: Whether no heavy modules were imported.
+  """
+  print(f'{name}: median {statistics.median(times):.3f}s, min {min(times):.3f}s over {len(times)} runs')
+  if imports is None:
+    return True
+  # Cumulative times of the top level imports add up to the total
+  total = sum(cumulative for _, depth, _, cumulative in imports if depth == 0)
+  print(f'  imports: {total:.3f}s for {len(imports)} modules')
+  for module, _, _, cumulative in sorted(imports, key=lambda i: i[3], reverse=True)[:top]:
+    print(f'  {cumulative:8.3f}s  {module}')
+  heavy = sorted({module.split('.')[0] for module, *_ in imports} & set(HEAVY_MODULES))
+  if heavy:
+    print(f'  Error: imports heavy modules at startup: {", ".join(heavy)}')
+  return not heavy
+
+
+def main(argv=None) -> int:
+  args = parse_args(argv)
+  env = get_env()
+  ok = True
+  for target in args.targets or TARGETS.keys():
+    cmd = [sys.executable, '-X', 'importtime'] + TARGETS[target]
+    times = []
+    for _ in range(max(1, args.runs)):
+      elapsed, result = run_timed(cmd, env)
+      if result.returncode != 0:
+        print(f'{target}: failed to start, skipping: {result.stderr.strip().splitlines()[-1:]}')
+        break
+      times.append(elapsed)
+    if times:
+      ok = report(target, times, parse_importtime(result.stderr), args.top) and ok
+  if args.exe:
+    times = [run_timed([args.exe], env)[0] for _ in range(max(1, args.runs))]
+    report(os.path.basename(args.exe), times, None, args.top)
+  return 0 if ok else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
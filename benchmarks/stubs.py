@@ -0,0 +1,100 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Deterministic stand-ins for the GroundingDINO model and SAM predictor, for benchmarking the processing pipeline
+#  around the models without checkpoints, a GPU, or network access.
+#
+# Both return the same detections and masks every time for images of the same size, and cost next to nothing to run,
+#  so benchmark timings only measure ezsam's own work: decoding, NMS, batching, compositing, encoding, and so on.
+#
+
+import math
+
+import numpy as np
+import supervision as sv
+import torch
+
+# Boxes detected per class (prompt) in each image
+STUB_BOXES_PER_CLASS = 2
+# Number of candidate masks returned for each box, same as SAM's multimask output
+STUB_CANDIDATE_MASKS = 3
+
+
+class StubDetector:
+  """
+  Same interface as groundingdino.util.inference.Model.predict_with_classes().
+  Detects STUB_BOXES_PER_CLASS overlapping boxes for each class, laid out on a grid over the image.
+  """
+
+  def __init__(self, boxes_per_class: int = STUB_BOXES_PER_CLASS):
+    self.boxes_per_class = boxes_per_class
+
+  def predict_with_classes(
+    self, image: np.ndarray, classes: list[str], box_threshold: float, text_threshold: float
+  ) -> sv.Detections:
+    h, w = image.shape[:2]
+    xyxy, confidence, class_id = [], [], []
+    for c in range(len(classes)):
+      for k in range(self.boxes_per_class):
+        cx = w * (k + 1) / (self.boxes_per_class + 1)
+        cy = h * (c + 1) / (len(classes) + 1)
+        xyxy.append([cx - 0.2 * w, cy - 0.2 * h, cx + 0.2 * w, cy + 0.2 * h])
+        confidence.append(0.9 - 0.1 * k)
+        class_id.append(c)
+    xyxy = np.clip(np.array(xyxy).reshape(-1, 4), 0, [w, h, w, h]).astype(np.float32)
+    return sv.Detections(
+      xyxy=xyxy, confidence=np.array(confidence, dtype=np.float32), class_id=np.array(class_id, dtype=int)
+    )
+
+
+class StubTransform:
+  # Same as SAM's ResizeLongestSide, except boxes stay in original image coordinates
+  target_length = 1024
+
+  def apply_boxes_torch(self, boxes: torch.Tensor, original_size: tuple[int, int]) -> torch.Tensor:
+    return boxes
+
+
+class StubPredictor:
+  """
+  Same interface as segment_anything_hq.SamPredictor, as used by ezsam.
+  Masks are ellipses inscribed in each box, the candidates shrinking with falling scores.
+  """
+
+  def __init__(self):
+    self.device = torch.device('cpu')
+    self.transform = StubTransform()
+    self.reset_image()
+
+  def set_image(self, image: np.ndarray, image_format: str = 'RGB') -> None:
+    self.original_size = image.shape[:2]
+    self.is_image_set = True
+
+  def reset_image(self) -> None:
+    self.original_size = None
+    self.is_image_set = False
+
+  def predict_torch(
+    self,
+    point_coords: torch.Tensor | None,
+    point_labels: torch.Tensor | None,
+    boxes: torch.Tensor | None = None,
+    mask_input: torch.Tensor | None = None,
+    multimask_output: bool = True,
+    return_logits: bool = False,
+    hq_token_only: bool = False,
+  ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    h, w = self.original_size
+    masks = torch.zeros(len(boxes), STUB_CANDIDATE_MASKS, h, w, dtype=torch.bool)
+    # Only compute each ellipse within its box, so the stub itself doesn't use much time or memory on large images
+    for b, (x0, y0, x1, y1) in enumerate(boxes.tolist()):
+      left, top = max(0, math.floor(x0)), max(0, math.floor(y0))
+      right, bottom = min(w, math.ceil(x1) + 1), min(h, math.ceil(y1) + 1)
+      ys = torch.arange(top, bottom, dtype=torch.float32)[:, None]
+      xs = torch.arange(left, right, dtype=torch.float32)[None, :]
+      rx, ry = max((x1 - x0) / 2, 1), max((y1 - y0) / 2, 1)
+      distance = ((xs - (x0 + x1) / 2) / rx) ** 2 + ((ys - (y0 + y1) / 2) / ry) ** 2
+      for i in range(STUB_CANDIDATE_MASKS):
+        masks[b, i, top:bottom, left:right] = distance <= (1 - 0.1 * i) ** 2
+    scores = torch.tensor([[0.9 - 0.1 * i for i in range(STUB_CANDIDATE_MASKS)]] * len(boxes))
+    low_res_masks = torch.zeros(len(boxes), STUB_CANDIDATE_MASKS, 256, 256)
+    return masks, scores, low_res_masks
@@ -13,16 +13,11 @@ import numbers
 import os
 import sys
 
-import torch
-import groundingdino.util.inference as gd
-# import segment_anything_hq as samhq # Noisy
-
 from ezsam.lib.date import now
-from ezsam.lib.downloader import download
-from ezsam.lib.gpu import attempt_gpu_cleanup
 from ezsam.cli.models import Model, MODEL_URL, get_default_paths_from_model
 from ezsam.cli.formats import OutputImageFormat, OutputVideoCodec
-from ezsam.cli.process import process_file
+from ezsam.cli.options import Precision, SamBackend, SamCropMode
+from ezsam.cli.server import ModelCache, parse_serve_args, send_job, serve
 from ezsam.cli.config.utils import create_gdconfig_file
 from ezsam.cli.config.defaults import (
   DEFAULT_SAM_MODEL,
@@ -34,6 +29,23 @@ from ezsam.cli.config.defaults import (
   DEFAULT_NMS_THRESHOLD,
   DEFAULT_IMAGE_FORMAT,
   DEFAULT_VIDEO_CODEC,
+  DEFAULT_QUEUE_DEPTH,
+  DEFAULT_KEYFRAME_INTERVAL,
+  DEFAULT_SCENE_THRESHOLD,
+  DEFAULT_MAX_PROPAGATION,
+  DEFAULT_PROPAGATION_MOTION,
+  DEFAULT_PROPAGATION_EDGE_ERROR,
+  DEFAULT_WORKERS,
+  DEFAULT_SERVER_PORT,
+  DEFAULT_RESULT_CACHE_SIZE_MB,
+  DEFAULT_EMBEDDING_CACHE_SIZE_MB,
+  DEFAULT_GD_BATCH_SIZE,
+  DEFAULT_VIDEO_CHUNKS,
+  DEFAULT_CHECKPOINT_FRAMES,
+  DEFAULT_SAM_CROP,
+  DEFAULT_TILE_OVERLAP,
+  DEFAULT_PRECISION,
+  DEFAULT_SAM_BACKEND,
 )
 
 
@@ -47,6 +59,19 @@ def parse_args(argv=None):
       raise ValueError(f'Error value {num} should be a float between 0 and 1 inclusive')
     return num
 
+  def overlap_fraction(value: str):
+    num = unit_interval(value)
+    # Tiles overlapping by their whole size would never move on
+    if num >= 1:
+      raise ValueError(f'Error value {num} should be a float from 0 up to but not including 1')
+    return num
+
+  def positive_int(value: str):
+    num = int(value)
+    if num <= 0:
+      raise ValueError(f'Error value {num} should be a positive integer')
+    return num
+
   parser = argparse.ArgumentParser('ezsam', add_help=True)
   # fmt: off
   parser.add_argument('input', nargs='+', help='Input image(s) or video(s) to process')
@@ -61,6 +86,7 @@ def parse_args(argv=None):
   parser.add_argument('--sam', '--sam_checkpoint', type=str, required=False, help='Path to Segment-Anything checkpoint file')
   parser.add_argument('-p', '--prompts', '--prompt_string', nargs='*', help='Comma delimited list of prompts to use in foreground selection')
   parser.add_argument('-n', '--nprompts', '--nprompt_string', nargs='*', help='Comma delimited list of negative prompts to exclude from selection')
+  parser.add_argument('--sp', '--single_pass', action='store_true', help='Detect positive and negative prompts together in a single GroundingDINO pass. Faster, but detections can differ slightly')
   parser.add_argument('--pfile', '--prompt_file', type=str, required=False, help='Path to file with foreground selection prompts, one per line')
   parser.add_argument('--npfile', '--nprompt_file', type=str, required=False, help='Path to file with negative prompts, one per line')
   parser.add_argument('--img', '--img_fmt', choices=[c.value for c in OutputImageFormat], default=DEFAULT_IMAGE_FORMAT, help='Image file format to use for output files(s)')
@@ -68,14 +94,68 @@ def parse_args(argv=None):
   parser.add_argument('--nf', '--num_frames', type=int, required=False, help='Number of frames to process for each input video, for testing purposes')
   parser.add_argument('-s', '--output_suffix', type=str, default=DEFAULT_OUTPUT_SUFFIX, help='Suffix to append to processed output name(s) i.e. for ".out", src.jpg -> src.out.png')
   parser.add_argument('-o', '--output_dir', type=str, default=DEFAULT_OUTPUT_DIR, help='Directory to write processed output to')
-  parser.add_argument('-k', '--keep', action='store_true', help='Keep temporary image files generated when processing video')
+  parser.add_argument('--tmp', '--temp_files', action='store_true', help='Write processed video frames to temporary image files before joining into a video, instead of streaming frames to the video encoder')
+  parser.add_argument('--gb', '--gd_batch_size', type=int, default=DEFAULT_GD_BATCH_SIZE, help='Number of video frames or same size input images to run GroundingDINO object detection on at once. Use 1 to detect objects one image at a time')
+  parser.add_argument('--kf', '--keyframe_interval', type=int, default=DEFAULT_KEYFRAME_INTERVAL, help='For video, only detect objects every this many frames and track detection boxes in between. Use 1 to detect objects in every frame')
+  parser.add_argument('--sc', '--scene_threshold', type=unit_interval, default=DEFAULT_SCENE_THRESHOLD, help='For video with --keyframe_interval, also detect objects when the difference from the previous frame is above this threshold [0,1]')
+  parser.add_argument('--mp', '--max_propagation', type=int, default=DEFAULT_MAX_PROPAGATION, help='For video, warp the previous frame\'s mask onto up to this many following frames using optical flow instead of segmenting them. Use 0 to segment every frame')
+  parser.add_argument('--pm', '--propagation_motion', type=float, default=DEFAULT_PROPAGATION_MOTION, help='With --max_propagation, segment the frame if mean motion from the previous frame is above this many pixels')
+  parser.add_argument('--pe', '--propagation_edge_error', type=unit_interval, default=DEFAULT_PROPAGATION_EDGE_ERROR, help='With --max_propagation, segment the frame if the warped mask edges differ from the frame by more than this threshold [0,1]')
+  parser.add_argument('--qd', '--queue_depth', type=int, default=DEFAULT_QUEUE_DEPTH, help='Number of video frames to buffer between the decode, inference, and encode stages, rounded up to whole batches of --gd_batch_size frames. Use 0 to run the stages one after another')
+  parser.add_argument('-k', '--keep', action='store_true', help='Keep temporary image files generated when processing video. Implies --temp_files')
+  parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS, help='Number of worker processes to process input files with in parallel, each loading its own copy of the models')
+  parser.add_argument('--cache', '--result_cache', action='store_true', help='Cache foreground masks on disk, and reuse them when processing identical images or video frames with the same models and options again')
+  parser.add_argument('--cache_size', type=int, default=DEFAULT_RESULT_CACHE_SIZE_MB, help='Maximum size of the --result_cache in megabytes, least recently used masks are deleted first')
+  parser.add_argument('--ec', '--embedding_cache', action='store_true', help='Cache SAM image embeddings on disk, and reuse them when segmenting the same images again with any prompts')
+  parser.add_argument('--embedding_cache_size', type=int, default=DEFAULT_EMBEDDING_CACHE_SIZE_MB, help='Maximum size of the --embedding_cache in megabytes, least recently used embeddings are deleted first')
+  parser.add_argument('--local', action='store_true', help='Always load models and process files in this process, even if an ezsam server is running')
+  parser.add_argument('--port', '--server_port', type=int, default=DEFAULT_SERVER_PORT, help='Port of the local ezsam server to send jobs to, if one is running')
+  parser.add_argument('--chunks', '--video_chunks', type=int, default=DEFAULT_VIDEO_CHUNKS, help='Split each input video into this many chunks of frames, processed in parallel by worker processes and then joined. Not available for gif and apng output')
+  parser.add_argument('--max_side', type=positive_int, default=None, help='Run object detection and segmentation on a copy of each image or video frame downscaled so its longest side is at most this many pixels, then upsample the mask to full resolution along image edges. Speeds up processing large photos')
+  parser.add_argument('--sam_crop', choices=[c.value for c in SamCropMode], default=DEFAULT_SAM_CROP, help='Segment padded crops around clusters of detected objects instead of the whole image, for more detail on small objects in large images. auto only uses crops when they cover a small part of a large image')
+  parser.add_argument('--tile_size', type=positive_int, default=None, help='Also detect objects on overlapping square tiles of this many pixels for larger images, to find small objects in very high resolution images. Tiles are batched by --gd_batch_size')
+  parser.add_argument('--tile_overlap', type=overlap_fraction, default=DEFAULT_TILE_OVERLAP, help='Fraction of --tile_size that neighbouring tiles overlap by [0,1). Objects smaller than the overlap are always whole in some tile')
+  parser.add_argument('--precision', choices=[c.value for c in Precision], default=DEFAULT_PRECISION, help='Numeric precision to run the models at. int8 quantizes the models for faster inference on CPU, bf16 is faster on CPUs and GPUs with native bfloat16 support. Both lower mask quality somewhat, see --check_precision')
+  parser.add_argument('--check_precision', action='store_true', help='Instead of writing output, compare foreground masks for the input images at --precision against fp32, and report mask IoU and timings. With --sam_backend onnx, masks are compared against SAM run with PyTorch')
+  parser.add_argument('--sam_backend', choices=[c.value for c in SamBackend], default=DEFAULT_SAM_BACKEND, help='Runtime for SAM. onnx exports SAM to ONNX once, then runs it with ONNX Runtime on CPU, which is faster than PyTorch at prompting boxes on CPU. Needs: pip install "ezsam[onnx]"')
+  parser.add_argument('--resume', action='store_true', help='Keep track of finished video frames, so that running the same command again after an interruption continues where it stopped. Videos already finished by an earlier --resume job are skipped')
+  parser.add_argument('--checkpoint_frames', type=int, default=DEFAULT_CHECKPOINT_FRAMES, help='With --resume, number of frames per segment video kept when interrupted, i.e. at most this many frames are processed again when resuming. Not used with --temp_files, gif or apng, which keep every frame')
+  parser.add_argument('--report', default=None, help='Write a JSON report of time spent in each processing stage, frames per second, boxes per image, and peak memory use to this path')
   parser.add_argument('--smem', '--show_memory', action='store_true', help='Show PyTorch CUDA memory summary on completion')
   # fmt: on
   return parser.parse_args(argv)
 
 
 def main(argv=None):
+  """
+  Process files, or start a persistent model server with `ezsam serve`.
+  When a server is running, jobs are sent to it instead of loading the models again in this process.
+  """
+  argv = list(sys.argv[1:] if argv is None else argv)
+  if len(argv) > 0 and argv[0] == 'serve':
+    serve_args = parse_serve_args(argv[1:])
+    serve(run=run_server_job, port=serve_args.port, max_models=serve_args.max_models)
+    return
   args = parse_args(argv)
+  if not args.local:
+    errors = send_job(argv, port=args.port)
+    if errors is not None:
+      return
+  run(args)
+
+
+def run_server_job(argv: list[str], model_cache: ModelCache) -> list[tuple[str, str]]:
+  return run(parse_args(argv), model_cache=model_cache)
+
+
+def run(args: argparse.Namespace, model_cache: ModelCache | None = None) -> list[tuple[str, str]]:
+  """
+  args (argparse.Namespace): Parsed command line arguments.
+  model_cache (ModelCache | None): Models kept loaded by the server. If None, models are loaded for this run only.
+
+  Returns:
+    list[tuple[str, str]]: Input file and error message for each file that could not be processed.
+  """
   INPUT: list[str] = args.input or []
   DEBUG: bool = args.debug
   GD_CONFIG_PATH = args.gconf or DEFAULT_GROUNDING_DINO_CONFIG_PATH
@@ -97,13 +177,38 @@ def main(argv=None):
   NPROMPT_STRING: str = ' '.join(args.nprompts) if args.nprompts else None
   PROMPT_FILE: str = args.pfile
   NPROMPT_FILE: str = args.npfile
+  SINGLE_PASS: bool = args.sp
   IMG_FMT: OutputImageFormat = args.img or DEFAULT_IMAGE_FORMAT
   CODEC: OutputVideoCodec = args.codec or DEFAULT_VIDEO_CODEC
   NUM_TEST_FRAMES: int = args.nf
   OUTPUT_DIR: str = args.output_dir.rstrip('/')
   OUTPUT_SUFFIX: str = args.output_suffix
   CLEANUP: bool = not args.keep
+  TEMP_FILES: bool = args.tmp or args.keep
+  QUEUE_DEPTH: int = args.qd
+  KEYFRAME_INTERVAL: int = args.kf
+  SCENE_THRESHOLD: float = args.sc
+  MAX_PROPAGATION: int = args.mp
+  PROPAGATION_MOTION: float = args.pm
+  PROPAGATION_EDGE_ERROR: float = args.pe
   SHOW_MEMORY_SUMMARY: bool = args.smem
+  REPORT: str | None = args.report
+  WORKERS: int = args.workers
+  GD_BATCH_SIZE: int = args.gb
+  VIDEO_CHUNKS: int = args.chunks
+  RESUME: bool = args.resume
+  MAX_SIDE: int | None = args.max_side
+  SAM_CROP = SamCropMode(args.sam_crop)
+  TILE_SIZE: int | None = args.tile_size
+  TILE_OVERLAP: float = args.tile_overlap
+  PRECISION = Precision(args.precision)
+  CHECK_PRECISION: bool = args.check_precision
+  SAM_BACKEND = SamBackend(args.sam_backend)
+  CHECKPOINT_FRAMES: int = args.checkpoint_frames
+  RESULT_CACHE: bool = args.cache
+  RESULT_CACHE_SIZE: int = args.cache_size
+  EMBEDDING_CACHE: bool = args.ec
+  EMBEDDING_CACHE_SIZE: int = args.embedding_cache_size
   print('---------------------')
   print('Running with options:')
   print(f'--input: {INPUT}')
@@ -121,10 +226,36 @@ def main(argv=None):
   print(f'--num_frames: {NUM_TEST_FRAMES}')
   print(f'--output_dir: {OUTPUT_DIR}')
   print(f'--output_suffix: {OUTPUT_SUFFIX}')
+  print(f'--temp_files: {TEMP_FILES}')
+  print(f'--keep: {not CLEANUP}')
+  print(f'--queue_depth: {QUEUE_DEPTH}')
+  print(f'--keyframe_interval: {KEYFRAME_INTERVAL}')
+  print(f'--scene_threshold: {SCENE_THRESHOLD}')
+  print(f'--max_propagation: {MAX_PROPAGATION}')
+  print(f'--propagation_motion: {PROPAGATION_MOTION}')
+  print(f'--propagation_edge_error: {PROPAGATION_EDGE_ERROR}')
   print(f'--prompt_string: {PROMPT_STRING}')
   print(f'--nprompt_string: {NPROMPT_STRING}')
   print(f'--prompt_file: {PROMPT_FILE}')
   print(f'--nprompt_file: {NPROMPT_FILE}')
+  print(f'--single_pass: {SINGLE_PASS}')
+  print(f'--workers: {WORKERS}')
+  print(f'--gd_batch_size: {GD_BATCH_SIZE}')
+  print(f'--video_chunks: {VIDEO_CHUNKS}')
+  print(f'--resume: {RESUME}')
+  print(f'--max_side: {MAX_SIDE}')
+  print(f'--sam_crop: {SAM_CROP.value}')
+  print(f'--tile_size: {TILE_SIZE}')
+  print(f'--tile_overlap: {TILE_OVERLAP}')
+  print(f'--precision: {PRECISION.value}')
+  print(f'--check_precision: {CHECK_PRECISION}')
+  print(f'--sam_backend: {SAM_BACKEND.value}')
+  print(f'--checkpoint_frames: {CHECKPOINT_FRAMES}')
+  print(f'--result_cache: {RESULT_CACHE}')
+  print(f'--cache_size: {RESULT_CACHE_SIZE}')
+  print(f'--embedding_cache: {EMBEDDING_CACHE}')
+  print(f'--embedding_cache_size: {EMBEDDING_CACHE_SIZE}')
+  print(f'--report: {REPORT}')
   print(f'--show_memory: {SHOW_MEMORY_SUMMARY}')
   print('---------------------')
 
@@ -179,6 +310,8 @@ def main(argv=None):
       str: Path to the cached or downloaded checkpoint file for `model_name`.
       bool: Whether something needed to be downloaded.
     """
+    from ezsam.lib.downloader import download
+
     checkpoint_path = None
     something_downloaded = False
     default_checkpoint_paths: list[str] = get_default_paths_from_model(model_name)
@@ -197,6 +330,8 @@ def main(argv=None):
     return checkpoint_path, something_downloaded
   
   print('Checking if models need to be downloaded ...')
+  gd_downloaded = False
+  sam_downloaded = False
   if not GD_CHECKPOINT:
     gd_checkpoint_path, gd_downloaded = get_cached_model_or_download(Model.gd)
   if not SAM_CHECKPOINT:
@@ -214,64 +349,137 @@ def main(argv=None):
   if DEBUG:
     print('Debug mode active: output images will have bounding box and masks overlaying original')
 
-  grounding_dino_model = None
-  sam = None
-  sam_predictor = None
-  try:
-    DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print(f'Running on: {DEVICE}')
-
-    # Only running inference, not training models, so disable gradient calculation to reduce memory usage
-    # ref: https://pytorch.org/docs/stable/generated/torch.no_grad.html
-    with torch.no_grad():
-      attempt_gpu_cleanup()
-
-      print(f'{now()}: Loading GroundingDINO model ...')
-      grounding_dino_model = gd.Model(model_config_path=GD_CONFIG_PATH, model_checkpoint_path=gd_checkpoint_path, device=DEVICE)
-
-      print(f'{now()}: Loading SAM model and predictor ...')
-      import segment_anything_hq as samhq
-
-      sam = samhq.sam_model_registry[SAM_MODEL](checkpoint=sam_checkpoint_path)
-      sam.to(device=DEVICE)
-      sam_predictor = samhq.SamPredictor(sam)
-
-      had_error = False
-      for src in INPUT:
-        try:
-          process_file_args = {
-            'src': src,
-            'prompts': prompts,
-            'neg_prompts': neg_prompts,
-            'box_threshold': BOX_THRESHOLD,
-            'text_threshold': TEXT_THRESHOLD,
-            'nms_threshold': NMS_THRESHOLD,
-            'sam_predictor': sam_predictor,
-            'grounding_dino_model': grounding_dino_model,
-            'img_fmt': IMG_FMT,
-            'codec': CODEC,
-            'num_test_frames': NUM_TEST_FRAMES,
-            'output_suffix': OUTPUT_SUFFIX,
-            'output_dir': OUTPUT_DIR,
-            'debug': DEBUG,
-            'cleanup': CLEANUP,
-          }
-          process_file(**process_file_args)
-        except Exception as err:
-          print(f'Error processing file {src}: {err}')
-          had_error = True
-      print(f'Finished all processing jobs at: {now()}')
-  except Exception as err:
-    print(err)
-  finally:
-    del grounding_dino_model
-    del sam_predictor
-    del sam
-    attempt_gpu_cleanup()
-    if torch.cuda.is_available() and SHOW_MEMORY_SUMMARY:
-      print(torch.cuda.memory_summary())
-    if had_error:
-      print('Warning: at least one file could not be processed. Check for errors!')
+  # Machine learning libraries take seconds to import, so they're only imported once there's work to do
+  print(f'{now()}: Importing libraries ...')
+  import torch
+
+  from ezsam.lib.gpu import attempt_gpu_cleanup
+  from ezsam.cli.loader import get_device, load_models
+  from ezsam.cli.cache import EmbeddingCache, ResultCache
+  from ezsam.cli.detector import text_encoder_stats
+  from ezsam.cli.process import process_files
+  from ezsam.cli.workers import process_jobs_in_workers
+  from ezsam.cli.chunks import join_chunked_videos, plan_jobs
+  from ezsam.cli.precision import check_precision
+  from ezsam.cli.report import timer, write_report
+
+  process_file_args = {
+    'prompts': prompts,
+    'neg_prompts': neg_prompts,
+    'box_threshold': BOX_THRESHOLD,
+    'text_threshold': TEXT_THRESHOLD,
+    'nms_threshold': NMS_THRESHOLD,
+    'img_fmt': IMG_FMT,
+    'codec': CODEC,
+    'num_test_frames': NUM_TEST_FRAMES,
+    'output_suffix': OUTPUT_SUFFIX,
+    'output_dir': OUTPUT_DIR,
+    'debug': DEBUG,
+    'cleanup': CLEANUP,
+    'single_pass': SINGLE_PASS,
+    'temp_files': TEMP_FILES,
+    'queue_depth': QUEUE_DEPTH,
+    'keyframe_interval': KEYFRAME_INTERVAL,
+    'scene_threshold': SCENE_THRESHOLD,
+    'max_propagation': MAX_PROPAGATION,
+    'propagation_motion': PROPAGATION_MOTION,
+    'propagation_edge_error': PROPAGATION_EDGE_ERROR,
+    'result_cache': None,
+    'gd_batch_size': GD_BATCH_SIZE,
+    'resume': RESUME,
+    'checkpoint_frames': CHECKPOINT_FRAMES,
+    'max_side': MAX_SIDE,
+    'sam_crop': SAM_CROP,
+    'tile_size': TILE_SIZE,
+    'tile_overlap': TILE_OVERLAP,
+  }
+  # Masks depend on the exact checkpoints used, not just the model type
+  checkpoints = [os.path.abspath(sam_checkpoint_path), os.path.abspath(gd_checkpoint_path), GD_CONFIG_PATH]
+  # ... and on the precision and runtime they run with
+  precision_id = [] if PRECISION == Precision.fp32 else [PRECISION.value]
+  backend_id = [] if SAM_BACKEND == SamBackend.torch else [SAM_BACKEND.value]
+  process_file_args['model_id'] = ':'.join([model_name] + checkpoints + precision_id + backend_id)
+  if RESULT_CACHE:
+    process_file_args['result_cache'] = ResultCache(model_id=process_file_args['model_id'], max_mb=RESULT_CACHE_SIZE)
+  DEVICE = get_device()
+  print(f'Running on: {DEVICE}')
+  model_args = {
+    'gd_config_path': GD_CONFIG_PATH,
+    'gd_checkpoint_path': gd_checkpoint_path,
+    'sam_model': SAM_MODEL,
+    'sam_checkpoint_path': sam_checkpoint_path,
+    'device': DEVICE,
+    'embedding_cache': None,
+    'precision': PRECISION,
+    'sam_backend': SAM_BACKEND,
+  }
+  if EMBEDDING_CACHE:
+    model_id = ':'.join([model_name, os.path.abspath(sam_checkpoint_path)] + precision_id + backend_id)
+    model_args['embedding_cache'] = EmbeddingCache(model_id=model_id, max_mb=EMBEDDING_CACHE_SIZE)
+
+  if CHECK_PRECISION:
+    # Embeddings or results cached at one precision must not be reused for the other
+    check_model_args = {k: v for k, v in model_args.items() if k not in ['embedding_cache', 'precision']}
+    segment_args = {
+      k: process_file_args[k]
+      for k in ['prompts', 'neg_prompts', 'box_threshold', 'text_threshold', 'nms_threshold', 'single_pass', 'sam_crop']
+    }
+    return check_precision(srcs=INPUT, model_args=check_model_args, segment_args=segment_args, precision=PRECISION)
+
+  errors: list[tuple[str, str]] = []
+  if (WORKERS > 1 or VIDEO_CHUNKS > 1) and model_cache is not None:
+    print('Warning: --workers and --video_chunks are ignored by the ezsam server, files are processed one at a time')
+  if model_cache is None and (VIDEO_CHUNKS > 1 or (WORKERS > 1 and len(INPUT) > 1)):
+    jobs, chunked = plan_jobs(srcs=INPUT, process_file_args=process_file_args, chunks=VIDEO_CHUNKS)
+    # Each video chunk gets its own worker process by default
+    workers = min(len(jobs), max(WORKERS, VIDEO_CHUNKS))
+    if DEVICE.type == 'cuda' and workers > 1:
+      print(f'Warning: each of the {workers} workers loads its own copy of the models into GPU memory')
+    # Includes the time workers take to load models
+    timer.reset()
+    errors = process_jobs_in_workers(jobs=jobs, model_args=model_args, workers=workers)
+    errors = join_chunked_videos(chunked=chunked, errors=errors, cleanup=CLEANUP, resume=RESUME)
+    print(f'Finished all processing jobs at: {now()}')
+  else:
+    grounding_dino_model = None
+    sam = None
+    sam_predictor = None
+    try:
+      # Only running inference, not training models, so disable gradient calculation to reduce memory usage
+      # ref: https://pytorch.org/docs/stable/generated/torch.no_grad.html
+      with torch.no_grad():
+        if model_cache is not None:
+          grounding_dino_model, sam, sam_predictor = model_cache.get(**model_args)
+        else:
+          attempt_gpu_cleanup()
+          grounding_dino_model, sam, sam_predictor = load_models(**model_args)
+        timer.reset()
+        errors = process_files(
+          srcs=INPUT, sam_predictor=sam_predictor, grounding_dino_model=grounding_dino_model, **process_file_args
+        )
+        print(f'Finished all processing jobs at: {now()}')
+        print(sam_predictor.stats())
+        if text_stats := text_encoder_stats(grounding_dino_model):
+          print(text_stats)
+    except Exception as err:
+      print(err)
+    finally:
+      del grounding_dino_model
+      del sam_predictor
+      del sam
+      if model_cache is None:
+        attempt_gpu_cleanup()
+      if torch.cuda.is_available() and SHOW_MEMORY_SUMMARY:
+        print(torch.cuda.memory_summary())
+  print(timer.stats())
+  if REPORT:
+    report = {**timer.summary(), 'files': len(INPUT), 'errors': len(errors), 'device': DEVICE.type}
+    write_report(REPORT, report)
+  if len(errors) > 0:
+    print(f'Warning: {len(errors)} of {len(INPUT)} files could not be processed:')
+    for src, err in errors:
+      print(f'  {src}: {err}')
+  return errors
 
 
 if __name__ == '__main__':
@@ -0,0 +1,267 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# On-disk caches of processing results and SAM image embeddings.
+#
+# Foreground supermasks are stored keyed by a hash of the image contents, the models used, and every option that
+#  affects the mask, so that processing the same image (or an identical video frame) again skips model inference.
+# Masks are stored bit-packed and compressed.
+# SAM image embeddings don't depend on the prompts at all, so they are stored keyed by image contents and SAM model
+#  only, and reused when trying out different prompts on the same images. Embeddings are stored as .npy files which
+#  are memory-mapped when loaded.
+# In both caches, the least recently used entries are deleted once the cache grows past its size limit.
+#
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+from ezsam.lib.date import now
+from ezsam.lib.hash import image_hash
+from ezsam.cli.config.defaults import (
+  DEFAULT_CACHE_FOLDER_LOCATION,
+  DEFAULT_RESULT_CACHE_SIZE_MB,
+  DEFAULT_EMBEDDING_CACHE_SIZE_MB,
+)
+
+DEFAULT_RESULT_CACHE_FOLDER = f'{DEFAULT_CACHE_FOLDER_LOCATION}/results'
+DEFAULT_EMBEDDING_CACHE_FOLDER = f'{DEFAULT_CACHE_FOLDER_LOCATION}/embeddings'
+# Evict down to this fraction of the size limit, so that a full cache isn't scanned again on every write
+EVICT_TO = 0.9
+
+
+def entry_paths(folder: str) -> list[str]:
+  """
+  Cache entries are files or folders, spread over subfolders of the cache folder named after their key's first
+   characters, i.e. folder/ab/abcdef.npz
+  """
+  paths = []
+  if not os.path.isdir(folder):
+    return paths
+  for sub in os.scandir(folder):
+    if sub.is_dir():
+      paths.extend(entry.path for entry in os.scandir(sub.path) if not entry.name.endswith('.tmp'))
+  return paths
+
+
+def entry_size(path: str) -> int:
+  if not os.path.isdir(path):
+    return os.path.getsize(path)
+  return sum(entry.stat().st_size for entry in os.scandir(path))
+
+
+def remove_entry(path: str) -> None:
+  if os.path.isdir(path):
+    shutil.rmtree(path, ignore_errors=True)
+  else:
+    os.remove(path)
+
+
+def evict_lru(folder: str, max_bytes: int) -> int:
+  """
+  If the entries in folder total more than max_bytes, delete the least recently used ones until they total at most
+   EVICT_TO * max_bytes.
+
+  Returns:
+    int: Total size of the remaining entries in bytes.
+  """
+  entries = []
+  for path in entry_paths(folder):
+    try:
+      entries.append((os.stat(path).st_mtime, entry_size(path), path))
+    except OSError:
+      # Deleted by another process in the meantime
+      pass
+  total = sum(size for _, size, _ in entries)
+  if total <= max_bytes:
+    return total
+  print(f'{now()}: Cache at {folder} is over {max_bytes // 2**20} MB, deleting least recently used entries ...')
+  for _, size, path in sorted(entries):
+    if total <= max_bytes * EVICT_TO:
+      break
+    try:
+      remove_entry(path)
+    except OSError:
+      pass
+    total -= size
+  return total
+
+
+class ResultCache:
+  """
+  Cache of foreground supermasks from process.supermask_for_image().
+
+  model_id (str): Identifies the models used, i.e. the SAM model name and the checkpoint files.
+  folder (str): Folder to store cached results in.
+  max_mb (int): Maximum size of the cache folder in megabytes.
+  """
+
+  def __init__(
+    self, model_id: str, folder: str = DEFAULT_RESULT_CACHE_FOLDER, max_mb: int = DEFAULT_RESULT_CACHE_SIZE_MB
+  ):
+    self.model_id = model_id
+    self.folder = folder
+    self.max_bytes = max_mb * 2**20
+    # Total size of the cache folder, counted on first write
+    self.size: int | None = None
+    self.hits = 0
+    self.misses = 0
+
+  def key(self, image: np.ndarray, **options) -> str:
+    """
+    image (np.ndarray): Image the supermask is for.
+    options: Prompts, thresholds, and any other options that affect the supermask.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(image_hash(image).encode())
+    h.update(json.dumps({'model_id': self.model_id, **options}, sort_keys=True).encode())
+    return h.hexdigest()
+
+  def path(self, key: str) -> str:
+    # Spread entries over subfolders so that no single folder gets huge
+    return f'{self.folder}/{key[:2]}/{key}.npz'
+
+  def get(self, key: str) -> tuple[bool, np.ndarray | None]:
+    """
+    Returns:
+      bool: Whether there was a cached result.
+      np.ndarray | None: Cached supermask, which is None if nothing was detected in the image.
+    """
+    path = self.path(key)
+    try:
+      with np.load(path) as data:
+        shape = tuple(data['shape'])
+        supermask = None
+        if data['found']:
+          supermask = np.unpackbits(data['bits'], count=int(np.prod(shape))).reshape(shape).astype(bool)
+      # Mark as recently used
+      os.utime(path)
+    except (OSError, KeyError, ValueError):
+      self.misses += 1
+      return False, None
+    self.hits += 1
+    return True, supermask
+
+  def put(self, key: str, supermask: np.ndarray | None) -> None:
+    path = self.path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    found = supermask is not None
+    shape = supermask.shape if found else ()
+    bits = np.packbits(supermask) if found else np.empty(0, np.uint8)
+    # Write to a temporary file first so that readers never see a partial entry
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+      np.savez_compressed(f, found=found, shape=np.array(shape, dtype=np.int64), bits=bits)
+    os.replace(tmp, path)
+    if self.size is None:
+      self.size = evict_lru(self.folder, self.max_bytes)
+    else:
+      self.size += os.path.getsize(path)
+      if self.size > self.max_bytes:
+        self.size = evict_lru(self.folder, self.max_bytes)
+
+  def stats(self) -> str:
+    return f'Result cache hits: {self.hits}, misses: {self.misses}'
+
+
+class EmbeddingCache:
+  """
+  Cache of SAM image embeddings, i.e. a SamPredictor's features and intermediate features after set_image().
+
+  model_id (str): Identifies the SAM model used, i.e. the SAM model name and checkpoint file.
+  folder (str): Folder to store cached embeddings in.
+  max_mb (int): Maximum size of the cache folder in megabytes.
+  """
+
+  def __init__(
+    self, model_id: str, folder: str = DEFAULT_EMBEDDING_CACHE_FOLDER, max_mb: int = DEFAULT_EMBEDDING_CACHE_SIZE_MB
+  ):
+    self.model_id = model_id
+    self.folder = folder
+    self.max_bytes = max_mb * 2**20
+    # Total size of the cache folder, counted on first write
+    self.size: int | None = None
+    self.hits = 0
+    self.misses = 0
+
+  def key(self, image_key: str, input_size: int) -> str:
+    """
+    image_key (str): Identifies the image contents and color format.
+    input_size (int): Size of the longest side of images input to the SAM image encoder.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps([self.model_id, image_key, input_size]).encode())
+    return h.hexdigest()
+
+  def path(self, key: str) -> str:
+    return f'{self.folder}/{key[:2]}/{key}'
+
+  def load(self, key: str, predictor) -> bool:
+    """
+    Set the predictor's image embedding from the cache, as if set_image() had been called.
+
+    predictor (samhq.SamPredictor): The predictor to set the embedding for.
+
+    Returns:
+      bool: Whether there was a cached embedding.
+    """
+    path = self.path(key)
+    try:
+      with open(f'{path}/meta.json', 'r') as f:
+        meta = json.load(f)
+      device = predictor.device
+      # Copy-on-write memory map, so only the parts of the file that are used get read, without a read-only warning
+      features = torch.from_numpy(np.load(f'{path}/features.npy', mmap_mode='c')).to(device)
+      interm_features = [torch.from_numpy(np.load(f'{path}/interm.0.npy', mmap_mode='c')).to(device)]
+      # Mark as recently used
+      os.utime(path)
+    except (OSError, KeyError, ValueError):
+      self.misses += 1
+      return False
+    predictor.reset_image()
+    predictor.original_size = tuple(meta['original_size'])
+    predictor.input_size = tuple(meta['input_size'])
+    predictor.features = features
+    predictor.interm_features = interm_features
+    predictor.is_image_set = True
+    self.hits += 1
+    return True
+
+  def save(self, key: str, predictor) -> None:
+    """
+    Store the predictor's current image embedding.
+    """
+    path = self.path(key)
+    if os.path.isdir(path):
+      return
+    # Write to a temporary folder first so that readers never see a partial entry
+    tmp = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(tmp, exist_ok=True)
+    np.save(f'{tmp}/features.npy', predictor.features.cpu().numpy())
+    # The SAM-HQ mask decoder only uses the first of the intermediate ViT embeddings, the others are a few times the
+    #  size of the image embedding and not worth keeping
+    np.save(f'{tmp}/interm.0.npy', predictor.interm_features[0].cpu().numpy())
+    meta = {
+      'original_size': list(predictor.original_size),
+      'input_size': list(predictor.input_size),
+    }
+    with open(f'{tmp}/meta.json', 'w') as f:
+      json.dump(meta, f)
+    try:
+      os.rename(tmp, path)
+    except OSError:
+      # Another process saved the same embedding in the meantime
+      shutil.rmtree(tmp, ignore_errors=True)
+      return
+    if self.size is None:
+      self.size = evict_lru(self.folder, self.max_bytes)
+    else:
+      self.size += entry_size(path)
+      if self.size > self.max_bytes:
+        self.size = evict_lru(self.folder, self.max_bytes)
+
+  def stats(self) -> str:
+    return f'Embedding cache hits: {self.hits}, misses: {self.misses}'
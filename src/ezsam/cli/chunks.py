@@ -0,0 +1,136 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Process one long video in parallel by splitting it into chunks of frames.
+#
+# Each chunk is a range of frames, which a worker process seeks to and processes on its own, writing a segment video
+#  with the same codec and frame rate as the full output would have. Once all the chunks are done, the segments are
+#  joined into the output video without re-encoding, using FFmpeg's concat demuxer.
+#
+
+import os
+
+import supervision as sv
+
+from ezsam.lib.file import InputMode, get_input_mode
+from ezsam.cli.process import get_output_path
+from ezsam.cli.resume import get_manifest_path, remove_files
+from ezsam.cli.video import UNJOINABLE_CODECS, concat_segments
+
+
+def split_frame_range(start: int, end: int, chunks: int) -> list[tuple[int, int]]:
+  """
+  Split frames from start up to but not including end into at most chunks ranges of nearly equal length.
+  """
+  length = end - start
+  bounds = [start + length * i // chunks for i in range(chunks + 1)]
+  return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+
+def get_segment_path(out: str, i: int) -> str:
+  base, ext = os.path.splitext(out)
+  return f'{base}.part{i:03d}{ext}'
+
+
+class ChunkedVideo:
+  """
+  Output video for an input video processed in chunks, and the segment videos the chunks are written to.
+  """
+
+  def __init__(self, src: str, out: str, segments: list[str]):
+    self.src = src
+    self.out = out
+    self.segments = segments
+
+  def join(self, cleanup: bool) -> None:
+    try:
+      concat_segments(self.segments, self.out)
+    finally:
+      if cleanup:
+        self.remove_segments()
+
+  def remove_segments(self) -> None:
+    # Including the manifests of chunks processed with --resume
+    remove_files(self.segments + [get_manifest_path(segment) for segment in self.segments])
+
+
+def plan_jobs(srcs: list[str], process_file_args: dict, chunks: int) -> tuple[list[dict], list[ChunkedVideo]]:
+  """
+  Make a job for each input file, or for each chunk of an input video.
+
+  srcs (list[str]): Input files to process.
+  process_file_args (dict): Arguments to process.process_file(), except src and the models.
+  chunks (int): Number of chunks to split each video into.
+
+  Returns:
+    list[dict]: Arguments to process.process_file() for each job, except the models.
+    list[ChunkedVideo]: Videos to join once all the jobs are done.
+  """
+  jobs = []
+  chunked = []
+  for src in srcs:
+    ranges = []
+    try:
+      if chunks > 1 and get_input_mode(src) == InputMode.video:
+        codec = process_file_args['codec']
+        if codec in UNJOINABLE_CODECS:
+          print(f'Warning: Can\'t join video chunks for codec {codec}, processing {src} without splitting it')
+        else:
+          total = sv.VideoInfo.from_video_path(video_path=src).total_frames
+          num_test_frames = process_file_args['num_test_frames']
+          ranges = split_frame_range(0, min(total, num_test_frames or total), chunks)
+    except Exception as err:
+      # Let the job for the whole file report the error
+      print(f'Warning: Could not split {src} into chunks: {err}')
+    if len(ranges) <= 1:
+      jobs.append({**process_file_args, 'src': src})
+      continue
+    out = get_output_path(
+      src=src,
+      input_mode=InputMode.video,
+      img_fmt=process_file_args['img_fmt'],
+      codec=process_file_args['codec'],
+      output_suffix=process_file_args['output_suffix'],
+      output_dir=process_file_args['output_dir'],
+      debug=process_file_args['debug'],
+    )
+    segments = [get_segment_path(out, i) for i in range(len(ranges))]
+    for i, (start, end) in enumerate(ranges):
+      # The frame count in a video's header can be an estimate, so the last chunk reads on until decoding stops,
+      #  rather than up to that count. See video.read_video_frames().
+      if i == len(ranges) - 1 and process_file_args['num_test_frames'] is None:
+        end = None
+      job = {**process_file_args, 'src': src, 'start_frame': start, 'end_frame': end, 'out': segments[i]}
+      job['num_test_frames'] = None
+      jobs.append(job)
+    chunked.append(ChunkedVideo(src=src, out=out, segments=segments))
+    print(f'Splitting video {src} into {len(ranges)} chunks: {ranges}')
+  return jobs, chunked
+
+
+def join_chunked_videos(
+  chunked: list[ChunkedVideo], errors: list[tuple[str, str]], cleanup: bool, resume: bool = False
+) -> list[tuple[str, str]]:
+  """
+  Join the segments of each chunked video whose chunks were all processed.
+
+  errors (list[tuple[str, str]]): Input file and error message for each job that failed.
+  resume (bool): Keep the segments of videos with failed chunks, so that finished chunks aren't processed again.
+
+  Returns:
+    list[tuple[str, str]]: Input file and error message for each file that could not be processed,
+     with one entry per input file.
+  """
+  failed = {}
+  for src, err in errors:
+    failed.setdefault(src, err)
+  for video in chunked:
+    if video.src in failed:
+      if cleanup and not resume:
+        video.remove_segments()
+      continue
+    try:
+      video.join(cleanup=cleanup)
+    except Exception as err:
+      print(f'Error joining video segments for {video.src}: {err}')
+      failed[video.src] = f'{err}'
+  return list(failed.items())
@@ -0,0 +1,40 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Incremental joining of SAM masks into the foreground supermask.
+#
+# Masks for each batch of detection boxes are joined into a single full size mask as soon as SAM produces them, so the
+#  masks for all of an image's boxes are never held in memory at once. For large images with many boxes, that stack
+#  of masks would otherwise take up the image's size in bytes for every box.
+#
+
+import numpy as np
+
+
+class SupermaskBuilder:
+  """
+  Builds the foreground supermask of an image from the masks of positive prompts, minus those of negative prompts.
+  Masks are joined in place, without temporary full size arrays. All masks for positive prompts must be added before
+   any masks for negative prompts are subtracted.
+  """
+
+  def __init__(self, shape_hw: tuple[int, int]):
+    self.mask = np.zeros(shape_hw, dtype=bool)
+
+  def region(self, mask: np.ndarray, offset: tuple[int, int]) -> np.ndarray:
+    x, y = offset
+    h, w = mask.shape
+    return self.mask[y : y + h, x : x + w]
+
+  def add(self, mask: np.ndarray, offset: tuple[int, int] = (0, 0)) -> None:
+    """
+    mask (np.ndarray): Boolean mask of H pixels * W pixels, i.e. for the whole image or a crop of it.
+    offset (tuple[int, int]): Position (x, y) of the mask's top left corner in the image, i.e. for a crop.
+    """
+    region = self.region(mask, offset)
+    np.logical_or(region, mask, out=region)
+
+  def subtract(self, mask: np.ndarray, offset: tuple[int, int] = (0, 0)) -> None:
+    """
+    Same as add(), but removes the mask from the supermask.
+    """
+    np.copyto(self.region(mask, offset), False, where=mask)
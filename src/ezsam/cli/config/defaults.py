@@ -13,3 +13,22 @@ DEFAULT_TEXT_THRESHOLD = 0.3
 DEFAULT_NMS_THRESHOLD = 0.8
 DEFAULT_IMAGE_FORMAT = OutputImageFormat.png.value
 DEFAULT_VIDEO_CODEC = OutputVideoCodec.vp9.value
+DEFAULT_SAM_BATCH_SIZE = 16
+DEFAULT_QUEUE_DEPTH = 4
+DEFAULT_KEYFRAME_INTERVAL = 1
+DEFAULT_SCENE_THRESHOLD = 0.1
+DEFAULT_MAX_PROPAGATION = 0
+DEFAULT_PROPAGATION_MOTION = 2.0
+DEFAULT_PROPAGATION_EDGE_ERROR = 0.1
+DEFAULT_WORKERS = 1
+DEFAULT_SERVER_PORT = 47615
+DEFAULT_SERVER_MAX_MODELS = 2
+DEFAULT_RESULT_CACHE_SIZE_MB = 1024
+DEFAULT_EMBEDDING_CACHE_SIZE_MB = 10240
+DEFAULT_GD_BATCH_SIZE = 4
+DEFAULT_VIDEO_CHUNKS = 1
+DEFAULT_CHECKPOINT_FRAMES = 250
+DEFAULT_SAM_CROP = 'off'
+DEFAULT_TILE_OVERLAP = 0.2
+DEFAULT_PRECISION = 'fp32'
+DEFAULT_SAM_BACKEND = 'torch'
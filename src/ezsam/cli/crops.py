@@ -0,0 +1,112 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# SAM segmentation on crops around detected objects.
+#
+# SAM's image encoder always works on the image resized to 1024 pixels on its longest side. When the detected objects
+#  only cover a small part of a large image, most of the encoder's work goes into the background, and small objects
+#  lose detail in the resize. In crop mode, detection boxes are padded and overlapping boxes are merged into clusters,
+#  then SAM encodes and segments each cluster's crop of the image on its own, and the crop masks are pasted back into
+#  full size masks.
+# Each crop costs a run of the image encoder, so in auto mode crops are only used when they're few and cover a small
+#  part of an image that SAM would otherwise downscale.
+#
+
+import functools
+from typing import Callable
+
+import numpy as np
+
+from ezsam.cli.predictor import predict_masks_for_boxes
+
+# Padding added around each box, as a fraction of the box's longest side, so SAM sees some context around objects
+CROP_PADDING = 0.2
+# Minimum padding around each box in pixels
+CROP_MIN_PADDING = 16
+# In auto mode, maximum fraction of the image that crops may cover in total
+CROP_MAX_COVERAGE = 0.25
+# In auto mode, maximum number of crops, i.e. image encoder runs, per image
+CROP_MAX_CLUSTERS = 4
+
+
+def pad_boxes(xyxy: np.ndarray, shape_hw: tuple[int, int]) -> np.ndarray:
+  """
+  Returns boxes grown by the crop padding on each side, clipped to the image and rounded out to whole pixels.
+  """
+  h, w = shape_hw
+  sides = np.maximum(xyxy[:, 2] - xyxy[:, 0], xyxy[:, 3] - xyxy[:, 1])
+  pad = np.maximum(sides * CROP_PADDING, CROP_MIN_PADDING)[:, None]
+  padded = np.concatenate([np.floor(xyxy[:, :2] - pad), np.ceil(xyxy[:, 2:] + pad)], axis=1)
+  return np.clip(padded, 0, [w, h, w, h]).astype(int)
+
+
+def cluster_boxes(xyxy: np.ndarray, shape_hw: tuple[int, int]) -> list[tuple[np.ndarray, list[int]]]:
+  """
+  Group detection boxes whose padded boxes overlap, merging them until no two clusters overlap.
+
+  Returns:
+    list[tuple[np.ndarray, list[int]]]: Crop box (x0, y0, x1, y1) of each cluster, and the indices of its boxes.
+  """
+  clusters = [(box, [i]) for i, box in enumerate(pad_boxes(xyxy, shape_hw))]
+  merged = True
+  while merged:
+    merged = False
+    for a in range(len(clusters)):
+      for b in range(a + 1, len(clusters)):
+        box_a, indices_a = clusters[a]
+        box_b, indices_b = clusters[b]
+        if box_a[0] < box_b[2] and box_b[0] < box_a[2] and box_a[1] < box_b[3] and box_b[1] < box_a[3]:
+          box = np.concatenate([np.minimum(box_a[:2], box_b[:2]), np.maximum(box_a[2:], box_b[2:])])
+          clusters[a] = (box, indices_a + indices_b)
+          del clusters[b]
+          merged = True
+          break
+      if merged:
+        break
+  return clusters
+
+
+def crops_worthwhile(
+  clusters: list[tuple[np.ndarray, list[int]]], shape_hw: tuple[int, int], target_length: int
+) -> bool:
+  """
+  Heuristic for auto mode: whether segmenting crops is likely to be faster or more detailed than the whole image.
+
+  target_length (int): Longest side SAM resizes images to, i.e. 1024.
+  """
+  h, w = shape_hw
+  if max(h, w) <= target_length or len(clusters) > CROP_MAX_CLUSTERS:
+    return False
+  coverage = sum((box[2] - box[0]) * (box[3] - box[1]) for box, _ in clusters) / (h * w)
+  return coverage <= CROP_MAX_COVERAGE
+
+
+def segment_crops(
+  sam_predictor,  #: samhq.SamPredictor,
+  image: np.ndarray,
+  xyxy: np.ndarray,
+  clusters: list[tuple[np.ndarray, list[int]]],
+  join: Callable[..., None] | None = None,
+) -> np.ndarray | None:
+  """
+  Segment each cluster of boxes on its own crop of a BGR image.
+
+  join (Callable | None): If given, called with the masks for each crop and the crop's offset, i.e.
+   SupermaskBuilder.add(), instead of returning full size masks for all the boxes.
+
+  Returns:
+    np.ndarray | None: Array of n masks * H pixels * W pixels for the whole image, where n is the number of boxes.
+     None if join is given.
+  """
+  h, w = image.shape[:2]
+  masks = np.zeros((len(xyxy), h, w), dtype=bool) if join is None else None
+  for (x0, y0, x1, y1), indices in clusters:
+    crop = np.ascontiguousarray(image[y0:y1, x0:x1])
+    sam_predictor.set_image(crop, 'BGR')
+    crop_xyxy = xyxy[indices] - np.array([x0, y0, x0, y0], dtype=xyxy.dtype)
+    if join is not None:
+      predict_masks_for_boxes(
+        sam_predictor=sam_predictor, xyxy=crop_xyxy, join=functools.partial(join, offset=(int(x0), int(y0)))
+      )
+    else:
+      masks[indices, y0:y1, x0:x1] = predict_masks_for_boxes(sam_predictor=sam_predictor, xyxy=crop_xyxy)
+  return masks
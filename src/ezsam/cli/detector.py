@@ -0,0 +1,191 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Helpers around the GroundingDINO object detection model.
+#
+# GroundingDINO encodes the text prompt caption with a BERT text encoder on every call, even though the same prompts
+#  are used for every image and video frame in a job. The text encoder is wrapped with a small memo keyed by the
+#  tokenized caption, so that it only runs once for each distinct caption.
+# GroundingDINO's inference API also only takes one image at a time, so there's a batched version of
+#  predict_with_classes() that sends several images through the model together.
+#
+
+import bisect
+import hashlib
+import inspect
+from collections import OrderedDict
+
+import numpy as np
+import supervision as sv
+import torch
+
+import groundingdino.util.inference as gd
+from groundingdino.util.utils import get_phrases_from_posmap
+
+# Number of distinct captions to keep text encoder outputs for, i.e. positive and negative prompts
+TEXT_MEMO_SIZE = 8
+# Whether the installed GroundingDINO's predict_with_classes() only matches phrases between the separators around the
+#  best matching token (predict(remove_combined=True)). rf-groundingdino 0.1.2 matches phrases over the whole caption,
+#  and its get_phrases_from_posmap() doesn't take the token range to match. Versions from 0.2.0 do both.
+PHRASES_BETWEEN_SEPARATORS = 'remove_combined' in inspect.signature(gd.predict).parameters
+
+
+class TextEncoderMemo(torch.nn.Module):
+  """
+  Wraps GroundingDINO's text encoder (model.bert), returning the previous output for identical tokenized input
+   instead of running the encoder again.
+  """
+
+  def __init__(self, text_encoder: torch.nn.Module, max_size: int = TEXT_MEMO_SIZE):
+    super().__init__()
+    self.text_encoder = text_encoder
+    self.max_size = max_size
+    self.memo = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    # Match the wrapped encoder, i.e. eval mode for inference
+    self.train(text_encoder.training)
+
+  def key(self, **inputs: torch.Tensor) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for name in sorted(inputs):
+      value = inputs[name]
+      if isinstance(value, torch.Tensor):
+        h.update(f'{name}{tuple(value.shape)}{value.dtype}'.encode())
+        h.update(value.detach().cpu().numpy().tobytes())
+      else:
+        h.update(f'{name}{value!r}'.encode())
+    return h.hexdigest()
+
+  def forward(self, **inputs):
+    if self.training or torch.is_grad_enabled():
+      # Outputs are only safe to share when nothing will backpropagate through them
+      return self.text_encoder(**inputs)
+    key = self.key(**inputs)
+    if key in self.memo:
+      self.hits += 1
+      self.memo.move_to_end(key)
+      return self.memo[key]
+    self.misses += 1
+    output = self.text_encoder(**inputs)
+    self.memo[key] = output
+    if len(self.memo) > self.max_size:
+      self.memo.popitem(last=False)
+    return output
+
+  def stats(self) -> str:
+    return f'GroundingDINO text encoder runs: {self.misses}, saved by text embedding memo: {self.hits}'
+
+
+def memoize_text_encoder(grounding_dino_model) -> TextEncoderMemo:
+  """
+  Wrap the text encoder of a GroundingDINO model (groundingdino.util.inference.Model) with a TextEncoderMemo.
+  """
+  model = grounding_dino_model.model
+  if not isinstance(model.bert, TextEncoderMemo):
+    model.bert = TextEncoderMemo(model.bert)
+  return model.bert
+
+
+def text_encoder_stats(grounding_dino_model) -> str | None:
+  bert = getattr(getattr(grounding_dino_model, 'model', None), 'bert', None)
+  return bert.stats() if isinstance(bert, TextEncoderMemo) else None
+
+
+def detections_from_outputs(
+  grounding_dino_model: gd.Model,
+  logits: torch.Tensor,
+  boxes: torch.Tensor,
+  caption: str,
+  classes: list[str],
+  box_threshold: float,
+  text_threshold: float,
+  source_hw: tuple[int, int],
+) -> sv.Detections:
+  """
+  Same post processing as gd.Model.predict_with_classes() in the installed GroundingDINO version, for one image's
+   model outputs.
+
+  logits (torch.Tensor): Sigmoid of the model's pred_logits for the image, on the CPU.
+  boxes (torch.Tensor): The model's pred_boxes for the image, on the CPU.
+  """
+  mask = logits.max(dim=1)[0] > box_threshold
+  logits = logits[mask]
+  boxes = boxes[mask]
+  tokenizer = grounding_dino_model.model.tokenizer
+  tokenized = tokenizer(caption)
+  if PHRASES_BETWEEN_SEPARATORS:
+    # Only match phrases between separators, i.e. one class each. Same as gd.predict(remove_combined=True)
+    sep_idx = [i for i in range(len(tokenized['input_ids'])) if tokenized['input_ids'][i] in [101, 102, 1012]]
+    phrases = []
+    for logit in logits:
+      insert_idx = bisect.bisect_left(sep_idx, logit.argmax())
+      right_idx = sep_idx[insert_idx]
+      left_idx = sep_idx[insert_idx - 1]
+      phrase = get_phrases_from_posmap(logit > text_threshold, tokenized, tokenizer, left_idx, right_idx)
+      phrases.append(phrase.replace('.', ''))
+  else:
+    phrases = [
+      get_phrases_from_posmap(logit > text_threshold, tokenized, tokenizer).replace('.', '') for logit in logits
+    ]
+  source_h, source_w = source_hw
+  detections = gd.Model.post_process_result(
+    source_h=source_h, source_w=source_w, boxes=boxes, logits=logits.max(dim=1)[0]
+  )
+  detections.class_id = gd.Model.phrases2classes(phrases=phrases, classes=classes)
+  return detections
+
+
+def predict_with_classes_batch(
+  grounding_dino_model: gd.Model,
+  images: list[np.ndarray],
+  classes: list[str],
+  box_threshold: float,
+  text_threshold: float,
+  batch_size: int,
+) -> list[sv.Detections]:
+  """
+  Detect objects in several images, same as calling grounding_dino_model.predict_with_classes() for each image,
+   but running up to batch_size images through the model together.
+
+  Only images that have the same size once resized for the model are batched together, so no padding is needed and
+   detections match those for single images. I.e. all frames from a video, or photos from the same camera.
+
+  images (list[np.ndarray]): BGR images.
+
+  Returns:
+    list[sv.Detections]: Detections for each image.
+  """
+  model = getattr(grounding_dino_model, 'model', None)
+  if batch_size <= 1 or len(images) <= 1 or not isinstance(model, torch.nn.Module):
+    return [
+      grounding_dino_model.predict_with_classes(
+        image=image, classes=classes, box_threshold=box_threshold, text_threshold=text_threshold
+      )
+      for image in images
+    ]
+  caption = gd.preprocess_caption(caption='. '.join(classes))
+  tensors = [gd.Model.preprocess_image(image_bgr=image) for image in images]
+  groups: dict[tuple, list[int]] = {}
+  for i, tensor in enumerate(tensors):
+    groups.setdefault(tuple(tensor.shape), []).append(i)
+  results: list[sv.Detections] = [None] * len(images)
+  for indices in groups.values():
+    for start in range(0, len(indices), batch_size):
+      batch_indices = indices[start : start + batch_size]
+      batch = torch.stack([tensors[i] for i in batch_indices]).to(grounding_dino_model.device)
+      with torch.no_grad():
+        outputs = model(batch, captions=[caption] * len(batch_indices))
+      logits = outputs['pred_logits'].cpu().sigmoid()
+      boxes = outputs['pred_boxes'].cpu()
+      for j, i in enumerate(batch_indices):
+        results[i] = detections_from_outputs(
+          grounding_dino_model=grounding_dino_model,
+          logits=logits[j],
+          boxes=boxes[j],
+          caption=caption,
+          classes=classes,
+          box_threshold=box_threshold,
+          text_threshold=text_threshold,
+          source_hw=images[i].shape[:2],
+        )
+  return results
@@ -0,0 +1,63 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Load the GroundingDINO object detection and SAM segmentation models for inference.
+#
+
+import torch
+import groundingdino.util.inference as gd
+
+from ezsam.lib.date import now
+from ezsam.cli.cache import EmbeddingCache
+from ezsam.cli.detector import memoize_text_encoder
+from ezsam.cli.options import Precision, SamBackend
+from ezsam.cli.precision import apply_precision
+from ezsam.cli.predictor import EmbeddingReusePredictor
+
+
+def get_device() -> torch.device:
+  return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def load_models(
+  gd_config_path: str,
+  gd_checkpoint_path: str,
+  sam_model: str,
+  sam_checkpoint_path: str,
+  device: torch.device,
+  embedding_cache: EmbeddingCache | None = None,
+  precision: Precision = Precision.fp32,
+  sam_backend: SamBackend = SamBackend.torch,
+) -> tuple[gd.Model, torch.nn.Module, EmbeddingReusePredictor]:
+  """
+  embedding_cache (EmbeddingCache | None): On-disk cache of SAM image embeddings for the predictor to use.
+  precision (Precision): Numeric precision to run the models at, see precision.py.
+  sam_backend (SamBackend): Runtime for SAM, see onnx_sam.py.
+
+  Returns:
+    gd.Model: GroundingDINO model.
+    torch.nn.Module: SAM or SAM-HQ model.
+    EmbeddingReusePredictor: Predictor for the SAM model.
+  """
+  print(f'{now()}: Loading GroundingDINO model ...')
+  grounding_dino_model = gd.Model(model_config_path=gd_config_path, model_checkpoint_path=gd_checkpoint_path, device=device)
+  # Prompts are the same for every image in a job, so only encode each prompt caption once
+  memoize_text_encoder(grounding_dino_model)
+
+  print(f'{now()}: Loading SAM model and predictor ...')
+  import segment_anything_hq as samhq
+
+  sam = samhq.sam_model_registry[sam_model](checkpoint=sam_checkpoint_path)
+  sam.to(device=device)
+  apply_precision(grounding_dino_model, sam, precision=precision, device=device)
+  if sam_backend == SamBackend.onnx:
+    from ezsam.cli.onnx_sam import load_onnx_predictor
+
+    if device.type != 'cpu' or precision != Precision.fp32:
+      print(f'Warning: the onnx SAM backend always runs SAM at {Precision.fp32.value} on CPU')
+      sam = samhq.sam_model_registry[sam_model](checkpoint=sam_checkpoint_path)
+    predictor = load_onnx_predictor(sam, sam_model=sam_model, sam_checkpoint_path=sam_checkpoint_path)
+  else:
+    predictor = samhq.SamPredictor(sam)
+  # Wrapped to skip recomputing the image embedding when segmenting the same image more than once
+  sam_predictor = EmbeddingReusePredictor(predictor, embedding_cache=embedding_cache)
+  return grounding_dino_model, sam, sam_predictor
@@ -0,0 +1,205 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# ONNX Runtime backend for SAM.
+#
+# On CPU, prompting SAM's small mask decoder once per box on every frame is dominated by Python and PyTorch dispatch
+#  overhead rather than actual compute. With this backend, the SAM image encoder and the prompt encoder plus mask
+#  decoder are exported to ONNX once per checkpoint, cached in the user's cache folder, and run with ONNX Runtime on
+#  the CPU. Predictions are the same as PyTorch's up to floating point differences.
+# Needs the optional onnx and onnxruntime packages.
+#
+
+import hashlib
+import inspect
+import os
+
+import numpy as np
+import torch
+import segment_anything_hq as samhq
+from segment_anything_hq.utils.onnx import SamOnnxModel
+
+from ezsam.lib.date import now
+from ezsam.cli.config.defaults import DEFAULT_CACHE_FOLDER_LOCATION
+
+ONNX_CACHE_FOLDER = f'{DEFAULT_CACHE_FOLDER_LOCATION}/onnx'
+ONNX_OPSET = 17
+
+
+def import_onnxruntime():
+  try:
+    import onnxruntime
+
+    return onnxruntime
+  except ImportError as err:
+    raise ImportError(
+      'The onnx SAM backend needs onnxruntime and onnx, install them with: pip install "ezsam[onnx]"'
+    ) from err
+
+
+class EncoderOnnxModel(torch.nn.Module):
+  """
+  SAM's image encoder, only returning the intermediate embedding that the SAM-HQ mask decoder uses.
+  """
+
+  def __init__(self, sam: torch.nn.Module):
+    super().__init__()
+    self.image_encoder = sam.image_encoder
+
+  def forward(self, image: torch.Tensor):
+    features, interm_features = self.image_encoder(image)
+    return features, interm_features[0]
+
+
+def onnx_export(model: torch.nn.Module, args: tuple, path: str, **kwargs) -> None:
+  # Write to a temporary file first so that an interrupted export is never mistaken for a finished one
+  tmp = f'{path}.{os.getpid()}.tmp'
+  export_args = {'opset_version': ONNX_OPSET, 'do_constant_folding': True, **kwargs}
+  if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+    # The TorchScript based exporter handles SAM's data dependent mask resizing
+    export_args['dynamo'] = False
+  with torch.no_grad():
+    torch.onnx.export(model, args, tmp, **export_args)
+  os.replace(tmp, path)
+
+
+def export_sam(sam: torch.nn.Module, folder: str) -> tuple[str, str]:
+  """
+  Export SAM's image encoder and mask decoder to ONNX files in folder, unless already exported.
+
+  Returns:
+    str: Path to the image encoder model.
+    str: Path to the prompt encoder and mask decoder model.
+  """
+  encoder_path = f'{folder}/encoder.onnx'
+  decoder_path = f'{folder}/decoder.onnx'
+  if os.path.isfile(encoder_path) and os.path.isfile(decoder_path):
+    return encoder_path, decoder_path
+  os.makedirs(folder, exist_ok=True)
+  img_size = sam.image_encoder.img_size
+  image = torch.randn(1, 3, img_size, img_size)
+  encoder = EncoderOnnxModel(sam).eval()
+  print(f'{now()}: Exporting SAM image encoder to {encoder_path}, this only happens once ...')
+  onnx_export(
+    encoder,
+    (image,),
+    encoder_path,
+    input_names=['image'],
+    output_names=['image_embeddings', 'interm_embeddings'],
+  )
+  with torch.no_grad():
+    image_embeddings, interm_embeddings = encoder(image)
+  # Same outputs as SamPredictor.predict_torch(multimask_output=True, hq_token_only=False) for box prompts
+  decoder = SamOnnxModel(sam, hq_token_only=False, multimask_output=True).eval()
+  num_boxes = 2
+  decoder_inputs = {
+    'image_embeddings': image_embeddings,
+    'interm_embeddings': interm_embeddings.unsqueeze(0),
+    'point_coords': torch.randint(0, img_size, (num_boxes, 2, 2), dtype=torch.float),
+    'point_labels': torch.tensor([[2, 3]] * num_boxes, dtype=torch.float),
+    'mask_input': torch.zeros(1, 1, 4 * image_embeddings.shape[2], 4 * image_embeddings.shape[3]),
+    'has_mask_input': torch.tensor([0], dtype=torch.float),
+    'orig_im_size': torch.tensor([img_size, img_size], dtype=torch.float),
+  }
+  print(f'{now()}: Exporting SAM mask decoder to {decoder_path} ...')
+  onnx_export(
+    decoder,
+    tuple(decoder_inputs.values()),
+    decoder_path,
+    input_names=list(decoder_inputs.keys()),
+    output_names=['masks', 'iou_predictions', 'low_res_masks'],
+    dynamic_axes={
+      'point_coords': {0: 'num_boxes'},
+      'point_labels': {0: 'num_boxes'},
+      'masks': {0: 'num_boxes', 2: 'height', 3: 'width'},
+      'iou_predictions': {0: 'num_boxes'},
+      'low_res_masks': {0: 'num_boxes'},
+    },
+  )
+  return encoder_path, decoder_path
+
+
+def get_onnx_folder(sam_model: str, sam_checkpoint_path: str) -> str:
+  """
+  Folder for the ONNX models exported from a SAM checkpoint, which changes if the checkpoint file does.
+  """
+  stat = os.stat(sam_checkpoint_path)
+  model_id = f'{sam_model}:{os.path.abspath(sam_checkpoint_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+  return f'{ONNX_CACHE_FOLDER}/{hashlib.blake2b(model_id.encode(), digest_size=16).hexdigest()}'
+
+
+def create_session(path: str):
+  ort = import_onnxruntime()
+  options = ort.SessionOptions()
+  options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+  options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+  # Use the same share of CPU cores as PyTorch, i.e. when running in worker processes
+  options.intra_op_num_threads = torch.get_num_threads()
+  options.inter_op_num_threads = 1
+  return ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+class OnnxSamPredictor(samhq.SamPredictor):
+  """
+  SamPredictor that runs the image encoder, and the mask decoder for box prompts, with ONNX Runtime.
+  Other prompts fall back to the PyTorch model.
+  """
+
+  def __init__(self, sam_model: torch.nn.Module, encoder_path: str, decoder_path: str):
+    super().__init__(sam_model)
+    self.encoder = create_session(encoder_path)
+    self.decoder = create_session(decoder_path)
+
+  def set_torch_image(self, transformed_image: torch.Tensor, original_image_size: tuple[int, ...]) -> None:
+    self.reset_image()
+    self.original_size = original_image_size
+    self.input_size = tuple(transformed_image.shape[-2:])
+    input_image = self.model.preprocess(transformed_image)
+    features, interm_features = self.encoder.run(None, {'image': input_image.cpu().numpy()})
+    self.features = torch.from_numpy(features).to(self.device)
+    self.interm_features = [torch.from_numpy(interm_features).to(self.device)]
+    self.is_image_set = True
+
+  def predict_torch(
+    self,
+    point_coords: torch.Tensor | None,
+    point_labels: torch.Tensor | None,
+    boxes: torch.Tensor | None = None,
+    mask_input: torch.Tensor | None = None,
+    multimask_output: bool = True,
+    return_logits: bool = False,
+    hq_token_only: bool = False,
+  ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    if point_coords is not None or mask_input is not None or boxes is None or not multimask_output or hq_token_only:
+      return super().predict_torch(
+        point_coords, point_labels, boxes, mask_input, multimask_output, return_logits, hq_token_only
+      )
+    if not self.is_image_set:
+      raise RuntimeError('An image must be set with .set_image(...) before mask prediction.')
+    num_boxes = len(boxes)
+    low_res_size = 4 * self.features.shape[2], 4 * self.features.shape[3]
+    masks, iou_predictions, low_res_masks = self.decoder.run(
+      None,
+      {
+        'image_embeddings': self.features.cpu().numpy(),
+        'interm_embeddings': self.interm_features[0].unsqueeze(0).cpu().numpy(),
+        # Boxes are prompted as their two corners, labelled 2 and 3
+        'point_coords': boxes.reshape(num_boxes, 2, 2).cpu().numpy().astype(np.float32),
+        'point_labels': np.array([[2, 3]] * num_boxes, dtype=np.float32),
+        'mask_input': np.zeros((1, 1, *low_res_size), dtype=np.float32),
+        'has_mask_input': np.zeros(1, dtype=np.float32),
+        'orig_im_size': np.array(self.original_size, dtype=np.float32),
+      },
+    )
+    masks = torch.from_numpy(masks).to(self.device)
+    if not return_logits:
+      masks = masks > self.model.mask_threshold
+    return masks, torch.from_numpy(iou_predictions).to(self.device), torch.from_numpy(low_res_masks).to(self.device)
+
+
+def load_onnx_predictor(sam: torch.nn.Module, sam_model: str, sam_checkpoint_path: str) -> OnnxSamPredictor:
+  """
+  Create an ONNX Runtime predictor for a SAM model loaded on the CPU, exporting it to ONNX first if needed.
+  """
+  import_onnxruntime()
+  encoder_path, decoder_path = export_sam(sam, get_onnx_folder(sam_model, sam_checkpoint_path))
+  return OnnxSamPredictor(sam, encoder_path=encoder_path, decoder_path=decoder_path)
@@ -0,0 +1,24 @@
+# Choices for command line options that select between implementations.
+# Kept free of heavy imports so that arguments are parsed before torch and the models are imported.
+
+from enum import Enum
+
+
+# Segment crops around detected objects, see crops.py
+class SamCropMode(str, Enum):
+  off = 'off'
+  auto = 'auto'
+  on = 'on'
+
+
+# Numeric precision to run the models at, see precision.py
+class Precision(str, Enum):
+  fp32 = 'fp32'
+  bf16 = 'bf16'
+  int8 = 'int8'
+
+
+# Runtime for SAM, see onnx_sam.py
+class SamBackend(str, Enum):
+  torch = 'torch'
+  onnx = 'onnx'
@@ -0,0 +1,117 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Three stage video processing pipeline: decode -> inference -> encode.
+#
+# Frames are decoded in one thread and processed frames are encoded / written in another, so that video decoding and
+#  encoding overlap with model inference, which runs on the calling thread. Stages are connected by bounded queues:
+#  when a queue is full the stage feeding it blocks (backpressure), so at most a fixed number of frames are in memory.
+#
+
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator
+
+# Marks the end of the stream of frames in a queue
+_END = object()
+# Seconds to wait on a full or empty queue before checking whether the pipeline was stopped
+_POLL_INTERVAL = 0.1
+
+
+def run_pipeline(
+  frames: Iterable[Any],
+  process: Callable[[Any], Any],
+  write: Callable[[Any], None],
+  depth: int,
+) -> None:
+  """
+  Run process() on every item from frames, and then write() on each result, keeping the original frame order.
+
+  frames (Iterable): Source of frames to process, i.e. a video frame generator. Iterated on a decode thread.
+  process (Callable): Processes a single frame. Called on the calling thread.
+  write (Callable): Writes a single processed frame. Called on an encode thread.
+  depth (int): Maximum number of frames waiting in each of the queues between stages.
+   If depth is 0 or less, all the stages run one after another in a single loop on the calling thread instead.
+
+  An error in any stage stops all the stages and is raised again from this function once the threads have exited.
+  """
+  if depth <= 0:
+    for frame in frames:
+      write(process(frame))
+    return
+
+  stop = threading.Event()
+  errors: list[BaseException] = []
+  decoded = queue.Queue(maxsize=depth)
+  processed = queue.Queue(maxsize=depth)
+
+  def fail(err: BaseException):
+    errors.append(err)
+    stop.set()
+
+  def put(q: queue.Queue, item) -> bool:
+    # Blocks while the queue is full, returns False if the pipeline is stopped before the item could be queued
+    while not stop.is_set():
+      try:
+        q.put(item, timeout=_POLL_INTERVAL)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def get(q: queue.Queue):
+    # Blocks while the queue is empty, returns _END if the pipeline is stopped
+    while not stop.is_set():
+      try:
+        return q.get(timeout=_POLL_INTERVAL)
+      except queue.Empty:
+        pass
+    return _END
+
+  def decode():
+    try:
+      for frame in frames:
+        if not put(decoded, frame):
+          return
+      put(decoded, _END)
+    except BaseException as err:
+      fail(err)
+
+  def encode():
+    try:
+      while (result := get(processed)) is not _END:
+        write(result)
+    except BaseException as err:
+      fail(err)
+
+  decoder = threading.Thread(target=decode, name='ezsam-decode', daemon=True)
+  encoder = threading.Thread(target=encode, name='ezsam-encode', daemon=True)
+  decoder.start()
+  encoder.start()
+  try:
+    while (frame := get(decoded)) is not _END:
+      if not put(processed, process(frame)):
+        break
+    put(processed, _END)
+  except BaseException as err:
+    fail(err)
+  finally:
+    encoder.join()
+    # Unblock the decoder if it's still waiting on a full queue
+    stop.set()
+    decoder.join()
+  if errors:
+    raise errors[0]
+
+
+def batches(items: Iterable[Any], size: int) -> Iterator[list[Any]]:
+  """
+  Group items into lists of up to size items each, i.e. video frames into batches for object detection.
+  """
+  batch = []
+  for item in items:
+    batch.append(item)
+    if len(batch) >= size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
@@ -0,0 +1,145 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Reduced precision inference, mainly for running on CPUs without a GPU.
+#
+# int8: The Linear layers of SAM and GroundingDINO, which do most of the work in their transformers, are replaced by
+#  dynamically quantized versions, with int8 weights and activations quantized on the fly. CPU only.
+# bf16: SAM's image encoder and GroundingDINO run under bfloat16 autocast, with outputs cast back to float32 so that
+#  post processing works as normal. Needs a CPU with native bf16 support (i.e. AVX512-BF16 or AMX) to be faster.
+#
+# Both trade some mask quality for speed, so there's a check that compares masks against full precision, which also
+#  compares SAM run with the onnx backend against PyTorch.
+#
+
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from ezsam.lib.date import now
+from ezsam.lib.file import InputMode, get_input_mode
+from ezsam.lib.metrics import boundary_f, mask_iou
+from ezsam.cli.options import Precision, SamBackend
+
+
+def to_float32(outputs):
+  """
+  Cast any reduced precision floating point tensors in (possibly nested) model outputs to float32.
+  """
+  if isinstance(outputs, torch.Tensor):
+    return outputs.float() if outputs.is_floating_point() and outputs.dtype != torch.float32 else outputs
+  if isinstance(outputs, dict):
+    return {k: to_float32(v) for k, v in outputs.items()}
+  if isinstance(outputs, (list, tuple)):
+    return type(outputs)(to_float32(v) for v in outputs)
+  return outputs
+
+
+def autocast_forward(module: torch.nn.Module, device_type: str) -> None:
+  """
+  Run a module's forward pass under bfloat16 autocast from now on, returning float32 outputs.
+  """
+  forward = module.forward
+
+  def forward_bf16(*args, **kwargs):
+    with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+      outputs = forward(*args, **kwargs)
+    return to_float32(outputs)
+
+  module.forward = forward_bf16
+
+
+def apply_precision(grounding_dino_model, sam: torch.nn.Module, precision: Precision, device: torch.device) -> None:
+  """
+  Convert loaded models in place for inference at the given precision.
+  """
+  gd_module = getattr(grounding_dino_model, 'model', None)
+  models = [model for model in [gd_module, sam] if isinstance(model, torch.nn.Module)]
+  if precision == Precision.int8:
+    if device.type != 'cpu':
+      print(f'Warning: int8 quantization is only available on CPU, running at full precision on {device}')
+      return
+    print(f'{now()}: Quantizing models to int8 ...')
+    for model in models:
+      torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+  elif precision == Precision.bf16:
+    print(f'{now()}: Running models with bfloat16 autocast ...')
+    if isinstance(gd_module, torch.nn.Module):
+      autocast_forward(gd_module, device.type)
+    # The image encoder does almost all of SAM's work, the prompt encoder and mask decoder are left at full precision
+    autocast_forward(sam.image_encoder, device.type)
+
+
+def check_precision(
+  srcs: list[str],
+  model_args: dict,
+  segment_args: dict,
+  precision: Precision,
+) -> list[tuple[str, str]]:
+  """
+  Compare masks and timings for input images at reduced precision against full precision, and print a report.
+  With the onnx SAM backend, full precision masks are those from SAM run with PyTorch.
+
+  model_args (dict): Arguments to loader.load_models(), except precision.
+  segment_args (dict): Arguments to process.supermask_for_image(), except the image and models.
+
+  Returns:
+    list[tuple[str, str]]: Input file and error message for each file that could not be checked.
+  """
+  from ezsam.cli.loader import load_models
+  from ezsam.cli.process import supermask_for_image
+
+  errors = []
+  images = {}
+  for src in srcs:
+    try:
+      if get_input_mode(src) != InputMode.image:
+        raise ValueError('Only images are checked')
+      image = cv2.imread(src)
+      if image is None:
+        raise ValueError('Could not read image')
+      images[src] = image
+    except Exception as err:
+      print(f'Skipping {src}: {err}')
+      errors.append((src, f'{err}'))
+
+  def run(run_precision: Precision, sam_backend: SamBackend) -> dict[str, tuple[np.ndarray | None, float]]:
+    run_model_args = {**model_args, 'sam_backend': sam_backend}
+    grounding_dino_model, _, sam_predictor = load_models(**run_model_args, precision=run_precision)
+    results = {}
+    with torch.no_grad():
+      for src, image in images.items():
+        start = time.perf_counter()
+        supermask = supermask_for_image(
+          image=image, sam_predictor=sam_predictor, grounding_dino_model=grounding_dino_model, **segment_args
+        )
+        results[src] = (supermask, time.perf_counter() - start)
+    return results
+
+  sam_backend = model_args.get('sam_backend', SamBackend.torch)
+  label = precision.value if sam_backend == SamBackend.torch else f'{sam_backend.value} {precision.value}'
+  print(f'{now()}: Checking {label} against {Precision.fp32.value} on {len(images)} images ...')
+  reference = run(Precision.fp32, SamBackend.torch)
+  reduced = run(precision, sam_backend)
+  ious = []
+  boundary_fs = []
+  print('---------------------')
+  print(f'{"image":40} {"IoU":>6} {"BF":>6} {Precision.fp32.value + " s":>8} {label + " s":>8}')
+  for src in images:
+    mask_ref, time_ref = reference[src]
+    mask, time_reduced = reduced[src]
+    iou = mask_iou(mask_ref, mask)
+    bf = boundary_f(mask_ref, mask)
+    ious.append(iou)
+    boundary_fs.append(bf)
+    print(f'{src:40} {iou:6.3f} {bf:6.3f} {time_ref:8.2f} {time_reduced:8.2f}')
+  if ious:
+    total_ref = sum(t for _, t in reference.values())
+    total_reduced = sum(t for _, t in reduced.values())
+    print(f'Mean IoU: {np.mean(ious):.4f}, min IoU: {np.min(ious):.4f}')
+    print(f'Mean boundary F: {np.mean(boundary_fs):.4f}, min boundary F: {np.min(boundary_fs):.4f}')
+    print(f'Total time: {total_ref:.2f}s {Precision.fp32.value}, {total_reduced:.2f}s {label}, ', end='')
+    print(f'speedup {total_ref / max(total_reduced, 1e-9):.2f}x')
+  print('---------------------')
+  return errors
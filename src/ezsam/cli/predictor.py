@@ -0,0 +1,107 @@
+# Wrappers around the Segment-Anything predictor used to prompt SAM with detected object boxes.
+
+from typing import Callable
+
+import numpy as np
+import torch
+
+from ezsam.lib.hash import image_hash
+from ezsam.cli.cache import EmbeddingCache
+from ezsam.cli.report import timer
+from ezsam.cli.config.defaults import DEFAULT_SAM_BATCH_SIZE
+
+
+class EmbeddingReusePredictor:
+  """
+  Wraps a SamPredictor so that the image encoder only runs once per image.
+
+  set_image() is skipped when the predictor already holds the features for an image with identical contents,
+   for example when segmenting positive and then negative prompt detections for the same image or video frame.
+  With an embedding cache, features are also loaded from disk for images that were encoded in an earlier run.
+  All other attributes are passed through to the wrapped predictor.
+  """
+
+  def __init__(self, predictor, embedding_cache: EmbeddingCache | None = None):
+    self.predictor = predictor
+    self.embedding_cache = embedding_cache
+    self.image_key: str = None
+    self.encoder_runs = 0
+    self.encoder_runs_saved = 0
+
+  def __getattr__(self, name):
+    return getattr(self.predictor, name)
+
+  @timer.stage('sam_set_image')
+  def set_image(self, image: np.ndarray, image_format: str = 'RGB') -> None:
+    key = f'{image_format}:{image_hash(image)}'
+    if self.predictor.is_image_set and key == self.image_key:
+      self.encoder_runs_saved += 1
+      return
+    cache_key = None
+    if self.embedding_cache is not None:
+      cache_key = self.embedding_cache.key(key, self.predictor.transform.target_length)
+      if self.embedding_cache.load(cache_key, self.predictor):
+        self.image_key = key
+        self.encoder_runs_saved += 1
+        return
+    self.predictor.set_image(image, image_format)
+    self.image_key = key
+    self.encoder_runs += 1
+    if cache_key is not None:
+      self.embedding_cache.save(cache_key, self.predictor)
+
+  def reset_image(self) -> None:
+    self.predictor.reset_image()
+    self.image_key = None
+
+  def stats(self) -> str:
+    stats = f'SAM image encoder runs: {self.encoder_runs}, saved by embedding reuse: {self.encoder_runs_saved}'
+    if self.embedding_cache is not None:
+      stats += f'\n{self.embedding_cache.stats()}'
+    return stats
+
+
+@timer.stage('sam_predict')
+def predict_masks_for_boxes(
+  sam_predictor,  #: samhq.SamPredictor,
+  xyxy: np.ndarray,
+  batch_size: int = DEFAULT_SAM_BATCH_SIZE,
+  join: Callable[[np.ndarray], None] | None = None,
+) -> np.ndarray | None:
+  """
+  Prompt SAM with a batch of boxes for the currently set image, returning the best scoring mask for each box.
+
+  Same result as calling sam_predictor.predict(box=box, multimask_output=True) for each box and picking the mask
+   with the highest score, but boxes are sent through the mask decoder together in batches of up to batch_size.
+   Peak memory scales with batch_size, since each box's candidate masks are upscaled to the full image size.
+
+  join (Callable | None): If given, called with the union of the masks for each batch of boxes, i.e.
+   SupermaskBuilder.add(), instead of returning the masks for all the boxes.
+
+  Returns:
+    np.ndarray | None: Array of n masks * H pixels * W pixels, where n is the number of boxes. None if join is given.
+  """
+  result_masks = []
+  boxes = torch.as_tensor(xyxy, dtype=torch.float, device=sam_predictor.device)
+  boxes = sam_predictor.transform.apply_boxes_torch(boxes, sam_predictor.original_size)
+  for start in range(0, len(boxes), batch_size):
+    batch = boxes[start : start + batch_size]
+    # masks: B boxes * C candidate masks * H * W, scores: B * C
+    masks, scores, _ = sam_predictor.predict_torch(
+      point_coords=None, point_labels=None, boxes=batch, multimask_output=True
+    )
+    index = torch.argmax(scores, dim=1)
+    if join is not None:
+      # Joined on the device one box at a time, without copying out each box's best mask, and so that only one mask
+      #  is copied back from the GPU
+      joined = torch.zeros(masks.shape[-2:], dtype=torch.bool, device=masks.device)
+      for box, best in enumerate(index.tolist()):
+        joined.logical_or_(masks[box, best])
+      join(joined.cpu().numpy())
+    else:
+      result_masks.append(masks[torch.arange(len(batch), device=masks.device), index].cpu().numpy())
+    # Free this batch's full size masks before predicting the next batch
+    del masks
+  if join is not None:
+    return None
+  return np.concatenate(result_masks, axis=0)
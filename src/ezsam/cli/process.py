@@ -4,8 +4,7 @@ import itertools
 import math
 import os
 import sys
-import shlex
-import subprocess as sub
+from typing import Callable
 
 import cv2
 import numpy as np
@@ -19,7 +18,38 @@ import groundingdino.util.inference as gd
 
 from ezsam.lib.date import now
 from ezsam.lib.file import InputMode, get_input_mode
+from ezsam.cli.cache import ResultCache
+from ezsam.cli.detector import predict_with_classes_batch
+from ezsam.cli.predictor import predict_masks_for_boxes
 from ezsam.cli.formats import OutputImageFormat, OutputVideoCodec, get_video_fmt_from_codec
+from ezsam.cli.config.defaults import (
+  DEFAULT_GD_BATCH_SIZE,
+  DEFAULT_CHECKPOINT_FRAMES,
+  DEFAULT_TILE_OVERLAP,
+  DEFAULT_QUEUE_DEPTH,
+  DEFAULT_KEYFRAME_INTERVAL,
+  DEFAULT_SCENE_THRESHOLD,
+  DEFAULT_MAX_PROPAGATION,
+  DEFAULT_PROPAGATION_MOTION,
+  DEFAULT_PROPAGATION_EDGE_ERROR,
+)
+from ezsam.cli.pipeline import batches, run_pipeline
+from ezsam.cli.propagation import MaskPropagator
+from ezsam.cli.tracking import KeyframeDetector
+from ezsam.cli.resume import JobManifest
+from ezsam.cli.report import timer
+from ezsam.cli.resolution import downscale_to_max_side, upsample_mask, upscale_detections
+from ezsam.cli.options import SamCropMode
+from ezsam.cli.crops import cluster_boxes, crops_worthwhile, segment_crops
+from ezsam.cli.composite import SupermaskBuilder
+from ezsam.cli.tiling import TiledDetector, tiling_options
+from ezsam.cli.video import (
+  UNJOINABLE_CODECS,
+  SegmentedFrameWriter,
+  StreamingFrameWriter,
+  TempFileFrameWriter,
+  read_video_frames,
+)
 
 
 def process_file(
@@ -38,17 +68,50 @@ def process_file(
   output_dir: str,
   debug: bool,
   cleanup: bool,
+  single_pass: bool = False,
+  temp_files: bool = False,
+  queue_depth: int = DEFAULT_QUEUE_DEPTH,
+  keyframe_interval: int = DEFAULT_KEYFRAME_INTERVAL,
+  scene_threshold: float = DEFAULT_SCENE_THRESHOLD,
+  max_propagation: int = DEFAULT_MAX_PROPAGATION,
+  propagation_motion: float = DEFAULT_PROPAGATION_MOTION,
+  propagation_edge_error: float = DEFAULT_PROPAGATION_EDGE_ERROR,
+  result_cache: ResultCache | None = None,
+  gd_batch_size: int = DEFAULT_GD_BATCH_SIZE,
+  # For images only, object detection boxes from detect_prompts() to use instead of running object detection
+  prior_detections: tuple[sv.Detections, sv.Detections | None] | None = None,
+  # For images only, the image already read with cv2.imread(), so that it isn't decoded again
+  image: np.ndarray | None = None,
+  # For videos only, process frames from start_frame up to but not including end_frame, i.e. one chunk of a video
+  start_frame: int = 0,
+  end_frame: int | None = None,
+  # Output file to write instead of the default output path
+  out: str | None = None,
+  # For videos only, keep track of finished frames so that processing can continue after them if interrupted
+  resume: bool = False,
+  checkpoint_frames: int = DEFAULT_CHECKPOINT_FRAMES,
+  # Identifies the models used, so that a job isn't resumed with different models
+  model_id: str | None = None,
+  # Run the models on a copy of each image or frame downscaled to this maximum side length, upsampling the mask
+  max_side: int | None = None,
+  # Whether to segment crops around detected objects instead of whole images, see crops.py
+  sam_crop: SamCropMode = SamCropMode.off,
+  # Also detect objects on overlapping tiles of this size for larger images or frames, see tiling.py
+  tile_size: int | None = None,
+  tile_overlap: float = DEFAULT_TILE_OVERLAP,
 ) -> None:
   input_mode = get_input_mode(src)
-  # Determine output extension: preserve for images in debug mode, else use formats that support transparency.
-  input_filename, input_ext = os.path.splitext(os.path.basename(src))
-  ext = input_ext
-  if input_mode == InputMode.image and not debug:
-    ext = '.' + img_fmt
-  elif input_mode == InputMode.video:
-    ext = '.' + get_video_fmt_from_codec(codec)
-  out = output_dir + '/' + input_filename + output_suffix + ext
+  # Prefix for temporary files, unique to the output file
+  tmp_prefix = f'{output_dir}/{os.path.splitext(os.path.basename(src))[0]}'
+  if out is None:
+    out = get_output_path(src, input_mode, img_fmt, codec, output_suffix, output_dir, debug)
+  else:
+    tmp_prefix = os.path.splitext(out)[0]
   print(f'{now()}: Processing file {src} to {out} ...')
+  if tile_size:
+    grounding_dino_model = TiledDetector(
+      grounding_dino_model, tile_size=tile_size, overlap=tile_overlap, batch_size=gd_batch_size
+    )
   process_image_args = {
     'prompts': prompts,
     'neg_prompts': neg_prompts,
@@ -58,89 +121,285 @@ def process_file(
     'sam_predictor': sam_predictor,
     'grounding_dino_model': grounding_dino_model,
     'debug': debug,
+    'single_pass': single_pass,
+    'result_cache': result_cache,
+    'max_side': max_side,
+    'sam_crop': sam_crop,
   }
   print(f'Process image args: {process_image_args}')
 
   if input_mode == InputMode.image:
-    # Load image, discarding any alpha channel information if present
-    image: np.ndarray = cv2.imread(src)  # note: default method cv2.IMREAD_COLOR, format BGR
-    # Version of image with alpha information if present. Note that BGR is default colour mode using OpenCV library (cv2).
-    image_unchanged: np.ndarray = cv2.imread(src, cv2.IMREAD_UNCHANGED)
-    processed_image = process_image(image=image, image_unchanged=image_unchanged, **process_image_args)
-    cv2.imwrite(out, processed_image)
+    with timer.stage('decode'):
+      if image is None:
+        # Load image, discarding any alpha channel information if present
+        image = cv2.imread(src)  # note: default method cv2.IMREAD_COLOR, format BGR
+      # Version of image with alpha information if present. Note that BGR is default colour mode using OpenCV library (cv2).
+      image_unchanged: np.ndarray = cv2.imread(src, cv2.IMREAD_UNCHANGED)
+    processed_image = process_image(
+      image=image, image_unchanged=image_unchanged, prior_detections=prior_detections, **process_image_args
+    )
+    write_image(out, processed_image)
+    timer.count_image()
 
   elif input_mode == InputMode.video:
-    print(f'Using extension / codec: {ext} / {codec} ...')
-
-    # Process all input frames to temporary image files
-    tmp_files = []
-    video_frames_generator = sv.get_video_frames_generator(source_path=src)
+    print(f'Using extension / codec: {os.path.splitext(out)[1]} / {codec} ...')
+
+    manifest = None
+    # Number of frames finished by an earlier run of the same job
+    done = 0
+    if resume:
+      # Everything that affects the output frames, so a job is only resumed with the same settings
+      models = ['sam_predictor', 'grounding_dino_model', 'result_cache']
+      options = {
+        **{name: value for name, value in process_image_args.items() if name not in models},
+        'model_id': model_id,
+        'tiling': tiling_options(grounding_dino_model),
+        'codec': codec,
+        'img_fmt': img_fmt,
+        'temp_files': temp_files,
+        'keyframe_interval': keyframe_interval,
+        'scene_threshold': scene_threshold,
+        'max_propagation': max_propagation,
+        'propagation_motion': propagation_motion,
+        'propagation_edge_error': propagation_edge_error,
+        'start_frame': start_frame,
+        'end_frame': end_frame,
+        'num_test_frames': num_test_frames,
+      }
+      manifest = JobManifest.load(out=out, src=src, options=options)
+      if manifest.complete and os.path.isfile(out):
+        print(f'{now()}: Already processed {src} to {out} in an earlier job, skipping ...')
+        return
+      done = manifest.num_frames
+      if done > 0:
+        print(f'{now()}: Resuming job after {done} finished frames ...')
+
+    video_frames_generator = read_video_frames(src, start=start_frame + done, end=end_frame)
     video_info = sv.VideoInfo.from_video_path(video_path=src)
     fps = video_info.fps
-    (w, h) = video_info.resolution_wh
-    i = 0
-    # I.e. 10 frames => 1 digit, 0..9. 11 frames => 2 digits, 00..10.
-    num_digits = int(math.log10(video_info.total_frames - 1)) + 1
     if num_test_frames is None:
-      total = video_info.total_frames
+      total = (end_frame or video_info.total_frames) - start_frame
       frame_gen = video_frames_generator
     else:
       total = num_test_frames
-      frame_gen = itertools.islice(video_frames_generator, total)
-    for frame in tqdm.tqdm(frame_gen, total=total):
-      # Pad counter to num_digits
-      i_pad = str(i).zfill(num_digits)
-      tmp = f'{output_dir}/{input_filename}.{i_pad}.tmp.{img_fmt}'
-      processed_image = process_image(image=frame, image_unchanged=None, **process_image_args)
-      i += 1
-      print(f'Writing frame {i} to {tmp} ...')
-      cv2.imwrite(tmp, processed_image)
-      tmp_files.append(tmp)
-
-    # Join temporary processed images into video using either FFmpeg or ImageMagick's convert
-    if codec == OutputVideoCodec.gif:
-      tmp_img_naming = f'{output_dir}/{input_filename}.*.tmp.{img_fmt}'
-      cmd_in = ''
-    else:
-      tmp_img_naming = f'{output_dir}/{input_filename}.%{num_digits}d.tmp.{img_fmt}'
-      cmd_in = f'ffmpeg -y -framerate {fps} -i {tmp_img_naming}'
-    # ref: https://stackoverflow.com/a/75461590
-    # Note: Software support is iffy for all but gif.
-    # Chrome can display alpha for vp9+webm.
-    # mpv works for the rest.
-    cmd_out = ''
-    if codec == OutputVideoCodec.prores:
-      cmd_out = f'-c:v prores -pix_fmt yuva444p10le {out}'
-    elif codec == OutputVideoCodec.vp9:
-      cmd_out = f'-c:v libvpx-vp9 -pix_fmt yuva420p {out}'
-    elif codec == OutputVideoCodec.ffv1:
-      cmd_out = f'-c:v ffv1 -pix_fmt yuva420p {out}'
-    elif codec == OutputVideoCodec.apng:
-      cmd_out = f'-c:v apng -pix_fmt rgba {out}'
-    elif codec == OutputVideoCodec.gif:
-      delay = get_delay_from_fps(fps)
-      cmd_out = f'convert -resize {w}x{h} -delay {delay} -dispose Background -loop 0 "{tmp_img_naming}" {out}'
+      frame_gen = itertools.islice(video_frames_generator, total - done)
+    frame_gen = timer.timed('decode', frame_gen)
+
+    if temp_files or (manifest and codec in UNJOINABLE_CODECS):
+      # Process all input frames to temporary image files, and join them into a video at the end
+      # I.e. 10 frames => 1 digit, 0..9. 11 frames => 2 digits, 00..10.
+      num_digits = int(math.log10(max(video_info.total_frames - 1, 1))) + 1
+      writer = TempFileFrameWriter(
+        out=out,
+        codec=codec,
+        fps=fps,
+        resolution_wh=video_info.resolution_wh,
+        tmp_prefix=tmp_prefix,
+        img_fmt=img_fmt,
+        num_digits=num_digits,
+        cleanup=cleanup,
+        num_frames=done,
+        keep_on_abort=manifest is not None,
+      )
+    elif manifest:
+      # Stream processed frames into segment videos, so that finished segments can be kept if interrupted
+      writer = SegmentedFrameWriter(
+        out=out,
+        codec=codec,
+        fps=fps,
+        resolution_wh=video_info.resolution_wh,
+        segments=manifest.segments,
+        num_frames=done,
+        segment_frames=checkpoint_frames,
+        on_segment=manifest.update,
+        cleanup=cleanup,
+      )
     else:
-      raise ValueError(f'Invalid codec: {codec}')
-    cmd = cmd_in + ' ' + cmd_out
-    print(f'Joining video frames via command: {cmd} ...')
-    cmd_args = shlex.split(cmd)
-    sub.run(cmd_args)
-
-    if cleanup:
-      for tmp in tmp_files:
-        try:
-          print(f'Deleting temp file: {tmp} ...')
-          os.remove(tmp)
-        except Exception as err:
-          print(f'Error deleting temporary image file {tmp}')
-          print(f'{err}')
-
+      # Stream processed frames directly into the video encoder
+      writer = StreamingFrameWriter(out=out, codec=codec, fps=fps, resolution_wh=video_info.resolution_wh)
+    detect_args = get_detect_args(process_image_args)
+    keyframes = None
+    if keyframe_interval > 1:
+      # Only run object detection on keyframes, tracking object boxes in between
+      keyframes = KeyframeDetector(
+        detect=lambda frame: detect_prompts(image=frame, **detect_args),
+        interval=keyframe_interval,
+        scene_threshold=scene_threshold,
+      )
+
+    propagator = None
+    if max_propagation > 0:
+      if debug:
+        print('Warning: mask propagation is not available in debug mode, segmenting every frame')
+      else:
+        propagator = MaskPropagator(
+          max_length=max_propagation, motion_threshold=propagation_motion, edge_threshold=propagation_edge_error
+        )
+    supermask_args = {k: v for k, v in process_image_args.items() if k not in ['debug', 'max_side']}
+    # Run object detection on batches of frames, unless it depends on the previous frame or might not be needed
+    batch_size = 1
+    if gd_batch_size > 1 and not keyframes and not propagator and not result_cache:
+      batch_size = gd_batch_size
+
+    # Keyframe detection, tracking, and propagation all work on frames at the processing resolution
+    def segment_frame(model_frame: np.ndarray) -> np.ndarray | None:
+      prior_detections = keyframes(model_frame) if keyframes else None
+      return supermask_for_image(image=model_frame, prior_detections=prior_detections, **supermask_args)
+
+    def process_frame(frame: np.ndarray) -> np.ndarray:
+      model_frame = downscale_to_max_side(frame, max_side)
+      if propagator:
+        supermask = propagator(model_frame, segment=segment_frame)
+        return apply_supermask(image=frame, image_unchanged=None, supermask=supermask)
+      prior_detections = keyframes(model_frame) if keyframes else None
+      return process_image(image=frame, image_unchanged=None, prior_detections=prior_detections, **process_image_args)
+
+    batch_detection_failed = False
+
+    def process_batch(frames: list[np.ndarray]) -> list[np.ndarray]:
+      nonlocal batch_detection_failed
+      if len(frames) <= 1 or batch_detection_failed:
+        return [process_frame(frame) for frame in frames]
+      model_frames = [downscale_to_max_side(frame, max_side) for frame in frames]
+      try:
+        detections = detect_prompts_batch(images=model_frames, batch_size=batch_size, **detect_args)
+      except Exception as err:
+        print(f'Error detecting objects in a batch of frames, detecting one frame at a time instead: {err}')
+        batch_detection_failed = True
+        return [process_frame(frame) for frame in frames]
+      return [
+        process_image(image=frame, image_unchanged=None, prior_detections=frame_detections, **process_image_args)
+        for frame, frame_detections in zip(frames, detections)
+      ]
+
+    # Decode, process, and encode batches of frames in a pipeline so that video I/O overlaps with model inference
+    with writer, tqdm.tqdm(total=total, initial=done) as progress:
+
+      def write_batch(processed_images: list[np.ndarray]):
+        for processed_image in processed_images:
+          with timer.stage('encode'):
+            writer.write(processed_image)
+          timer.count_frames(1)
+          progress.update()
+          if manifest and isinstance(writer, TempFileFrameWriter):
+            manifest.update(num_frames=writer.num_frames)
+
+      # Queues hold batches of frames, so buffer the same number of frames as without batching, rounded up
+      depth = -(-queue_depth // batch_size)
+      run_pipeline(frames=batches(frame_gen, batch_size), process=process_batch, write=write_batch, depth=depth)
+    if manifest:
+      manifest.finish()
+    if keyframes:
+      print(keyframes.stats())
+    if propagator:
+      print(propagator.stats())
+  if result_cache:
+    print(result_cache.stats())
+
+
+def write_image(out: str, image: np.ndarray) -> None:
+  # Same as cv2.imwrite(), but timing encoding and writing separately
+  with timer.stage('encode'):
+    success, encoded = cv2.imencode(os.path.splitext(out)[1], image)
+  if not success:
+    raise ValueError(f'Could not encode output image {out}')
+  with timer.stage('write'):
+    encoded.tofile(out)
+
+
+def get_output_path(
+  src: str,
+  input_mode: InputMode,
+  img_fmt: OutputImageFormat,
+  codec: OutputVideoCodec,
+  output_suffix: str,
+  output_dir: str,
+  debug: bool,
+) -> str:
+  # Determine output extension: preserve for images in debug mode, else use formats that support transparency.
+  input_filename, input_ext = os.path.splitext(os.path.basename(src))
+  ext = input_ext
+  if input_mode == InputMode.image and not debug:
+    ext = '.' + img_fmt
+  elif input_mode == InputMode.video:
+    ext = '.' + get_video_fmt_from_codec(codec)
+  return output_dir + '/' + input_filename + output_suffix + ext
+
+
+def get_detect_args(process_image_args: dict) -> dict:
+  """
+  Arguments to detect_prompts() for the same detections process_image() would use.
+  """
+  excluded = ['sam_predictor', 'debug', 'result_cache', 'max_side', 'sam_crop']
+  detect_args = {k: v for k, v in process_image_args.items() if k not in excluded}
+  if process_image_args['debug']:
+    # Debug mode detects and annotates all prompts together
+    detect_args['prompts'] = process_image_args['prompts'] + (process_image_args['neg_prompts'] or [])
+    detect_args['neg_prompts'] = []
+  return detect_args
+
+
+def process_files(srcs: list[str], **process_file_args) -> list[tuple[str, str]]:
+  """
+  Process input files one after another, running object detection on batches of consecutive input images.
+
+  srcs (list[str]): Input files to process.
+  process_file_args (dict): Arguments to process_file(), except src.
+
+  Returns:
+    list[tuple[str, str]]: Input file and error message for each file that could not be processed.
+  """
+  errors = []
+  gd_batch_size = process_file_args.get('gd_batch_size', DEFAULT_GD_BATCH_SIZE)
+  # Cached results would make detecting objects ahead of time wasted work, and tiled detection batches tiles instead
+  can_batch = (
+    gd_batch_size > 1 and process_file_args.get('result_cache') is None and not process_file_args.get('tile_size')
+  )
 
-def get_delay_from_fps(fps):
-  # Get centiseconds delay from frames per second, used as ImageMagick's delay parameter
-  f = fps if (fps is not None and fps != 0) else 1
-  return 100.0 / f
+  def is_image(src: str) -> bool:
+    try:
+      return get_input_mode(src) == InputMode.image
+    except Exception:
+      return False
+
+  i = 0
+  while i < len(srcs):
+    batch = list(itertools.takewhile(is_image, srcs[i : i + gd_batch_size])) if can_batch else []
+    if len(batch) <= 1:
+      batch = srcs[i : i + 1]
+    i += len(batch)
+    detections = [None] * len(batch)
+    images = [None] * len(batch)
+    if len(batch) > 1:
+      try:
+        max_side = process_file_args.get('max_side')
+        with timer.stage('decode'):
+          images = [cv2.imread(src) for src in batch]
+        readable = [j for j, image in enumerate(images) if image is not None]
+        # Detections for each image are made at the processing resolution process_file() will use
+        model_images = [downscale_to_max_side(images[j], max_side) for j in readable]
+        detect_args = get_detect_args({
+          'prompts': process_file_args['prompts'],
+          'neg_prompts': process_file_args['neg_prompts'],
+          'box_threshold': process_file_args['box_threshold'],
+          'text_threshold': process_file_args['text_threshold'],
+          'nms_threshold': process_file_args['nms_threshold'],
+          'grounding_dino_model': process_file_args['grounding_dino_model'],
+          'debug': process_file_args['debug'],
+          'single_pass': process_file_args.get('single_pass', False),
+        })
+        batch_detections = detect_prompts_batch(images=model_images, batch_size=gd_batch_size, **detect_args)
+        for j, image_detections in zip(readable, batch_detections):
+          detections[j] = image_detections
+      except Exception as err:
+        print(f'Error detecting objects in a batch of images, detecting one image at a time instead: {err}')
+    for src, image, prior_detections in zip(batch, images, detections):
+      try:
+        process_file(src=src, prior_detections=prior_detections, image=image, **process_file_args)
+      except Exception as err:
+        print(f'Error processing file {src}: {err}')
+        errors.append((src, f'{err}'))
+  return errors
 
 
 def get_video_codec(src: str):
@@ -167,99 +426,363 @@ def process_image(
   sam_predictor,  #: samhq.SamPredictor,
   grounding_dino_model: gd.Model,
   debug: bool,
+  single_pass: bool = False,
+  # Object detection boxes from detect_prompts() to use instead of running object detection on the image
+  prior_detections: tuple[sv.Detections, sv.Detections | None] | None = None,
+  result_cache: ResultCache | None = None,
+  # Run the models on a copy of the image downscaled to this maximum side length. Prior detections are for that copy
+  max_side: int | None = None,
+  sam_crop: SamCropMode = SamCropMode.off,
 ) -> np.ndarray:
   print('Processing image...')
-  if debug:
-    print(f'{now()} Joining prompts for debug mode ...')
-    prompts = prompts + (neg_prompts or [])
-  else:
-    print(f'{now()} Handling positive prompts...')
-  detections = detections_for_image(
-    grounding_dino_model=grounding_dino_model,
+  model_image = downscale_to_max_side(image, max_side)
+  if model_image is not image:
+    print(f'{now()} Processing at {model_image.shape[1]}x{model_image.shape[0]} ...')
+  segment_args = {
+    'image': model_image,
+    'prompts': prompts,
+    'neg_prompts': neg_prompts,
+    'box_threshold': box_threshold,
+    'text_threshold': text_threshold,
+    'nms_threshold': nms_threshold,
+    'sam_predictor': sam_predictor,
+    'grounding_dino_model': grounding_dino_model,
+    'single_pass': single_pass,
+    'prior_detections': prior_detections,
+    'sam_crop': sam_crop,
+  }
+  if not debug:
+    supermask = supermask_for_image(**segment_args, result_cache=result_cache)
+    return apply_supermask(image=image, image_unchanged=image_unchanged, supermask=supermask)
+
+  print(f'{now()} Joining prompts for debug mode ...')
+  prompts = prompts + (neg_prompts or [])
+  detections, _ = segment_prompts(**{**segment_args, 'prompts': prompts, 'neg_prompts': []})
+  if detections is None:
+    print('Returning original image ...')
+    return image
+  if model_image is not image:
+    detections = upscale_detections(detections=detections, small_image=model_image, image=image)
+  print(f'{now()} Annotating output image ...')
+  return annotate_image(image=image, detections=detections, prompts=prompts)
+
+
+@timer.stage('composite')
+def annotate_image(image: np.ndarray, detections: sv.Detections, prompts: list[str]) -> np.ndarray:
+  # Annotate image with SAM segment masks and GroundingDINO object detection boxes.
+  # Note: Should set ColorLookup.INDEX when annotating for SAM.
+  # ref: https://github.com/roboflow/notebooks/blob/main/notebooks/how-to-segment-anything-with-sam.ipynb
+  # ref: https://supervision.roboflow.com/annotators/
+  mask_annotator = sv.MaskAnnotator(color_lookup=sv.ColorLookup.INDEX)
+  box_corner_annotator = sv.BoxCornerAnnotator(color_lookup=sv.ColorLookup.INDEX)
+  label_annotator = sv.LabelAnnotator(text_position=sv.Position.CENTER_OF_MASS, color_lookup=sv.ColorLookup.INDEX)
+  labels = get_labels(prompts, detections)
+  processed_image = mask_annotator.annotate(scene=image.copy(), detections=detections)
+  processed_image = box_corner_annotator.annotate(scene=processed_image, detections=detections)
+  processed_image = label_annotator.annotate(scene=processed_image, detections=detections, labels=labels)
+  return processed_image
+
+
+def supermask_for_image(
+  image: np.ndarray,
+  prompts: list[str],
+  neg_prompts: list[str],
+  box_threshold: float,
+  text_threshold: float,
+  nms_threshold: float,
+  sam_predictor,  #: samhq.SamPredictor,
+  grounding_dino_model: gd.Model,
+  single_pass: bool = False,
+  prior_detections: tuple[sv.Detections, sv.Detections | None] | None = None,
+  result_cache: ResultCache | None = None,
+  sam_crop: SamCropMode = SamCropMode.off,
+) -> np.ndarray | None:
+  """
+  Returns a single mask of the foreground selected by the prompts, excluding anything selected by the negative prompts.
+  Returns None if there were no objects detected for the prompts.
+
+  result_cache (ResultCache | None): If given, reuse the cached supermask for identical images and options instead of
+   running the models. Not used with prior_detections, since those depend on earlier video frames.
+  """
+  cache_key = None
+  if result_cache is not None and prior_detections is None:
+    cache_key = result_cache.key(
+      image,
+      prompts=prompts,
+      neg_prompts=neg_prompts,
+      box_threshold=box_threshold,
+      text_threshold=text_threshold,
+      nms_threshold=nms_threshold,
+      single_pass=single_pass,
+      sam_crop=sam_crop,
+      tiling=tiling_options(grounding_dino_model),
+    )
+    hit, supermask = result_cache.get(cache_key)
+    if hit:
+      print(f'{now()} Using cached result ...')
+      return supermask
+  builder = SupermaskBuilder(image.shape[:2])
+  detections, _ = segment_prompts(
     image=image,
     prompts=prompts,
+    neg_prompts=neg_prompts,
     box_threshold=box_threshold,
     text_threshold=text_threshold,
     nms_threshold=nms_threshold,
     sam_predictor=sam_predictor,
+    grounding_dino_model=grounding_dino_model,
+    single_pass=single_pass,
+    prior_detections=prior_detections,
+    sam_crop=sam_crop,
+    supermask=builder,
   )
-  if detections is None:
-    if debug:
-      print('Returning original image ...')
-      return image
-    else:
-      print('Returning empty image ...')
-      # Create a new image with dimensions of old image plus an alpha channel, and then zero out everything
-      processed_image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
-      processed_image[:, :, :] = 0
-      return processed_image
+  # Masks are joined into the supermask as SAM produces them, with negative prompts' masks removed from it
+  supermask = builder.mask if detections is not None else None
+  # Also cache when nothing was detected, so that the models don't run again for the same image
+  if cache_key is not None:
+    result_cache.put(cache_key, supermask)
+  return supermask
+
+
+@timer.stage('composite')
+def apply_supermask(image: np.ndarray, image_unchanged: np.ndarray | None, supermask: np.ndarray | None) -> np.ndarray:
+  """
+  Filter image using the foreground supermask from supermask_for_image(), returning a BGRA image.
+  A supermask made for a downscaled copy of the image is upsampled to the image's resolution first.
+  """
+  if supermask is None:
+    print('Returning empty image ...')
+    # Dimensions of old image plus an alpha channel, with everything zeroed out
+    return np.zeros((*image.shape[:2], 4), dtype=np.uint8)
+  print(f'{now()} Filtering output image ...')
+  # We prefer basing output on original image including any alpha channel, if present
+  processed_image = cv2.cvtColor(image if not is_ndarray(image_unchanged) else image_unchanged, cv2.COLOR_BGR2BGRA)
+  # Apply mask to image's alpha channel
+  if supermask.shape != image.shape[:2]:
+    print(f'{now()} Upsampling mask ...')
+    soft_mask = upsample_mask(mask=supermask, image=image)
+    alpha = processed_image[:, :, 3]
+    # Same type as the alpha channel, which is 16 bit for 16 bit PNG or TIFF input. The product is still scaled by
+    #  1 / 255, since the soft mask's values only go up to 255 either way
+    processed_image[:, :, 3] = cv2.multiply(alpha, soft_mask.astype(alpha.dtype), scale=1 / 255)
+  else:
+    # In place on the alpha channel, multiplying by the mask's 0 or 1 bytes
+    alpha = processed_image[:, :, 3]
+    np.multiply(alpha, supermask.view(np.uint8), out=alpha)
+  return processed_image
 
-  neg_detections: sv.Detections | None
-  has_neg_prompts = neg_prompts and len(neg_prompts) > 0
-  if not debug and has_neg_prompts:
-    print(f'{now()} Handling negative prompts...')
-    neg_detections = detections_for_image(
+
+def segment_prompts(
+  image: np.ndarray,
+  prompts: list[str],
+  neg_prompts: list[str],
+  box_threshold: float,
+  text_threshold: float,
+  nms_threshold: float,
+  sam_predictor,  #: samhq.SamPredictor,
+  grounding_dino_model: gd.Model,
+  single_pass: bool = False,
+  prior_detections: tuple[sv.Detections, sv.Detections | None] | None = None,
+  sam_crop: SamCropMode = SamCropMode.off,
+  supermask: SupermaskBuilder | None = None,
+) -> tuple[sv.Detections | None, sv.Detections | None]:
+  """
+  Detect (unless prior detections are given) and segment objects for the positive and negative prompts.
+
+  supermask (SupermaskBuilder | None): If given, masks are joined into it instead of kept with the detections.
+
+  Returns:
+    sv.Detections | None: Detections with masks for positive prompts, or None if there were no objects detected.
+    sv.Detections | None: Detections with masks for negative prompts, or None.
+  """
+  if prior_detections is None:
+    detections, neg_detections = detect_prompts(
       grounding_dino_model=grounding_dino_model,
       image=image,
-      prompts=neg_prompts,
+      prompts=prompts,
+      neg_prompts=neg_prompts,
       box_threshold=box_threshold,
       text_threshold=text_threshold,
       nms_threshold=nms_threshold,
-      sam_predictor=sam_predictor,
+      single_pass=single_pass,
     )
-
-  if debug:
-    print(f'{now()} Annotating output image ...')
-    # Annotate image with SAM segment masks and GroundingDINO object detection boxes.
-    # Note: Should set ColorLookup.INDEX when annotating for SAM.
-    # ref: https://github.com/roboflow/notebooks/blob/main/notebooks/how-to-segment-anything-with-sam.ipynb
-    # ref: https://supervision.roboflow.com/annotators/
-    mask_annotator = sv.MaskAnnotator(color_lookup=sv.ColorLookup.INDEX)
-    box_corner_annotator = sv.BoxCornerAnnotator(color_lookup=sv.ColorLookup.INDEX)
-    label_annotator = sv.LabelAnnotator(text_position=sv.Position.CENTER_OF_MASS, color_lookup=sv.ColorLookup.INDEX)
-    labels = get_labels(prompts, detections)
-    processed_image = mask_annotator.annotate(scene=image.copy(), detections=detections)
-    processed_image = box_corner_annotator.annotate(scene=processed_image, detections=detections)
-    processed_image = label_annotator.annotate(scene=processed_image, detections=detections, labels=labels)
   else:
-    print(f'{now()} Filtering output image ...')
-    # Filter image using masks...
-    # First join all masks together; reduce on first axis, since that's the mask number in detections.mask.
-    # Note: detection.mask is array of n masks * H pixels * W pixels, with each pixel True or False.
-    pos_supermask: np.ndarray = np.logical_or.reduce(detections.mask, axis=0)
-    if has_neg_prompts and neg_detections:
-      # Negative mask is just flipped
-      neg_supermask: np.ndarray = ~np.logical_or.reduce(neg_detections.mask, axis=0)
-      # Joint removes negative mask from positive
-      supermask = np.logical_and(pos_supermask, neg_supermask)
-    else:
-      supermask = pos_supermask
-    # We prefer basing output on original image including any alpha channel, if present
-    processed_image = cv2.cvtColor(image if not is_ndarray(image_unchanged) else image_unchanged, cv2.COLOR_BGR2BGRA)
-    # Apply mask to image's alpha channel
-    processed_image[:, :, 3] = np.multiply(processed_image[:, :, 3], supermask)
-  return processed_image
+    detections, neg_detections = prior_detections
+  detections = segment_detections(
+    sam_predictor=sam_predictor,
+    image=image,
+    detections=detections,
+    prompts=prompts,
+    sam_crop=sam_crop,
+    join=supermask.add if supermask is not None else None,
+  )
+  if detections is None:
+    timer.count_boxes(0)
+    return None, None
+  if neg_detections is not None:
+    neg_detections = segment_detections(
+      sam_predictor=sam_predictor,
+      image=image,
+      detections=neg_detections,
+      prompts=neg_prompts,
+      sam_crop=sam_crop,
+      join=supermask.subtract if supermask is not None else None,
+    )
+  timer.count_boxes(len(detections) + (len(neg_detections) if neg_detections is not None else 0))
+  return detections, neg_detections
 
 
 def is_ndarray(array: np.ndarray):
   return type(array) is np.ndarray
 
 
-def detections_for_image(
+def detect_prompts(
     grounding_dino_model: gd.Model,
-    image,
+    image: np.ndarray,
     prompts: list[str],
+    neg_prompts: list[str],
     box_threshold: float,
     text_threshold: float,
     nms_threshold: float,
-    sam_predictor,  #: samhq.SamPredictor,
-  ) -> sv.Detections:
-
-  # Detect objects
-  detections: sv.Detections = grounding_dino_model.predict_with_classes(
-    image=image, classes=prompts, box_threshold=box_threshold, text_threshold=text_threshold
+    single_pass: bool = False,
+  ) -> tuple[sv.Detections, sv.Detections | None]:
+  """
+  Detect objects for positive and negative prompts, without segmenting them.
+
+  In single pass mode, positive and negative prompts are detected using one GroundingDINO pass over a joint list of
+   classes, and the detections are then split by class. Otherwise each set of prompts gets its own pass, and negative
+   prompts are skipped if there were no positive detections.
+
+  Returns:
+    sv.Detections: Object detection boxes for positive prompts, after NMS. Might be empty.
+    sv.Detections | None: Object detection boxes for negative prompts after NMS, or None if not detected.
+  """
+  has_neg_prompts = neg_prompts and len(neg_prompts) > 0
+  if single_pass and has_neg_prompts:
+    print(f'{now()} Handling positive and negative prompts in a single detection pass ...')
+    with timer.stage('detect'):
+      detections: sv.Detections = grounding_dino_model.predict_with_classes(
+        image=image, classes=prompts + neg_prompts, box_threshold=box_threshold, text_threshold=text_threshold
+      )
+    pos_detections, neg_detections = split_detections(detections=detections, num_prompts=len(prompts))
+    # NMS is applied to each group separately, same as if they were detected in separate passes
+    print(f'{now()} Positive detections:')
+    pos_detections = filter_detections_nms(detections=pos_detections, nms_threshold=nms_threshold)
+    print(f'{now()} Negative detections:')
+    neg_detections = filter_detections_nms(detections=neg_detections, nms_threshold=nms_threshold)
+    return pos_detections, neg_detections
+
+  print(f'{now()} Handling positive prompts...')
+  pos_detections = detect_objects(
+    grounding_dino_model=grounding_dino_model,
+    image=image,
+    prompts=prompts,
+    box_threshold=box_threshold,
+    text_threshold=text_threshold,
+    nms_threshold=nms_threshold,
   )
+  neg_detections = None
+  if has_neg_prompts and len(pos_detections) > 0:
+    print(f'{now()} Handling negative prompts...')
+    neg_detections = detect_objects(
+      grounding_dino_model=grounding_dino_model,
+      image=image,
+      prompts=neg_prompts,
+      box_threshold=box_threshold,
+      text_threshold=text_threshold,
+      nms_threshold=nms_threshold,
+    )
+  return pos_detections, neg_detections
 
+
+def detect_prompts_batch(
+    grounding_dino_model: gd.Model,
+    images: list[np.ndarray],
+    prompts: list[str],
+    neg_prompts: list[str],
+    box_threshold: float,
+    text_threshold: float,
+    nms_threshold: float,
+    single_pass: bool = False,
+    batch_size: int = DEFAULT_GD_BATCH_SIZE,
+  ) -> list[tuple[sv.Detections, sv.Detections | None]]:
+  """
+  Same as detect_prompts() for each image, but running object detection on batches of up to batch_size images.
+
+  Returns:
+    list[tuple[sv.Detections, sv.Detections | None]]: Positive and negative detections for each image.
+  """
+  detect_args = {'box_threshold': box_threshold, 'text_threshold': text_threshold, 'batch_size': batch_size}
+  has_neg_prompts = neg_prompts and len(neg_prompts) > 0
+  if single_pass and has_neg_prompts:
+    print(f'{now()} Handling positive and negative prompts in a single detection pass for {len(images)} images ...')
+    results = []
+    with timer.stage('detect'):
+      batch = predict_with_classes_batch(grounding_dino_model, images, prompts + neg_prompts, **detect_args)
+    for detections in batch:
+      pos_detections, neg_detections = split_detections(detections=detections, num_prompts=len(prompts))
+      pos_detections = filter_detections_nms(detections=pos_detections, nms_threshold=nms_threshold)
+      neg_detections = filter_detections_nms(detections=neg_detections, nms_threshold=nms_threshold)
+      results.append((pos_detections, neg_detections))
+    return results
+
+  print(f'{now()} Handling positive prompts for {len(images)} images ...')
+  with timer.stage('detect'):
+    batch = predict_with_classes_batch(grounding_dino_model, images, prompts, **detect_args)
+  pos_detections = [filter_detections_nms(detections=detections, nms_threshold=nms_threshold) for detections in batch]
+  neg_detections = [None] * len(images)
+  # Negative prompts are only needed for images with positive detections
+  found = [i for i, detections in enumerate(pos_detections) if len(detections) > 0]
+  if has_neg_prompts and len(found) > 0:
+    print(f'{now()} Handling negative prompts for {len(found)} images ...')
+    found_images = [images[i] for i in found]
+    with timer.stage('detect'):
+      batch = predict_with_classes_batch(grounding_dino_model, found_images, neg_prompts, **detect_args)
+    for i, detections in zip(found, batch):
+      neg_detections[i] = filter_detections_nms(detections=detections, nms_threshold=nms_threshold)
+  return list(zip(pos_detections, neg_detections))
+
+
+def detect_objects(
+    grounding_dino_model: gd.Model,
+    image: np.ndarray,
+    prompts: list[str],
+    box_threshold: float,
+    text_threshold: float,
+    nms_threshold: float,
+  ) -> sv.Detections:
+  # Detect objects
+  with timer.stage('detect'):
+    detections: sv.Detections = grounding_dino_model.predict_with_classes(
+      image=image, classes=prompts, box_threshold=box_threshold, text_threshold=text_threshold
+    )
+  return filter_detections_nms(detections=detections, nms_threshold=nms_threshold)
+
+
+def split_detections(detections: sv.Detections, num_prompts: int) -> tuple[sv.Detections, sv.Detections]:
+  """
+  Split detections for a joint list of prompts + negative prompts into separate positive and negative detections.
+  Negative class ids are renumbered to index into the list of negative prompts.
+  Detections that GroundingDINO couldn't map onto any class (class id None or -1) are dropped, since they could be
+   for either a positive or a negative prompt.
+  """
+  if detections.class_id is None:
+    class_id = np.full(len(detections), -1)
+  else:
+    class_id = np.array([-1 if c is None else c for c in detections.class_id], dtype=int)
+  unmatched = class_id < 0
+  if unmatched.any():
+    print(f'Warning: dropping {unmatched.sum()} detections that match neither a prompt nor a negative prompt')
+  is_neg = class_id >= num_prompts
+  pos_detections = detections[~is_neg & ~unmatched]
+  pos_detections.class_id = class_id[~is_neg & ~unmatched]
+  neg_detections = detections[is_neg]
+  neg_detections.class_id = class_id[is_neg] - num_prompts
+  return pos_detections, neg_detections
+
+
+@timer.stage('nms')
+def filter_detections_nms(detections: sv.Detections, nms_threshold: float) -> sv.Detections:
   # NMS post processing to remove lower quality boxes
   print(f'{now()} Before NMS: {len(detections.xyxy)} boxes')
   nms_idx = (
@@ -270,25 +793,39 @@ def detections_for_image(
   detections.xyxy = detections.xyxy[nms_idx]
   detections.confidence = detections.confidence[nms_idx]
   detections.class_id = detections.class_id[nms_idx]
-  num_detections = len(detections.xyxy)
-  print(f'{now()} After NMS: {num_detections} boxes')
+  print(f'{now()} After NMS: {len(detections.xyxy)} boxes')
+  return detections
 
+
+def segment_detections(
+    sam_predictor,  #: samhq.SamPredictor,
+    image: np.ndarray,
+    detections: sv.Detections,
+    prompts: list[str],
+    sam_crop: SamCropMode = SamCropMode.off,
+    # Called with masks as they're produced, i.e. SupermaskBuilder.add(), instead of setting detections.mask
+    join: Callable[..., None] | None = None,
+  ) -> sv.Detections | None:
+  num_detections = len(detections.xyxy)
   if num_detections <= 0:
     print(f'Warning: no objects detected for prompts {prompts}')
     return None
 
-  import segment_anything_hq as samhq
-
-  def segment(sam_predictor: samhq.SamPredictor, image: np.ndarray, xyxy: np.ndarray) -> np.ndarray:
+  if sam_crop != SamCropMode.off:
+    clusters = cluster_boxes(detections.xyxy, image.shape[:2])
+    target_length = sam_predictor.transform.target_length
+    if sam_crop == SamCropMode.on or crops_worthwhile(clusters, image.shape[:2], target_length):
+      print(f'{now()} Converting object detections to segment masks in {len(clusters)} crops ...')
+      detections.mask = segment_crops(
+        sam_predictor=sam_predictor, image=image, xyxy=detections.xyxy, clusters=clusters, join=join
+      )
+      return detections
+
+  def segment(sam_predictor, image: np.ndarray, xyxy: np.ndarray) -> np.ndarray | None:
     # Prompt SAM with boxes for all detected objects
     sam_predictor.set_image(image, 'BGR')
-    result_masks = []
-    for box in xyxy:
-      masks, scores, logits = sam_predictor.predict(box=box, multimask_output=True)
-      index = np.argmax(scores)
-      result_masks.append(masks[index])
-    return np.array(result_masks)
-  
+    return predict_masks_for_boxes(sam_predictor=sam_predictor, xyxy=xyxy, join=join)
+
   print(f'{now()} Converting object detections to segment masks ...')
   detections.mask = segment(sam_predictor=sam_predictor, image=image, xyxy=detections.xyxy)
 
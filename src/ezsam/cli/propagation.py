@@ -0,0 +1,117 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Mask propagation for video.
+#
+# Instead of segmenting every frame, the previous frame's foreground supermask is warped onto the next frame using
+#  dense optical flow (Farneback). Full segmentation only runs again when there's too much motion, when the warped
+#  mask's edges don't line up with the new frame, or after too many frames in a row have been propagated.
+# Works best for footage from a static camera, i.e. objects on a turntable.
+#
+
+from typing import Callable
+
+import cv2
+import numpy as np
+
+from ezsam.lib.date import now
+from ezsam.cli.tracking import to_tracking_gray
+
+FARNEBACK_PARAMS = {
+  'pyr_scale': 0.5,
+  'levels': 3,
+  'winsize': 15,
+  'iterations': 3,
+  'poly_n': 5,
+  'poly_sigma': 1.2,
+  'flags': 0,
+}
+
+
+def warp(image: np.ndarray, flow: np.ndarray, interpolation: int = cv2.INTER_LINEAR) -> np.ndarray:
+  """
+  Warp an image from the previous frame onto the current frame, given backward flow from the current frame to the
+   previous frame at the same resolution as the image.
+  """
+  h, w = flow.shape[:2]
+  grid_x, grid_y = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+  return cv2.remap(image, grid_x + flow[..., 0], grid_y + flow[..., 1], interpolation, borderMode=cv2.BORDER_REPLICATE)
+
+
+def edge_error(mask: np.ndarray, warped_gray: np.ndarray, gray: np.ndarray) -> float:
+  """
+  Mean absolute difference between the warped previous frame and the current frame along the edges of a mask,
+   between 0 and 1. High values mean the warped mask boundary probably doesn't line up with the objects anymore.
+  """
+  kernel = np.ones((3, 3), np.uint8)
+  edges = cv2.morphologyEx(mask.astype(np.uint8), cv2.MORPH_GRADIENT, kernel) > 0
+  if not edges.any():
+    return 0.0
+  return float(cv2.absdiff(warped_gray, gray)[edges].mean()) / 255.0
+
+
+class MaskPropagator:
+  """
+  Returns the foreground supermask for each video frame in turn, propagating masks between frames where possible.
+
+  max_length (int): Maximum number of frames in a row to propagate a mask for before segmenting again.
+  motion_threshold (float): Segment again if mean optical flow magnitude is above this many pixels,
+   measured on frames downscaled to tracking resolution.
+  edge_threshold (float): Segment again if the warped mask's edge error is above this threshold [0,1].
+  """
+
+  def __init__(self, max_length: int, motion_threshold: float, edge_threshold: float):
+    self.max_length = max_length
+    self.motion_threshold = motion_threshold
+    self.edge_threshold = edge_threshold
+    self.prev_gray: np.ndarray = None
+    self.prev_supermask: np.ndarray | None = None
+    self.frames_since_segmented = 0
+    self.num_segmented = 0
+    self.num_propagated = 0
+
+  def __call__(self, frame: np.ndarray, segment: Callable[[np.ndarray], np.ndarray | None]) -> np.ndarray | None:
+    """
+    frame (np.ndarray): Current video frame, BGR.
+    segment (Callable): Returns the supermask for a frame, i.e. process.supermask_for_image().
+    """
+    gray, scale = to_tracking_gray(frame)
+    supermask = None
+    propagated = False
+    if self.prev_gray is not None and self.frames_since_segmented < self.max_length:
+      propagated, supermask = self.propagate(gray, scale, frame.shape[:2])
+    if propagated:
+      self.frames_since_segmented += 1
+      self.num_propagated += 1
+    else:
+      supermask = segment(frame)
+      self.frames_since_segmented = 0
+      self.num_segmented += 1
+    self.prev_gray = gray
+    self.prev_supermask = supermask
+    return supermask
+
+  def propagate(self, gray: np.ndarray, scale: float, shape: tuple[int, int]) -> tuple[bool, np.ndarray | None]:
+    # Backward flow, so that each pixel in the current frame knows where it came from in the previous frame
+    flow = cv2.calcOpticalFlowFarneback(gray, self.prev_gray, None, **FARNEBACK_PARAMS)
+    motion = float(np.linalg.norm(flow, axis=2).mean())
+    if motion > self.motion_threshold:
+      print(f'{now()} Motion {motion:.2f} above threshold, segmenting frame ...')
+      return False, None
+    if self.prev_supermask is None:
+      # Nothing was detected in the previous frame, and not much has changed since
+      return True, None
+    small_mask = cv2.resize(
+      self.prev_supermask.astype(np.uint8), (gray.shape[1], gray.shape[0]), interpolation=cv2.INTER_NEAREST
+    )
+    error = edge_error(warp(small_mask, flow, cv2.INTER_NEAREST), warp(self.prev_gray, flow), gray)
+    if error > self.edge_threshold:
+      print(f'{now()} Mask edge error {error:.3f} above threshold, segmenting frame ...')
+      return False, None
+    # Warp full resolution mask, so that detail isn't lost when propagating
+    h, w = shape
+    full_flow = cv2.resize(flow, (w, h), interpolation=cv2.INTER_LINEAR) / scale
+    supermask = warp(self.prev_supermask.astype(np.uint8) * 255, full_flow) >= 128
+    return True, supermask
+
+  def stats(self) -> str:
+    return f'Video frames segmented: {self.num_segmented}, propagated: {self.num_propagated}'
@@ -0,0 +1,189 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Per-stage timings of a run, and a machine readable report of them.
+#
+# Processing code times its stages with the module's timer, i.e. `with timer.stage('detect'): ...`:
+#  decode: Reading input images and decoding video frames.
+#  detect: GroundingDINO object detection, including tiles for tiled detection.
+#  nms: Non-maximum suppression of detection boxes.
+#  sam_set_image: SAM image encoder, or loading its embedding from the embedding cache.
+#  sam_predict: SAM prompt encoder and mask decoder for the detection boxes, including joining their masks into the
+#   foreground mask as they're produced.
+#  composite: Applying the foreground mask to the image, or annotating the image in debug mode.
+#  encode: Encoding output images, and sending output video frames to the video encoder.
+#  write: Writing output images, and finishing output videos.
+# Stages that run on video pipeline threads overlap, so stage totals can add up to more than the wall time. The same
+#  goes for stage totals from parallel worker processes, which are merged into the main process's timer.
+#
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from ezsam.lib.date import now
+
+REPORT_VERSION = 1
+STAGES = ['decode', 'detect', 'nms', 'sam_set_image', 'sam_predict', 'composite', 'encode', 'write']
+
+
+def get_peak_rss_mb() -> float | None:
+  """
+  Peak resident set size of this process in megabytes, or None where it isn't available, i.e. on Windows.
+  """
+  try:
+    import resource
+  except ImportError:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Reported in kilobytes on Linux, and bytes on macOS
+  return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+  if len(values) == 0:
+    return {'p50': 0.0, 'p95': 0.0}
+  p50, p95 = np.percentile(values, [50, 95])
+  return {'p50': float(p50), 'p95': float(p95)}
+
+
+class StageTimer:
+  """
+  Collects durations of processing stages, and counts of images, video frames, and boxes, from any thread.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self) -> None:
+    with self.lock:
+      self.durations: dict[str, list[float]] = {stage: [] for stage in STAGES}
+      self.boxes: list[int] = []
+      self.images = 0
+      self.frames = 0
+      self.peak_rss_mb: float | None = None
+      self.start = time.perf_counter()
+
+  def add(self, stage: str, seconds: float) -> None:
+    with self.lock:
+      self.durations.setdefault(stage, []).append(seconds)
+
+  @contextlib.contextmanager
+  def stage(self, stage: str):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add(stage, time.perf_counter() - start)
+
+  def timed(self, stage: str, items: Iterable) -> Iterator:
+    """
+    Iterate over items, timing how long each one takes to produce, i.e. decoding frames from a video generator.
+    """
+    iterator = iter(items)
+    while True:
+      start = time.perf_counter()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      self.add(stage, time.perf_counter() - start)
+      yield item
+
+  def count_boxes(self, num_boxes: int) -> None:
+    with self.lock:
+      self.boxes.append(num_boxes)
+
+  def count_image(self) -> None:
+    with self.lock:
+      self.images += 1
+
+  def count_frames(self, num_frames: int) -> None:
+    with self.lock:
+      self.frames += num_frames
+
+  def snapshot(self) -> dict:
+    """
+    Timings collected so far, to merge into the timer of another process.
+    """
+    with self.lock:
+      return {
+        'durations': {stage: list(durations) for stage, durations in self.durations.items()},
+        'boxes': list(self.boxes),
+        'images': self.images,
+        'frames': self.frames,
+        'peak_rss_mb': get_peak_rss_mb(),
+      }
+
+  def merge(self, snapshot: dict) -> None:
+    with self.lock:
+      for stage, durations in snapshot['durations'].items():
+        self.durations.setdefault(stage, []).extend(durations)
+      self.boxes.extend(snapshot['boxes'])
+      self.images += snapshot['images']
+      self.frames += snapshot['frames']
+      if snapshot['peak_rss_mb'] is not None:
+        self.peak_rss_mb = max(self.peak_rss_mb or 0, snapshot['peak_rss_mb'])
+
+  def summary(self) -> dict:
+    """
+    Report of the timings since the last reset, as a JSON serializable dict.
+    """
+    wall = time.perf_counter() - self.start
+    with self.lock:
+      stages = {}
+      for stage, durations in self.durations.items():
+        stages[stage] = {
+          'count': len(durations),
+          'total': float(sum(durations)),
+          **percentiles(durations),
+        }
+      peak_rss = [rss for rss in [get_peak_rss_mb(), self.peak_rss_mb] if rss is not None]
+      return {
+        'version': REPORT_VERSION,
+        'wall_seconds': wall,
+        'images': self.images,
+        'video_frames': self.frames,
+        'frames_per_second': (self.images + self.frames) / wall if wall > 0 else 0.0,
+        'boxes_per_image': {
+          'images': len(self.boxes),
+          'mean': float(np.mean(self.boxes)) if self.boxes else 0.0,
+          'max': max(self.boxes, default=0),
+          **percentiles(self.boxes),
+        },
+        'peak_rss_mb': max(peak_rss) if peak_rss else None,
+        'stages_seconds': stages,
+      }
+
+  def stats(self) -> str:
+    summary = self.summary()
+    lines = [
+      f'Processed {summary["images"]} images and {summary["video_frames"]} video frames in '
+      + f'{summary["wall_seconds"]:.2f}s, {summary["frames_per_second"]:.2f} per second',
+      f'{"stage":14} {"count":>7} {"total s":>9} {"p50 s":>8} {"p95 s":>8}',
+    ]
+    for stage, timing in summary['stages_seconds'].items():
+      if timing['count'] > 0:
+        lines.append(
+          f'{stage:14} {timing["count"]:7d} {timing["total"]:9.2f} {timing["p50"]:8.4f} {timing["p95"]:8.4f}'
+        )
+    return '\n'.join(lines)
+
+
+# Timer for the current run in this process
+timer = StageTimer()
+
+
+def write_report(path: str, summary: dict) -> None:
+  print(f'{now()}: Writing run report to {path} ...')
+  folder = os.path.dirname(path)
+  if folder:
+    os.makedirs(folder, exist_ok=True)
+  with open(path, 'w') as f:
+    json.dump(summary, f, indent=2)
@@ -0,0 +1,88 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Processing resolution for large images.
+#
+# With a maximum processing side length set, object detection, segmentation, and joining masks all run on a downscaled
+#  copy of each image, so their cost doesn't grow with the input's megapixels. The foreground supermask is then
+#  upsampled back to the input's resolution with a fast guided filter, which uses the full resolution image as a guide
+#  so that mask edges snap to edges in the image instead of being blocky, and applied to the original image.
+# ref: https://arxiv.org/abs/1505.00996 (Fast Guided Filter)
+#
+
+import cv2
+import numpy as np
+import supervision as sv
+
+# Guided filter window radius, in pixels of the downscaled mask
+GUIDED_FILTER_RADIUS = 4
+# Guided filter regularization, for guide images scaled to [0,1]. Lower values follow image edges more closely
+GUIDED_FILTER_EPS = 1e-3
+
+
+def downscale_to_max_side(image: np.ndarray, max_side: int | None) -> np.ndarray:
+  """
+  Returns a copy of an image downscaled so that its longest side is at most max_side pixels, or the image itself if
+   it's already small enough or max_side is None.
+  """
+  h, w = image.shape[:2]
+  if not max_side or max(h, w) <= max_side:
+    return image
+  scale = max_side / max(h, w)
+  return cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+
+def to_guide(image: np.ndarray) -> np.ndarray:
+  gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+  return gray.astype(np.float32) / 255.0
+
+
+def upsample_mask(mask: np.ndarray, image: np.ndarray) -> np.ndarray:
+  """
+  Upsample a mask made for a downscaled copy of an image to the image's full resolution, using the image as the guide
+   of a fast guided filter.
+
+  mask (np.ndarray): Boolean mask at the downscaled resolution.
+  image (np.ndarray): Full resolution BGR image.
+
+  Returns:
+    np.ndarray: Soft mask at full resolution, uint8 with 255 for foreground.
+  """
+  h, w = image.shape[:2]
+  small_h, small_w = mask.shape[:2]
+  # Filter coefficients are fitted at low resolution, against a guide downscaled the same way as the model input
+  guide = to_guide(cv2.resize(image, (small_w, small_h), interpolation=cv2.INTER_AREA))
+  p = mask.astype(np.float32)
+  ksize = (2 * GUIDED_FILTER_RADIUS + 1,) * 2
+
+  def box(x: np.ndarray) -> np.ndarray:
+    return cv2.boxFilter(x, -1, ksize, borderType=cv2.BORDER_REFLECT)
+
+  mean_i = box(guide)
+  mean_p = box(p)
+  var_i = box(guide * guide) - mean_i * mean_i
+  cov_ip = box(guide * p) - mean_i * mean_p
+  a = cov_ip / (var_i + GUIDED_FILTER_EPS)
+  b = mean_p - a * mean_i
+  # Only the smooth coefficients are upsampled, then applied to the full resolution guide
+  q = cv2.resize(box(a), (w, h), interpolation=cv2.INTER_LINEAR)
+  q *= to_guide(image)
+  q += cv2.resize(box(b), (w, h), interpolation=cv2.INTER_LINEAR)
+  np.clip(q, 0.0, 1.0, out=q)
+  q *= 255.0
+  return (q + 0.5).astype(np.uint8)
+
+
+def upscale_detections(detections: sv.Detections, small_image: np.ndarray, image: np.ndarray) -> sv.Detections:
+  """
+  Scale detection boxes and masks made for a downscaled copy of an image up to the image's full resolution.
+  """
+  h, w = image.shape[:2]
+  small_h, small_w = small_image.shape[:2]
+  scale = np.array([w / small_w, h / small_h, w / small_w, h / small_h], dtype=np.float32)
+  detections.xyxy = (detections.xyxy * scale).astype(np.float32)
+  if detections.mask is not None and len(detections) > 0:
+    detections.mask = np.stack([
+      cv2.resize(mask.astype(np.uint8), (w, h), interpolation=cv2.INTER_NEAREST).astype(bool)
+      for mask in detections.mask
+    ])
+  return detections
@@ -0,0 +1,106 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Resumable video jobs.
+#
+# In resume mode, a small job manifest is kept next to the output video while it's processed, recording the input
+#  video's hash, the options it's processed with, and how many frames are finished. Finished frames are kept either
+#  as temporary image files, or as segment videos of a fixed number of frames each which are joined at the end.
+# When the same job is run again after a crash, processing continues after the last finished frame instead of starting
+#  over. Once the output video is complete the manifest is marked as such, so running the job again skips the video.
+#
+
+import json
+import os
+
+from ezsam.lib.date import now
+from ezsam.lib.hash import file_hash
+
+MANIFEST_VERSION = 1
+
+
+def get_manifest_path(out: str) -> str:
+  return f'{os.path.splitext(out)[0]}.resume.json'
+
+
+class JobManifest:
+  """
+  Progress of processing one input video to one output video.
+
+  path (str): Where the manifest is stored.
+  input_hash (str): Hash of the input video's contents.
+  options (dict): Options that affect the output, which must match to resume.
+  """
+
+  def __init__(self, path: str, input_hash: str, options: dict):
+    self.path = path
+    self.input_hash = input_hash
+    # Round trip through JSON so options compare equal to options loaded from a manifest file
+    self.options = json.loads(json.dumps(options))
+    # Number of output frames finished
+    self.num_frames = 0
+    # Finished segment videos, when frames are streamed to segments
+    self.segments: list[str] = []
+    self.complete = False
+
+  @classmethod
+  def load(cls, out: str, src: str, options: dict) -> 'JobManifest':
+    """
+    Load the manifest for processing src to out, or start a new one if there isn't one for the same input and options.
+    """
+    print(f'{now()}: Hashing {src} to check for an earlier job to resume ...')
+    manifest = cls(get_manifest_path(out), file_hash(src), options)
+    try:
+      with open(manifest.path, 'r') as f:
+        data = json.load(f)
+    except (OSError, ValueError):
+      return manifest
+    if (
+      data.get('version') != MANIFEST_VERSION
+      or data.get('input_hash') != manifest.input_hash
+      or data.get('options') != manifest.options
+    ):
+      print(f'Warning: Input or options changed since the job in {manifest.path}, starting over')
+      remove_files(data.get('segments', []))
+      return manifest
+    segments = data.get('segments', [])
+    if not all(os.path.isfile(segment) for segment in segments):
+      print(f'Warning: Segment videos from the job in {manifest.path} are missing, starting over')
+      return manifest
+    manifest.num_frames = data.get('num_frames', 0)
+    manifest.segments = segments
+    manifest.complete = data.get('complete', False)
+    return manifest
+
+  def save(self) -> None:
+    data = {
+      'version': MANIFEST_VERSION,
+      'input_hash': self.input_hash,
+      'options': self.options,
+      'num_frames': self.num_frames,
+      'segments': self.segments,
+      'complete': self.complete,
+    }
+    # Write to a temporary file first, so that a crash never leaves a partial manifest
+    tmp = f'{self.path}.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(data, f, indent=2)
+    os.replace(tmp, self.path)
+
+  def update(self, num_frames: int, segments: list[str] | None = None) -> None:
+    self.num_frames = num_frames
+    if segments is not None:
+      self.segments = list(segments)
+    self.save()
+
+  def finish(self) -> None:
+    self.complete = True
+    self.segments = []
+    self.save()
+
+
+def remove_files(paths: list[str]) -> None:
+  for path in paths:
+    try:
+      os.remove(path)
+    except OSError:
+      pass
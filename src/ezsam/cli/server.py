@@ -0,0 +1,201 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Persistent local model server.
+#
+# `ezsam serve` starts a long-lived process that keeps loaded models in memory and runs jobs sent to it by later
+#  `ezsam` commands and the GUI, so only the first job pays for loading model checkpoints.
+# Jobs are the command line arguments of an `ezsam` call, run one at a time in the client's working directory.
+#  Logging from each job is streamed back to the client while it runs.
+# The server only listens on localhost, and clients authenticate with a random key that the server writes to a file
+#  in the user's cache folder, readable only by the user.
+#
+
+import argparse
+import contextlib
+import os
+import secrets
+import threading
+from collections import OrderedDict
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Callable
+
+from ezsam.lib.date import now
+from ezsam.cli.config.defaults import (
+  DEFAULT_CACHE_FOLDER_LOCATION,
+  DEFAULT_SERVER_PORT,
+  DEFAULT_SERVER_MAX_MODELS,
+)
+
+SERVER_KEY_PATH = f'{DEFAULT_CACHE_FOLDER_LOCATION}/server.key'
+
+
+class ModelCache:
+  """
+  Keeps loaded models in memory between jobs, keyed by the arguments they were loaded with, i.e. the SAM model type,
+   whether it's SAM-HQ (its checkpoint), and the GroundingDINO config and checkpoint.
+  The least recently used models are unloaded once more than max_models sets of models are loaded.
+  """
+
+  def __init__(self, max_models: int = DEFAULT_SERVER_MAX_MODELS):
+    self.max_models = max(1, max_models)
+    self.models = OrderedDict()
+
+  def get(self, **model_args) -> tuple:
+    """
+    model_args (dict): Arguments to loader.load_models().
+
+    Returns:
+      tuple: Same as loader.load_models().
+    """
+    # Imported here so that sending jobs to the server doesn't import the machine learning libraries
+    from ezsam.lib.gpu import attempt_gpu_cleanup
+    from ezsam.cli.loader import load_models
+
+    # The embedding cache is set per job, so it isn't part of what identifies the models
+    embedding_cache = model_args.pop('embedding_cache', None)
+    key = tuple((name, str(value)) for name, value in sorted(model_args.items()))
+    if key in self.models:
+      print(f'{now()}: Using models already loaded by the server')
+      self.models.move_to_end(key)
+      self.models[key][2].embedding_cache = embedding_cache
+      return self.models[key]
+    while len(self.models) >= self.max_models:
+      _, evicted = self.models.popitem(last=False)
+      print(f'{now()}: Unloading least recently used models ...')
+      del evicted
+      attempt_gpu_cleanup()
+    self.models[key] = load_models(**model_args, embedding_cache=embedding_cache)
+    return self.models[key]
+
+
+class ConnectionWriter:
+  """
+  File-like object that sends text written to it over a connection, used to stream job logging to the client.
+  """
+
+  def __init__(self, conn: Connection):
+    self.conn = conn
+    # Video processing writes from more than one thread
+    self.lock = threading.Lock()
+
+  def write(self, text: str) -> int:
+    if text:
+      with self.lock:
+        self.conn.send(('log', text))
+    return len(text)
+
+  def flush(self) -> None:
+    pass
+
+  def isatty(self) -> bool:
+    return False
+
+
+def read_server_key() -> bytes | None:
+  try:
+    with open(SERVER_KEY_PATH, 'rb') as f:
+      return f.read()
+  except OSError:
+    return None
+
+
+def create_server_key() -> bytes:
+  key = secrets.token_bytes(32)
+  os.makedirs(os.path.dirname(SERVER_KEY_PATH), exist_ok=True)
+  if os.path.exists(SERVER_KEY_PATH):
+    os.remove(SERVER_KEY_PATH)
+  fd = os.open(SERVER_KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+  with os.fdopen(fd, 'wb') as f:
+    f.write(key)
+  return key
+
+
+def send_job(argv: list[str], port: int = DEFAULT_SERVER_PORT) -> list[tuple[str, str]] | None:
+  """
+  Run a job on the local server if one is running, printing its logging as it arrives.
+
+  argv (list[str]): Command line arguments for the job, as passed to app.main().
+  port (int): Port the server listens on.
+
+  Returns:
+    list[tuple[str, str]] | None: Input file and error message for each file that could not be processed,
+     or None if no server is running.
+  """
+  key = read_server_key()
+  if key is None:
+    return None
+  try:
+    conn = Client(('localhost', port), authkey=key)
+  except (ConnectionRefusedError, OSError) as err:
+    if not isinstance(err, ConnectionRefusedError):
+      print(f'Warning: Could not connect to ezsam server on port {port}: {err}')
+    return None
+  print(f'{now()}: Sending job to ezsam server on port {port} ...')
+  with conn:
+    conn.send({'argv': list(argv), 'cwd': os.getcwd()})
+    while True:
+      kind, value = conn.recv()
+      if kind == 'log':
+        print(value, end='', flush=True)
+      elif kind == 'error':
+        raise RuntimeError(f'ezsam server job failed: {value}')
+      else:
+        return value
+
+
+def handle_job(conn: Connection, run: Callable[[list[str], ModelCache], list], model_cache: ModelCache) -> None:
+  job = conn.recv()
+  print(f'{now()}: Running job: ezsam {" ".join(job["argv"])}')
+  writer = ConnectionWriter(conn)
+  cwd = os.getcwd()
+  try:
+    os.chdir(job['cwd'])
+    with contextlib.redirect_stdout(writer), contextlib.redirect_stderr(writer):
+      errors = run(job['argv'], model_cache)
+    conn.send(('done', errors))
+  except (BrokenPipeError, EOFError, ConnectionResetError):
+    print(f'{now()}: Client disconnected before the job finished')
+  except Exception as err:
+    print(f'{now()}: Job failed: {err}')
+    conn.send(('error', f'{err}'))
+  finally:
+    os.chdir(cwd)
+  print(f'{now()}: Finished job')
+
+
+def serve(run: Callable[[list[str], ModelCache], list], port: int, max_models: int) -> None:
+  """
+  Accept and run jobs until interrupted.
+
+  run (Callable): Runs a job given its command line arguments and the model cache, returning errors per input file.
+  port (int): Port to listen on, on localhost only.
+  max_models (int): Maximum number of sets of models to keep loaded.
+  """
+  model_cache = ModelCache(max_models)
+  key = create_server_key()
+  with Listener(('localhost', port), authkey=key) as listener:
+    print(f'{now()}: ezsam server listening on localhost:{port}, press Ctrl+C to stop')
+    try:
+      while True:
+        try:
+          conn = listener.accept()
+        except Exception as err:
+          # i.e. a client with the wrong key
+          print(f'{now()}: Rejected connection: {err}')
+          continue
+        with conn:
+          handle_job(conn, run, model_cache)
+    except KeyboardInterrupt:
+      print(f'{now()}: Stopping ezsam server ...')
+    finally:
+      if read_server_key() == key:
+        os.remove(SERVER_KEY_PATH)
+
+
+def parse_serve_args(argv=None):
+  parser = argparse.ArgumentParser('ezsam serve', add_help=True)
+  # fmt: off
+  parser.add_argument('--port', type=int, default=DEFAULT_SERVER_PORT, help='Port to listen for jobs on, on localhost only')
+  parser.add_argument('--max_models', type=int, default=DEFAULT_SERVER_MAX_MODELS, help='Maximum number of sets of models to keep loaded at once, i.e. SAM and SAM-HQ')
+  # fmt: on
+  return parser.parse_args(argv)
@@ -0,0 +1,121 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Tiled object detection for very high resolution images.
+#
+# GroundingDINO resizes every input to around 800 pixels on its shortest side, so small objects in huge images, i.e.
+#  gigapixel scans or drone orthomosaics, shrink to a few pixels and go undetected. In the style of SAHI, tiled
+#  detection also runs GroundingDINO on overlapping tiles of the image at their full resolution, and maps the tile
+#  detections back to image coordinates. Objects cut off at a tile's edge are left to the neighbouring tile that they
+#  fit inside of, or to a pass over the whole image for objects larger than the tile overlap. The usual NMS step then
+#  merges duplicate detections from overlapping tiles.
+# ref: https://github.com/obss/sahi
+#
+
+import numpy as np
+import supervision as sv
+
+from ezsam.lib.date import now
+from ezsam.cli.detector import predict_with_classes_batch
+
+# Tile detections within this many pixels of a tile edge inside the image are considered cut off
+TILE_EDGE_MARGIN = 2
+
+
+def tile_grid(shape_hw: tuple[int, int], tile_size: int, overlap: float) -> list[tuple[int, int, int, int]]:
+  """
+  Split an image into overlapping square tiles of the same size, the last tile in each row and column being shifted
+   back to end at the image's edge.
+
+  overlap (float): Fraction of the tile size that neighbouring tiles overlap by, from 0 up to but not including 1.
+
+  Returns:
+    list[tuple[int, int, int, int]]: Tiles as (x0, y0, x1, y1).
+  """
+  if tile_size <= 0:
+    raise ValueError(f'Tile size {tile_size} should be a positive number of pixels')
+  if not 0 <= overlap < 1:
+    raise ValueError(f'Tile overlap {overlap} should be from 0 up to but not including 1')
+  h, w = shape_hw
+  stride = max(1, round(tile_size * (1 - overlap)))
+
+  def starts(length: int) -> list[int]:
+    if length <= tile_size:
+      return [0]
+    positions = list(range(0, length - tile_size, stride))
+    return positions + [length - tile_size]
+
+  return [(x0, y0, min(x0 + tile_size, w), min(y0 + tile_size, h)) for y0 in starts(h) for x0 in starts(w)]
+
+
+def inside_tile(xyxy: np.ndarray, tile: tuple[int, int, int, int], shape_hw: tuple[int, int]) -> np.ndarray:
+  """
+  Whether each box, in tile coordinates, stays clear of the tile's edges, except for edges on the image's border.
+  """
+  h, w = shape_hw
+  x0, y0, x1, y1 = tile
+  tile_w, tile_h = x1 - x0, y1 - y0
+  keep = np.ones(len(xyxy), dtype=bool)
+  if x0 > 0:
+    keep &= xyxy[:, 0] > TILE_EDGE_MARGIN
+  if y0 > 0:
+    keep &= xyxy[:, 1] > TILE_EDGE_MARGIN
+  if x1 < w:
+    keep &= xyxy[:, 2] < tile_w - TILE_EDGE_MARGIN
+  if y1 < h:
+    keep &= xyxy[:, 3] < tile_h - TILE_EDGE_MARGIN
+  return keep
+
+
+class TiledDetector:
+  """
+  Wraps a GroundingDINO model (groundingdino.util.inference.Model) so that predict_with_classes() detects objects
+   on the whole image and on overlapping tiles of it, for images larger than the tile size.
+
+  tile_size (int): Side length of the square tiles, in pixels.
+  overlap (float): Fraction of the tile size that neighbouring tiles overlap by.
+  batch_size (int): Number of tiles to run through the model together.
+  """
+
+  def __init__(self, grounding_dino_model, tile_size: int, overlap: float, batch_size: int):
+    self.grounding_dino_model = grounding_dino_model
+    self.tile_size = tile_size
+    self.overlap = overlap
+    self.batch_size = max(1, batch_size)
+
+  def predict_with_classes(
+    self, image: np.ndarray, classes: list[str], box_threshold: float, text_threshold: float
+  ) -> sv.Detections:
+    detect_args = {'classes': classes, 'box_threshold': box_threshold, 'text_threshold': text_threshold}
+    detections = self.grounding_dino_model.predict_with_classes(image=image, **detect_args)
+    h, w = image.shape[:2]
+    if max(h, w) <= self.tile_size:
+      return detections
+    tiles = tile_grid((h, w), self.tile_size, self.overlap)
+    print(f'{now()} Detecting objects in {len(tiles)} tiles ...')
+    merged = [detections]
+    # Only a batch of tiles is preprocessed for the model at a time, tiles themselves are views of the image
+    for start in range(0, len(tiles), self.batch_size):
+      batch = tiles[start : start + self.batch_size]
+      batch_detections = predict_with_classes_batch(
+        grounding_dino_model=self.grounding_dino_model,
+        images=[image[y0:y1, x0:x1] for x0, y0, x1, y1 in batch],
+        batch_size=self.batch_size,
+        **detect_args,
+      )
+      for tile, tile_detections in zip(batch, batch_detections):
+        if len(tile_detections) == 0:
+          continue
+        tile_detections = tile_detections[inside_tile(tile_detections.xyxy, tile, (h, w))]
+        x0, y0 = tile[:2]
+        tile_detections.xyxy = tile_detections.xyxy + np.array([x0, y0, x0, y0], dtype=tile_detections.xyxy.dtype)
+        merged.append(tile_detections)
+    return sv.Detections.merge(merged)
+
+
+def tiling_options(grounding_dino_model) -> dict | None:
+  """
+  Tiling settings of a possibly tiled detector, which affect its detections, or None if it isn't tiled.
+  """
+  if not isinstance(grounding_dino_model, TiledDetector):
+    return None
+  return {'tile_size': grounding_dino_model.tile_size, 'overlap': grounding_dino_model.overlap}
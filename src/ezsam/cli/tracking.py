@@ -0,0 +1,196 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Keyframe object detection for video.
+#
+# Text prompted object detection only runs on keyframes: every N frames, or whenever the scene changes.
+# In between keyframes, the object detection boxes from the previous frame are carried forward using sparse optical
+#  flow (Lucas-Kanade) on a downscaled grayscale copy of each frame, and then used to prompt SAM as normal.
+#
+
+from typing import Callable
+
+import cv2
+import numpy as np
+import supervision as sv
+
+from ezsam.lib.date import now
+
+# Frames are downscaled to fit this size before computing scene changes and optical flow
+TRACKING_MAX_SIDE = 640
+# Minimum number of points that need to be tracked successfully to carry a box forward
+MIN_TRACKED_POINTS = 4
+# Maximum number of feature points to track per box
+MAX_POINTS_PER_BOX = 50
+# Maximum forward-backward optical flow error in pixels (at tracking resolution) for a point to be trusted
+MAX_FB_ERROR = 1.0
+
+LK_PARAMS = {
+  'winSize': (21, 21),
+  'maxLevel': 3,
+  'criteria': (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01),
+}
+
+
+def to_tracking_gray(frame: np.ndarray) -> tuple[np.ndarray, float]:
+  """
+  Returns a downscaled grayscale copy of a BGR frame, and the scale applied to it.
+  """
+  h, w = frame.shape[:2]
+  scale = min(1.0, TRACKING_MAX_SIDE / max(h, w))
+  gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+  if scale < 1.0:
+    gray = cv2.resize(gray, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+  return gray, scale
+
+
+def scene_change(prev_gray: np.ndarray, gray: np.ndarray) -> float:
+  """
+  Cheap scene change metric: mean absolute difference between two grayscale frames, between 0 and 1.
+  """
+  return float(cv2.absdiff(prev_gray, gray).mean()) / 255.0
+
+
+def track_points(prev_gray: np.ndarray, gray: np.ndarray, points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+  """
+  Track points from one frame to the next, checking that each point tracks back to where it started.
+
+  Returns:
+    np.ndarray: New locations of the tracked points.
+    np.ndarray: Whether each point was tracked successfully.
+  """
+  p0 = points.reshape(-1, 1, 2).astype(np.float32)
+  p1, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, p0, None, **LK_PARAMS)
+  p0r, status_r, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, p1, None, **LK_PARAMS)
+  fb_error = np.linalg.norm((p0 - p0r).reshape(-1, 2), axis=1)
+  good = (status.ravel() == 1) & (status_r.ravel() == 1) & (fb_error < MAX_FB_ERROR)
+  return p1.reshape(-1, 2), good
+
+
+def box_points(gray: np.ndarray, box: np.ndarray) -> np.ndarray:
+  """
+  Pick points to track inside a box: strong corners if there are enough of them, otherwise a regular grid.
+  """
+  h, w = gray.shape[:2]
+  x0, y0, x1, y1 = np.clip(np.round(box), 0, [w - 1, h - 1, w - 1, h - 1]).astype(int)
+  mask = np.zeros_like(gray)
+  mask[y0 : y1 + 1, x0 : x1 + 1] = 255
+  corners = cv2.goodFeaturesToTrack(gray, MAX_POINTS_PER_BOX, qualityLevel=0.01, minDistance=3, mask=mask)
+  if corners is not None and len(corners) >= MIN_TRACKED_POINTS:
+    return corners.reshape(-1, 2)
+  n = int(np.sqrt(MAX_POINTS_PER_BOX))
+  xs, ys = np.meshgrid(np.linspace(x0, x1, n), np.linspace(y0, y1, n))
+  return np.stack([xs.ravel(), ys.ravel()], axis=1)
+
+
+def track_box(prev_gray: np.ndarray, gray: np.ndarray, box: np.ndarray) -> np.ndarray | None:
+  """
+  Move a box (in tracking resolution coordinates) from one frame to the next, following the median motion and
+   change in scale of the points tracked inside it. Returns None if the box couldn't be tracked.
+  """
+  p0 = box_points(prev_gray, box)
+  p1, good = track_points(prev_gray, gray, p0)
+  if good.sum() < MIN_TRACKED_POINTS:
+    return None
+  p0, p1 = p0[good], p1[good]
+  c0, c1 = np.median(p0, axis=0), np.median(p1, axis=0)
+  d0 = np.median(np.linalg.norm(p0 - c0, axis=1))
+  d1 = np.median(np.linalg.norm(p1 - c1, axis=1))
+  scale = d1 / d0 if d0 > 0 else 1.0
+  # Box centre follows the points' centre, box size follows their spread
+  centre = (box[:2] + box[2:]) / 2 + (c1 - c0)
+  half = (box[2:] - box[:2]) / 2 * scale
+  return np.concatenate([centre - half, centre + half])
+
+
+def track_detections(
+  prev_gray: np.ndarray,
+  gray: np.ndarray,
+  scale: float,
+  detections: sv.Detections,
+  resolution_wh: tuple[int, int],
+) -> sv.Detections | None:
+  """
+  Carry object detection boxes forward from the previous frame. Returns None if any box was lost.
+  """
+  w, h = resolution_wh
+  xyxy = np.empty_like(detections.xyxy)
+  for i, box in enumerate(detections.xyxy):
+    tracked = track_box(prev_gray, gray, box * scale)
+    if tracked is None:
+      return None
+    xyxy[i] = tracked / scale
+  xyxy = np.clip(xyxy, 0, [w, h, w, h])
+  return sv.Detections(xyxy=xyxy, confidence=detections.confidence, class_id=detections.class_id)
+
+
+class KeyframeDetector:
+  """
+  Returns object detections for each video frame in turn, only running object detection on keyframes.
+
+  detect (Callable): Runs object detection on a frame, returning positive and negative detections.
+   I.e. process.detect_prompts().
+  interval (int): Run object detection at least every interval frames.
+  scene_threshold (float): Also run object detection when the scene change metric from the previous frame
+   goes above this threshold [0,1].
+  """
+
+  def __init__(
+    self,
+    detect: Callable[[np.ndarray], tuple[sv.Detections, sv.Detections | None]],
+    interval: int,
+    scene_threshold: float,
+  ):
+    self.detect = detect
+    self.interval = interval
+    self.scene_threshold = scene_threshold
+    self.prev_gray: np.ndarray = None
+    self.prev_detections: tuple[sv.Detections, sv.Detections | None] = None
+    self.frames_since_keyframe = 0
+    self.num_detected = 0
+    self.num_tracked = 0
+
+  def __call__(self, frame: np.ndarray) -> tuple[sv.Detections, sv.Detections | None]:
+    gray, scale = to_tracking_gray(frame)
+    detections = None
+    if self.prev_gray is not None and self.frames_since_keyframe + 1 < self.interval:
+      change = scene_change(self.prev_gray, gray)
+      if change <= self.scene_threshold:
+        detections = self.track(gray, scale, (frame.shape[1], frame.shape[0]))
+        if detections is None:
+          print(f'{now()} Lost track of object detection boxes, detecting objects again ...')
+      else:
+        print(f'{now()} Scene change {change:.3f} above threshold, detecting objects again ...')
+    if detections is None:
+      detections = self.detect(frame)
+      self.frames_since_keyframe = 0
+      self.num_detected += 1
+    else:
+      self.frames_since_keyframe += 1
+      self.num_tracked += 1
+    self.prev_gray = gray
+    self.prev_detections = detections
+    # SAM masks get attached to the returned detections, so hand out copies
+    return tuple(copy_boxes(d) for d in detections)
+
+  def track(
+    self, gray: np.ndarray, scale: float, resolution_wh: tuple[int, int]
+  ) -> tuple[sv.Detections, sv.Detections | None] | None:
+    tracked = []
+    for detections in self.prev_detections:
+      if detections is None or len(detections) <= 0:
+        tracked.append(detections)
+        continue
+      detections = track_detections(self.prev_gray, gray, scale, detections, resolution_wh)
+      if detections is None:
+        return None
+      tracked.append(detections)
+    return tuple(tracked)
+
+  def stats(self) -> str:
+    return f'Video frames with objects detected: {self.num_detected}, tracked: {self.num_tracked}'
+
+
+def copy_boxes(detections: sv.Detections | None) -> sv.Detections | None:
+  if detections is None:
+    return None
+  return sv.Detections(xyxy=detections.xyxy.copy(), confidence=detections.confidence, class_id=detections.class_id)
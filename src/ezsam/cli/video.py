@@ -0,0 +1,316 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Reading of input video frames, and writers that encode processed video frames to an output video file.
+#
+# By default frames are streamed as raw BGRA pixels into the stdin of an FFmpeg (or ImageMagick for GIFs) process,
+#  so no intermediate image files are written and disk usage doesn't grow with the length of the video.
+# Alternatively frames can be written to temporary image files which are joined into a video at the end.
+# For resumable jobs, frames can also be streamed into a series of segment videos which are joined at the end.
+#
+
+import abc
+import os
+import subprocess as sub
+from typing import Callable, Iterator
+
+import cv2
+import numpy as np
+
+from ezsam.cli.formats import OutputImageFormat, OutputVideoCodec
+from ezsam.cli.report import timer
+
+# Codecs which FFmpeg can't join segments of without re-encoding
+UNJOINABLE_CODECS = [OutputVideoCodec.gif, OutputVideoCodec.apng]
+
+
+def read_video_frames(src: str, start: int = 0, end: int | None = None) -> Iterator[np.ndarray]:
+  """
+  Read the frames of a video from start up to but not including end, or up to the end of the video if end is None.
+  Unlike supervision's get_video_frames_generator(), frames are read until decoding stops rather than up to the frame
+   count in the video's header, which can be an estimate and miss frames at the end.
+  """
+  video = cv2.VideoCapture(src)
+  if not video.isOpened():
+    raise RuntimeError(f'Could not open video {src}')
+  try:
+    if start > 0:
+      video.set(cv2.CAP_PROP_POS_FRAMES, start)
+    position = start
+    while end is None or position < end:
+      success, frame = video.read()
+      if not success:
+        break
+      yield frame
+      position += 1
+  finally:
+    video.release()
+
+
+def get_delay_from_fps(fps):
+  # Get centiseconds delay from frames per second, used as ImageMagick's delay parameter
+  f = fps if (fps is not None and fps != 0) else 1
+  return 100.0 / f
+
+
+def get_ffmpeg_output_args(codec: OutputVideoCodec, out: str) -> list[str]:
+  # ref: https://stackoverflow.com/a/75461590
+  # Note: Software support is iffy for all but gif.
+  # Chrome can display alpha for vp9+webm.
+  # mpv works for the rest.
+  if codec == OutputVideoCodec.prores:
+    args = ['-c:v', 'prores', '-pix_fmt', 'yuva444p10le']
+  elif codec == OutputVideoCodec.vp9:
+    args = ['-c:v', 'libvpx-vp9', '-pix_fmt', 'yuva420p']
+  elif codec == OutputVideoCodec.ffv1:
+    args = ['-c:v', 'ffv1', '-pix_fmt', 'yuva420p']
+  elif codec == OutputVideoCodec.apng:
+    args = ['-c:v', 'apng', '-pix_fmt', 'rgba']
+  else:
+    raise ValueError(f'Invalid codec for FFmpeg: {codec}')
+  return args + [out]
+
+
+def get_gif_args(fps, w: int, h: int, inputs: list[str], out: str) -> list[str]:
+  delay = get_delay_from_fps(fps)
+  return ['convert', '-resize', f'{w}x{h}', '-delay', f'{delay}', '-dispose', 'Background', '-loop', '0'] + inputs + [out]
+
+
+def concat_segments(segments: list[str], out: str) -> None:
+  """
+  Join video segments encoded with the same codec and settings into one video, without re-encoding, using FFmpeg's
+   concat demuxer.
+  """
+  list_path = f'{os.path.splitext(out)[0]}.segments.txt'
+  with open(list_path, 'w') as f:
+    for segment in segments:
+      # Paths are quoted, so escape any quotes in them
+      path = os.path.abspath(segment).replace("'", "'\\''")
+      f.write(f"file '{path}'\n")
+  cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'warning', '-f', 'concat', '-safe', '0', '-i', list_path]
+  cmd += ['-map', '0', '-c', 'copy', out]
+  print(f'Joining video segments via command: {" ".join(cmd)} ...')
+  try:
+    result = sub.run(cmd)
+  finally:
+    os.remove(list_path)
+  if result.returncode != 0:
+    raise RuntimeError(f'Joining video segments failed with code {result.returncode} writing {out}')
+
+
+def get_stream_command(codec: OutputVideoCodec, fps, w: int, h: int, out: str) -> list[str]:
+  """
+  Command to encode a stream of raw BGRA frames of size (w, h) read from stdin to the output video file.
+  """
+  if codec == OutputVideoCodec.gif:
+    # ImageMagick splits a raw pixel stream into frames using the size and depth specified before the input
+    return get_gif_args(fps, w, h, ['-size', f'{w}x{h}', '-depth', '8', 'bgra:-'], out)
+  cmd_in = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'warning']
+  cmd_in += ['-f', 'rawvideo', '-pix_fmt', 'bgra', '-s', f'{w}x{h}', '-framerate', f'{fps}', '-i', '-']
+  return cmd_in + get_ffmpeg_output_args(codec, out)
+
+
+class FrameWriter(abc.ABC):
+  """
+  Writes processed frames in order to an output video. Use as a context manager, or call close() when done.
+  """
+
+  def __init__(self, out: str, codec: OutputVideoCodec, fps, resolution_wh: tuple[int, int]):
+    self.out = out
+    self.codec = codec
+    self.fps = fps
+    (self.w, self.h) = resolution_wh
+    self.num_frames = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      with timer.stage('write'):
+        self.close()
+    else:
+      self.abort()
+
+  @abc.abstractmethod
+  def write(self, frame: np.ndarray) -> None:
+    pass
+
+  @abc.abstractmethod
+  def close(self) -> None:
+    pass
+
+  def abort(self) -> None:
+    # Clean up after an error, without needing to finish writing the output video
+    pass
+
+
+class StreamingFrameWriter(FrameWriter):
+  """
+  Pipes raw BGRA frames straight into the stdin of the video encoder as they're written.
+  """
+
+  def __init__(self, out: str, codec: OutputVideoCodec, fps, resolution_wh: tuple[int, int]):
+    super().__init__(out, codec, fps, resolution_wh)
+    cmd = get_stream_command(codec, fps, self.w, self.h, out)
+    print(f'Streaming video frames to command: {" ".join(cmd)} ...')
+    self.process = sub.Popen(cmd, stdin=sub.PIPE)
+
+  def write(self, frame: np.ndarray) -> None:
+    # Debug mode frames and unfiltered frames don't have an alpha channel
+    if frame.ndim == 2 or frame.shape[2] == 3:
+      frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGRA if frame.ndim == 2 else cv2.COLOR_BGR2BGRA)
+    if frame.shape != (self.h, self.w, 4) or frame.dtype != np.uint8:
+      raise ValueError(f'Frame of shape {frame.shape} and type {frame.dtype} does not match video {self.w}x{self.h}')
+    try:
+      self.process.stdin.write(np.ascontiguousarray(frame).data)
+    except BrokenPipeError as err:
+      raise RuntimeError(f'Video encoder exited early with code {self.process.poll()} writing {self.out}') from err
+    self.num_frames += 1
+
+  def close(self) -> None:
+    self.process.stdin.close()
+    returncode = self.process.wait()
+    if returncode != 0:
+      raise RuntimeError(f'Video encoder failed with code {returncode} writing {self.out}')
+
+  def abort(self) -> None:
+    self.process.kill()
+    self.process.wait()
+
+
+class SegmentedFrameWriter(FrameWriter):
+  """
+  Streams frames into a series of segment videos with up to segment_frames frames each, which are joined into the
+   output video on close. Finished segments are kept on abort, so that processing can resume after them.
+
+  segments (list[str]): Segment videos finished earlier, to continue after.
+  on_segment (Callable): Called with the total number of frames and the list of segments each time a segment is done.
+  """
+
+  def __init__(
+    self,
+    out: str,
+    codec: OutputVideoCodec,
+    fps,
+    resolution_wh: tuple[int, int],
+    segments: list[str],
+    num_frames: int,
+    segment_frames: int,
+    on_segment: Callable[[int, list[str]], None],
+    cleanup: bool,
+  ):
+    super().__init__(out, codec, fps, resolution_wh)
+    self.segments = list(segments)
+    self.num_frames = num_frames
+    self.segment_frames = segment_frames
+    self.on_segment = on_segment
+    self.cleanup = cleanup
+    self.writer: StreamingFrameWriter | None = None
+
+  def segment_path(self, i: int) -> str:
+    base, ext = os.path.splitext(self.out)
+    return f'{base}.segment{i:05d}{ext}'
+
+  def write(self, frame: np.ndarray) -> None:
+    if self.writer is None:
+      path = self.segment_path(len(self.segments))
+      self.writer = StreamingFrameWriter(out=path, codec=self.codec, fps=self.fps, resolution_wh=(self.w, self.h))
+    self.writer.write(frame)
+    self.num_frames += 1
+    if self.writer.num_frames >= self.segment_frames:
+      self.finish_segment()
+
+  def finish_segment(self) -> None:
+    self.writer.close()
+    self.segments.append(self.writer.out)
+    self.writer = None
+    self.on_segment(self.num_frames, self.segments)
+
+  def close(self) -> None:
+    if self.writer is not None:
+      self.finish_segment()
+    concat_segments(self.segments, self.out)
+    if self.cleanup:
+      for segment in self.segments:
+        os.remove(segment)
+
+  def abort(self) -> None:
+    if self.writer is not None:
+      # Partial segments can't be resumed from
+      self.writer.abort()
+      if os.path.isfile(self.writer.out):
+        os.remove(self.writer.out)
+      self.writer = None
+
+
+class TempFileFrameWriter(FrameWriter):
+  """
+  Writes frames to temporary image files, which are joined into a video using FFmpeg or ImageMagick on close.
+  """
+
+  def __init__(
+    self,
+    out: str,
+    codec: OutputVideoCodec,
+    fps,
+    resolution_wh: tuple[int, int],
+    tmp_prefix: str,
+    img_fmt: OutputImageFormat,
+    num_digits: int,
+    cleanup: bool,
+    # Number of frames already written to temporary files, i.e. by an earlier job that is being resumed
+    num_frames: int = 0,
+    # Keep temporary files on abort, so that a resumed job can continue after them
+    keep_on_abort: bool = False,
+  ):
+    super().__init__(out, codec, fps, resolution_wh)
+    self.tmp_prefix = tmp_prefix
+    self.img_fmt = img_fmt
+    self.num_digits = num_digits
+    self.cleanup = cleanup
+    self.keep_on_abort = keep_on_abort
+    self.num_frames = num_frames
+    self.tmp_files: list[str] = [self.tmp_file(i) for i in range(num_frames)]
+
+  def tmp_file(self, i: int) -> str:
+    # Pad counter to num_digits
+    i_pad = str(i).zfill(self.num_digits)
+    return f'{self.tmp_prefix}.{i_pad}.tmp.{self.img_fmt}'
+
+  def write(self, frame: np.ndarray) -> None:
+    tmp = self.tmp_file(self.num_frames)
+    self.num_frames += 1
+    print(f'Writing frame {self.num_frames} to {tmp} ...')
+    cv2.imwrite(tmp, frame)
+    self.tmp_files.append(tmp)
+
+  def close(self) -> None:
+    # Join temporary processed images into video using either FFmpeg or ImageMagick's convert
+    if self.codec == OutputVideoCodec.gif:
+      tmp_img_naming = f'{self.tmp_prefix}.*.tmp.{self.img_fmt}'
+      cmd = get_gif_args(self.fps, self.w, self.h, [tmp_img_naming], self.out)
+    else:
+      tmp_img_naming = f'{self.tmp_prefix}.%0{self.num_digits}d.tmp.{self.img_fmt}'
+      cmd_in = ['ffmpeg', '-y', '-framerate', f'{self.fps}', '-i', tmp_img_naming]
+      cmd = cmd_in + get_ffmpeg_output_args(self.codec, self.out)
+    print(f'Joining video frames via command: {" ".join(cmd)} ...')
+    result = sub.run(cmd)
+    if result.returncode != 0:
+      # Temporary images of a resumable job are kept, so that joining them can be retried
+      self.abort()
+      raise RuntimeError(f'Joining video frames failed with code {result.returncode} writing {self.out}')
+    if self.cleanup:
+      self.remove_tmp_files()
+
+  def abort(self) -> None:
+    if self.cleanup and not self.keep_on_abort:
+      self.remove_tmp_files()
+
+  def remove_tmp_files(self) -> None:
+    for tmp in self.tmp_files:
+      try:
+        print(f'Deleting temp file: {tmp} ...')
+        os.remove(tmp)
+      except Exception as err:
+        print(f'Error deleting temporary image file {tmp}')
+        print(f'{err}')
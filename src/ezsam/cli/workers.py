@@ -0,0 +1,113 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# Process many input files, or chunks of a long video, in parallel using a pool of worker processes.
+#
+# Each worker process limits PyTorch to its share of the CPU cores, loads its own copy of the models once for its first
+#  job, and takes files to process one at a time from a queue shared with the other workers.
+#
+
+import multiprocessing
+import os
+import sys
+
+import torch
+import tqdm
+
+from ezsam.lib.date import now
+from ezsam.cli.loader import load_models
+from ezsam.cli.process import process_file
+from ezsam.cli.report import timer
+
+# Models and predictor loaded in this worker process
+_worker_models = {}
+# Arguments to load the models with, and the error if loading them failed
+_worker_state = {'model_args': None, 'load_error': None}
+
+
+def init_worker(model_args: dict, num_threads: int, quiet: bool):
+  if quiet:
+    # Per file logging and progress bars from many processes at once just bury the combined progress bar.
+    # Errors are still reported back to the main process.
+    sys.stdout = open(os.devnull, 'w')
+    sys.stderr = sys.stdout
+  torch.set_num_threads(num_threads)
+  # Models are loaded by the first job instead of here, since a pool replaces workers whose initializer fails
+  #  over and over, without ever reporting the error
+  _worker_state['model_args'] = model_args
+
+
+def get_worker_models() -> dict:
+  """
+  Load the models for this worker process on first use. If loading fails, the error is raised again for every
+   later job instead of trying again.
+  """
+  if _worker_state['load_error'] is not None:
+    raise RuntimeError(_worker_state['load_error'])
+  if not _worker_models:
+    try:
+      grounding_dino_model, sam, sam_predictor = load_models(**_worker_state['model_args'])
+    except Exception as err:
+      _worker_state['load_error'] = f'Could not load models: {err}'
+      raise RuntimeError(_worker_state['load_error']) from err
+    _worker_models['grounding_dino_model'] = grounding_dino_model
+    _worker_models['sam'] = sam
+    _worker_models['sam_predictor'] = sam_predictor
+  return _worker_models
+
+
+def run_job(process_file_args: dict) -> tuple[str, str | None, dict]:
+  """
+  Returns:
+    str: The input file processed.
+    str | None: Error message if the file could not be processed.
+    dict: Stage timings for the job, see report.py.
+  """
+  src = process_file_args['src']
+  timer.reset()
+  try:
+    models = get_worker_models()
+    with torch.no_grad():
+      process_file(
+        sam_predictor=models['sam_predictor'],
+        grounding_dino_model=models['grounding_dino_model'],
+        **process_file_args,
+      )
+    return src, None, timer.snapshot()
+  except Exception as err:
+    return src, f'{err}', timer.snapshot()
+
+
+def get_threads_per_worker(workers: int) -> int:
+  return max(1, (os.cpu_count() or 1) // workers)
+
+
+def process_jobs_in_workers(
+  jobs: list[dict],
+  model_args: dict,
+  workers: int,
+  quiet: bool = True,
+) -> list[tuple[str, str]]:
+  """
+  Process jobs, which can be whole files or chunks of videos, using a pool of worker processes, showing combined
+   progress for all the workers.
+
+  jobs (list[dict]): Arguments to process.process_file() for each job, except the models.
+  model_args (dict): Arguments to loader.load_models().
+  workers (int): Number of worker processes.
+  quiet (bool): Hide logging from the worker processes.
+
+  Returns:
+    list[tuple[str, str]]: Input file and error message for each job that failed.
+  """
+  num_threads = get_threads_per_worker(workers)
+  print(f'{now()}: Starting {workers} worker processes with {num_threads} threads each ...')
+  # Spawn fresh processes instead of forking, since PyTorch and CUDA state can't be safely shared with forked processes
+  context = multiprocessing.get_context('spawn')
+  errors = []
+  with context.Pool(workers, initializer=init_worker, initargs=(model_args, num_threads, quiet)) as pool:
+    for src, err, timings in tqdm.tqdm(pool.imap_unordered(run_job, jobs), total=len(jobs)):
+      # Timings from the workers add up in the main process's timer
+      timer.merge(timings)
+      if err is not None:
+        errors.append((src, err))
+  return errors
@@ -1,3 +1,4 @@
+import os
 import sys
 import threading
 import tkinter as tk
@@ -9,7 +10,6 @@ import tkinterdnd2 as dnd
 from ezsam.lib.logger import debug, log
 from ezsam.lib.tkutils import create_required_stringvars
 from ezsam.lib.path import resource_path
-from ezsam.lib.preview import get_preview_image
 from ezsam.gui.config import (
   DEFAULT_DEBUG,
   DEFAULT_MODEL,
@@ -19,6 +19,7 @@ from ezsam.gui.config import (
   PREVIEW_HEIGHT,
   APPEARANCE_MODE,
   COLOR_THEME,
+  EXIT_AFTER_STARTUP_ENV,
 )
 from ezsam.gui.models import HQ_MODEL_PREFIX, MODEL_NAME_TO_TYPE
 
@@ -158,6 +159,9 @@ class App(ctk.CTk, dnd.TkinterDnD.DnDWrapper):
     self.path_label.configure(text=path)
     self.place_path_label()
     try:
+      # OpenCV is only needed once there's something to preview, so it doesn't slow down opening the window
+      from ezsam.lib.preview import get_preview_image
+
       preview_image: pil.Image.Image = get_preview_image(path, App.PREVIEW_WIDTH, App.PREVIEW_HEIGHT)
       ctk_preview = ctk.CTkImage(dark_image=preview_image, size=(App.PREVIEW_WIDTH, App.PREVIEW_HEIGHT))
       self.preview.configure(text='')
@@ -170,6 +174,11 @@ def main(argv=None):
   ctk.set_appearance_mode(APPEARANCE_MODE)
   ctk.set_default_color_theme(resource_path(COLOR_THEME))
   app = App()
+  if os.environ.get(EXIT_AFTER_STARTUP_ENV):
+    # Show the first window and exit, to time startup, see benchmarks/startup.py
+    app.update()
+    app.quit()
+    return
   app.start()
 
 
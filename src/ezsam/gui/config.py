@@ -7,3 +7,6 @@ COLOR_THEME = 'src/ezsam/gui/assets/theme.json'  # 'blue'
 
 DEFAULT_MODEL = 'SAM Large'
 DEFAULT_DEBUG = False
+
+# Environment variable that makes the app exit once its first window is shown
+EXIT_AFTER_STARTUP_ENV = 'EZSAM_EXIT_AFTER_STARTUP'
@@ -0,0 +1,24 @@
+import hashlib
+
+import numpy as np
+
+
+def image_hash(image: np.ndarray) -> str:
+  """
+  Return a hex digest identifying an image's contents, including its shape and data type.
+  """
+  h = hashlib.blake2b(digest_size=16)
+  h.update(f'{image.shape}{image.dtype}'.encode())
+  h.update(memoryview(np.ascontiguousarray(image)).cast('B'))
+  return h.hexdigest()
+
+
+def file_hash(path: str, block_size: int = 2**20) -> str:
+  """
+  Return a hex digest identifying a file's contents.
+  """
+  h = hashlib.blake2b(digest_size=16)
+  with open(path, 'rb') as f:
+    while block := f.read(block_size):
+      h.update(block)
+  return h.hexdigest()
@@ -0,0 +1,62 @@
+# Metrics for comparing foreground masks.
+
+import cv2
+import numpy as np
+
+# Default boundary F-measure distance tolerance, as a fraction of the image diagonal, same as the DAVIS benchmark
+BOUNDARY_TOLERANCE = 0.008
+
+
+def mask_iou(a: np.ndarray | None, b: np.ndarray | None) -> float:
+  """
+  Intersection over union of two boolean masks. None is an empty mask, and two empty masks match perfectly.
+  """
+  if a is None and b is None:
+    return 1.0
+  if a is None or b is None:
+    # Only matches if the other mask is empty too
+    return 0.0 if (a if a is not None else b).any() else 1.0
+  union = np.logical_or(a, b).sum()
+  if union == 0:
+    return 1.0
+  return float(np.logical_and(a, b).sum() / union)
+
+
+def mask_boundary(mask: np.ndarray) -> np.ndarray:
+  """
+  Pixels of a boolean mask that are next to a pixel outside of it. The edges of the image aren't a boundary.
+  """
+  mask = mask.astype(np.uint8)
+  return (mask - cv2.erode(mask, np.ones((3, 3), dtype=np.uint8))) > 0
+
+
+def boundary_f(a: np.ndarray | None, b: np.ndarray | None, tolerance: int | None = None) -> float:
+  """
+  Boundary F-measure of two boolean masks, as used by the DAVIS video segmentation benchmark.
+  Precision and recall are the fractions of each mask's boundary pixels within tolerance pixels of the other mask's
+   boundary. Unlike IoU, errors along the edges of large objects aren't hidden by their area.
+  None is an empty mask, and two masks without boundaries match perfectly.
+
+  tolerance (int | None): Distance in pixels. Defaults to BOUNDARY_TOLERANCE times the image diagonal.
+  """
+  if a is None and b is None:
+    return 1.0
+  shape = (a if a is not None else b).shape[:2]
+  boundary_a = mask_boundary(a) if a is not None else np.zeros(shape, dtype=bool)
+  boundary_b = mask_boundary(b) if b is not None else np.zeros(shape, dtype=bool)
+  count_a = boundary_a.sum()
+  count_b = boundary_b.sum()
+  if count_a == 0 and count_b == 0:
+    return 1.0
+  if count_a == 0 or count_b == 0:
+    return 0.0
+  if tolerance is None:
+    tolerance = max(1, round(BOUNDARY_TOLERANCE * np.hypot(*shape)))
+  kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * tolerance + 1, 2 * tolerance + 1))
+  near_a = cv2.dilate(boundary_a.astype(np.uint8), kernel) > 0
+  near_b = cv2.dilate(boundary_b.astype(np.uint8), kernel) > 0
+  precision = np.logical_and(boundary_a, near_b).sum() / count_a
+  recall = np.logical_and(boundary_b, near_a).sum() / count_b
+  if precision + recall == 0:
+    return 0.0
+  return float(2 * precision * recall / (precision + recall))
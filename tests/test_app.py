@@ -0,0 +1,33 @@
+import pytest
+
+from ezsam.cli.app import parse_args
+
+
+def parse(*args: str):
+  return parse_args(['image.jpg', '-p', 'car', *args])
+
+
+def test_tile_and_resolution_args():
+  args = parse('--tile_size', '512', '--tile_overlap', '0', '--max_side', '1024')
+  assert (args.tile_size, args.tile_overlap, args.max_side) == (512, 0, 1024)
+  assert parse('--tile_overlap', '0.99').tile_overlap == 0.99
+  args = parse()
+  assert (args.tile_size, args.max_side) == (None, None)
+
+
+@pytest.mark.parametrize(
+  'args',
+  [
+    ['--tile_overlap', '1'],
+    ['--tile_overlap', '-0.1'],
+    ['--tile_overlap', 'half'],
+    ['--tile_size', '0'],
+    ['--tile_size', '-512'],
+    ['--tile_size', '512.5'],
+    ['--max_side', '0'],
+    ['--max_side', '-1024'],
+  ],
+)
+def test_invalid_tile_and_resolution_args(args):
+  with pytest.raises(SystemExit):
+    parse(*args)
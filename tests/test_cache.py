@@ -0,0 +1,123 @@
+import os
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import segment_anything_hq as samhq
+import torch
+
+from ezsam.cli.cache import EmbeddingCache, ResultCache, evict_lru
+
+
+def random_mask(shape: tuple[int, int], seed: int = 0) -> np.ndarray:
+  return np.random.default_rng(seed).random(shape) > 0.5
+
+
+def test_result_cache_round_trip(tmp_path):
+  cache = ResultCache(model_id='model', folder=str(tmp_path))
+  image = np.zeros((5, 7, 3), dtype=np.uint8)
+  # Not a multiple of 8 pixels, so the packed bits are padded
+  supermask = random_mask((5, 7))
+  key = cache.key(image, prompts=['car'])
+  assert cache.get(key) == (False, None)
+  cache.put(key, supermask)
+  hit, cached = cache.get(key)
+  assert hit
+  assert cached.dtype == bool
+  np.testing.assert_array_equal(cached, supermask)
+  assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_result_cache_nothing_detected(tmp_path):
+  cache = ResultCache(model_id='model', folder=str(tmp_path))
+  key = cache.key(np.zeros((4, 4, 3), dtype=np.uint8), prompts=['car'])
+  cache.put(key, None)
+  assert cache.get(key) == (True, None)
+
+
+def test_result_cache_key(tmp_path):
+  cache = ResultCache(model_id='model', folder=str(tmp_path))
+  image = np.zeros((4, 4, 3), dtype=np.uint8)
+  other_image = image.copy()
+  other_image[0, 0, 0] = 1
+  key = cache.key(image, prompts=['car'], box_threshold=0.3)
+  assert key == cache.key(image.copy(), box_threshold=0.3, prompts=['car'])
+  assert key != cache.key(other_image, prompts=['car'], box_threshold=0.3)
+  assert key != cache.key(image, prompts=['car'], box_threshold=0.35)
+  assert key != ResultCache(model_id='other', folder=str(tmp_path)).key(image, prompts=['car'], box_threshold=0.3)
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+  cache = ResultCache(model_id='model', folder=str(tmp_path), max_mb=1)
+  image = np.zeros((4, 4, 3), dtype=np.uint8)
+  # Random masks don't compress, so each entry is around 0.4 MB
+  keys = [cache.key(image, prompts=[f'{i}']) for i in range(3)]
+  cache.put(keys[0], random_mask((1800, 1800), seed=0))
+  cache.put(keys[1], random_mask((1800, 1800), seed=1))
+  old = time.time() - 100
+  os.utime(cache.path(keys[0]), (old, old))
+  os.utime(cache.path(keys[1]), (old + 1, old + 1))
+  # Using the first entry makes the second one the least recently used
+  assert cache.get(keys[0])[0]
+  cache.put(keys[2], random_mask((1800, 1800), seed=2))
+  assert cache.get(keys[0])[0]
+  assert not cache.get(keys[1])[0]
+  assert cache.get(keys[2])[0]
+
+
+def test_evict_lru(tmp_path):
+  folder = tmp_path / 'ab'
+  folder.mkdir()
+  for i in range(5):
+    path = folder / f'{i}.npz'
+    path.write_bytes(b'x' * 100)
+    os.utime(path, (1000 + i, 1000 + i))
+  # Under the limit, nothing is deleted
+  assert evict_lru(str(tmp_path), 500) == 500
+  # Over the limit, the oldest entries are deleted until at most 90% of the limit is left
+  assert evict_lru(str(tmp_path), 400) == 300
+  assert sorted(os.listdir(folder)) == ['2.npz', '3.npz', '4.npz']
+
+
+def test_embedding_cache_round_trip(tmp_path):
+  cache = EmbeddingCache(model_id='model', folder=str(tmp_path))
+  predictor = SimpleNamespace(
+    device=torch.device('cpu'),
+    features=torch.randn(1, 4, 8, 8),
+    interm_features=[torch.randn(1, 8, 8, 2), torch.randn(1, 8, 8, 2)],
+    original_size=(30, 40),
+    input_size=(24, 32),
+  )
+  key = cache.key('BGR:image', 32)
+  cache.save(key, predictor)
+  loaded = SimpleNamespace(device=torch.device('cpu'), reset_image=lambda: None)
+  assert cache.load(key, loaded)
+  assert loaded.is_image_set
+  assert loaded.original_size == (30, 40)
+  assert loaded.input_size == (24, 32)
+  assert torch.equal(loaded.features, predictor.features)
+  # Only the intermediate embedding that the SAM-HQ mask decoder uses is kept
+  assert len(loaded.interm_features) == 1
+  assert torch.equal(loaded.interm_features[0], predictor.interm_features[0])
+  assert sorted(os.listdir(cache.path(key))) == ['features.npy', 'interm.0.npy', 'meta.json']
+  assert not cache.load(cache.key('BGR:other', 32), loaded)
+
+
+def test_embedding_cache_predictions(tmp_path):
+  torch.manual_seed(0)
+  sam = samhq.sam_model_registry['vit_tiny']().eval()
+  image = np.random.default_rng(0).integers(0, 256, (120, 160, 3), dtype=np.uint8)
+  box = np.array([10, 10, 120, 100])
+  cache = EmbeddingCache(model_id='model', folder=str(tmp_path))
+  key = cache.key('BGR:image', 1024)
+  with torch.no_grad():
+    predictor = samhq.SamPredictor(sam)
+    predictor.set_image(image, 'BGR')
+    expected = predictor.predict(box=box)
+    cache.save(key, predictor)
+    loaded = samhq.SamPredictor(sam)
+    assert cache.load(key, loaded)
+    masks, scores, logits = loaded.predict(box=box)
+  np.testing.assert_array_equal(masks, expected[0])
+  np.testing.assert_allclose(scores, expected[1], atol=1e-5)
+  np.testing.assert_allclose(logits, expected[2], atol=1e-5)
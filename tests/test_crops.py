@@ -0,0 +1,87 @@
+import numpy as np
+
+from ezsam.cli.crops import CROP_MIN_PADDING, cluster_boxes, crops_worthwhile, pad_boxes
+
+SHAPE_HW = (1000, 2000)
+
+
+def boxes(*xyxy) -> np.ndarray:
+  return np.array(xyxy, dtype=np.float32)
+
+
+def sorted_clusters(clusters) -> list[tuple[list[int], list[int]]]:
+  return sorted((sorted(indices), box.tolist()) for box, indices in clusters)
+
+
+def test_pad_boxes():
+  # 100 px boxes get 20% padding, small boxes the minimum padding, and padding stops at the image's edges
+  padded = pad_boxes(boxes([500, 500, 600, 600], [100.5, 100.5, 110.5, 120.5], [5, 5, 1990, 995]), SHAPE_HW)
+  np.testing.assert_array_equal(padded[0], [480, 480, 620, 620])
+  # Rounded out to whole pixels
+  pad = CROP_MIN_PADDING
+  np.testing.assert_array_equal(padded[1], [np.floor(100.5 - pad), np.floor(100.5 - pad), 127, 137])
+  np.testing.assert_array_equal(padded[2], [0, 0, 2000, 1000])
+
+
+def test_cluster_boxes_disjoint():
+  clusters = cluster_boxes(boxes([100, 100, 200, 200], [1000, 500, 1100, 600]), SHAPE_HW)
+  assert sorted_clusters(clusters) == [([0], [80, 80, 220, 220]), ([1], [980, 480, 1120, 620])]
+
+
+def test_cluster_boxes_overlapping():
+  # Boxes 0 and 1 only overlap once padded, box 2 is on its own
+  clusters = cluster_boxes(boxes([100, 100, 200, 200], [230, 120, 330, 220], [1500, 100, 1600, 200]), SHAPE_HW)
+  assert sorted_clusters(clusters) == [([0, 1], [80, 80, 350, 240]), ([2], [1480, 80, 1620, 220])]
+
+
+def test_cluster_boxes_merges_chains():
+  # 0 overlaps 1 and 1 overlaps 2, but 0 and 2 are apart: all three end up in one crop
+  xyxy = boxes([100, 100, 200, 200], [230, 100, 330, 200], [360, 100, 460, 200])
+  clusters = cluster_boxes(xyxy, SHAPE_HW)
+  assert sorted_clusters(clusters) == [([0, 1, 2], [80, 80, 480, 220])]
+
+
+def test_cluster_boxes_merged_crop_overlaps_another():
+  # Merging 0 and 1 makes a crop large enough to overlap box 2, which neither overlapped on its own
+  xyxy = boxes([100, 100, 200, 200], [200, 210, 300, 310], [280, 110, 300, 130])
+  assert len(cluster_boxes(xyxy[[0, 2]], SHAPE_HW)) == 2
+  assert len(cluster_boxes(xyxy[[1, 2]], SHAPE_HW)) == 2
+  clusters = cluster_boxes(xyxy, SHAPE_HW)
+  assert sorted_clusters(clusters) == [([0, 1, 2], [80, 80, 320, 330])]
+
+
+def test_cluster_boxes_covers_all_boxes():
+  rng = np.random.default_rng(0)
+  x0 = rng.uniform(0, 1900, 30)
+  y0 = rng.uniform(0, 900, 30)
+  xyxy = np.stack([x0, y0, x0 + rng.uniform(5, 100, 30), y0 + rng.uniform(5, 100, 30)], axis=1).astype(np.float32)
+  clusters = cluster_boxes(xyxy, SHAPE_HW)
+  indices = sorted(i for _, cluster_indices in clusters for i in cluster_indices)
+  assert indices == list(range(30))
+  for box, cluster_indices in clusters:
+    # Each crop contains its boxes
+    assert (xyxy[cluster_indices, :2] >= box[:2]).all()
+    assert (xyxy[cluster_indices, 2:] <= box[2:]).all()
+  # No two crops overlap
+  for a in range(len(clusters)):
+    for b in range(a + 1, len(clusters)):
+      box_a, box_b = clusters[a][0], clusters[b][0]
+      assert not (box_a[0] < box_b[2] and box_b[0] < box_a[2] and box_a[1] < box_b[3] and box_b[1] < box_a[3])
+
+
+def test_cluster_boxes_empty():
+  assert cluster_boxes(np.empty((0, 4), dtype=np.float32), SHAPE_HW) == []
+
+
+def test_crops_worthwhile():
+  small_objects = cluster_boxes(boxes([100, 100, 200, 200], [1500, 700, 1600, 800]), SHAPE_HW)
+  assert crops_worthwhile(small_objects, SHAPE_HW, target_length=1024)
+  # Not for images SAM doesn't downscale
+  assert not crops_worthwhile(small_objects, (1000, 1000), target_length=1024)
+  # Not when crops cover most of the image
+  large_object = cluster_boxes(boxes([100, 100, 1800, 900]), SHAPE_HW)
+  assert not crops_worthwhile(large_object, SHAPE_HW, target_length=1024)
+  # Not for many crops, each of which runs the image encoder
+  many = cluster_boxes(boxes(*[[x, 100, x + 20, 120] for x in range(0, 2000, 200)]), SHAPE_HW)
+  assert len(many) == 10
+  assert not crops_worthwhile(many, SHAPE_HW, target_length=1024)
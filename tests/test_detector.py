@@ -0,0 +1,104 @@
+import groundingdino.util.inference as gd
+import numpy as np
+import pytest
+import torch
+
+from ezsam.cli.detector import predict_with_classes_batch
+
+CLASSES = ['car', 'person', 'red bike']
+NUM_QUERIES = 50
+MAX_TEXT_LEN = 256
+
+
+class WordTokenizer:
+  """
+  Stand-in for GroundingDINO's BERT tokenizer, with one token per word, using BERT's [CLS], [SEP], and '.' ids.
+  """
+
+  special = {101: '[CLS]', 102: '[SEP]', 1012: '.'}
+
+  def __init__(self):
+    self.ids = {}
+    self.words = dict(self.special)
+
+  def token_id(self, word: str) -> int:
+    if word == '.':
+      return 1012
+    if word not in self.ids:
+      self.ids[word] = 2000 + len(self.ids)
+      self.words[self.ids[word]] = word
+    return self.ids[word]
+
+  def __call__(self, caption: str) -> dict:
+    words = caption.replace('.', ' . ').split()
+    return {'input_ids': [101] + [self.token_id(word) for word in words] + [102]}
+
+  def decode(self, token_ids: list[int]) -> str:
+    return ' '.join(self.words[i] for i in token_ids)
+
+
+class StubGroundingDINO(torch.nn.Module):
+  """
+  Deterministic stand-in for the GroundingDINO model, whose outputs for each image only depend on that image.
+  """
+
+  def __init__(self):
+    super().__init__()
+    self.tokenizer = WordTokenizer()
+    generator = torch.Generator().manual_seed(0)
+    features = 3 * 4 * 4
+    self.logit_weights = torch.nn.Parameter(torch.randn(features, NUM_QUERIES * MAX_TEXT_LEN, generator=generator))
+    self.box_weights = torch.nn.Parameter(torch.randn(features, NUM_QUERIES * 4, generator=generator))
+
+  def forward(self, samples: torch.Tensor, captions: list[str]) -> dict:
+    features = torch.nn.functional.adaptive_avg_pool2d(samples, 4).flatten(1)
+    logits = (features @ self.logit_weights).reshape(-1, NUM_QUERIES, MAX_TEXT_LEN)
+    # Tokens past the end of the caption never match, same as the real model
+    num_tokens = len(self.tokenizer(captions[0])['input_ids'])
+    logits[:, :, num_tokens:] = -float('inf')
+    boxes = torch.sigmoid(features @ self.box_weights).reshape(-1, NUM_QUERIES, 4) * 0.5 + 0.25
+    return {'pred_logits': logits, 'pred_boxes': boxes}
+
+
+@pytest.fixture
+def grounding_dino_model():
+  model = gd.Model.__new__(gd.Model)
+  model.model = StubGroundingDINO().eval()
+  model.device = 'cpu'
+  return model
+
+
+def make_images() -> list[np.ndarray]:
+  rng = np.random.default_rng(0)
+  # Two sizes, which are batched separately
+  sizes = [(120, 160), (120, 160), (200, 100), (120, 160), (200, 100)]
+  return [rng.integers(0, 256, (h, w, 3), dtype=np.uint8) for h, w in sizes]
+
+
+@pytest.mark.parametrize('batch_size', [2, 4])
+def test_predict_with_classes_batch_matches_single_images(grounding_dino_model, batch_size):
+  images = make_images()
+  batched = predict_with_classes_batch(
+    grounding_dino_model, images, CLASSES, box_threshold=0.5, text_threshold=0.5, batch_size=batch_size
+  )
+  assert len(batched) == len(images)
+  for image, detections in zip(images, batched):
+    expected = grounding_dino_model.predict_with_classes(
+      image=image, classes=CLASSES, box_threshold=0.5, text_threshold=0.5
+    )
+    assert len(expected) > 0
+    np.testing.assert_allclose(detections.xyxy, expected.xyxy, rtol=1e-5, atol=1e-3)
+    np.testing.assert_allclose(detections.confidence, expected.confidence, rtol=1e-5)
+    np.testing.assert_array_equal(detections.class_id, expected.class_id)
+
+
+def test_predict_with_classes_batch_single_image(grounding_dino_model):
+  image = make_images()[0]
+  (detections,) = predict_with_classes_batch(
+    grounding_dino_model, [image], CLASSES, box_threshold=0.5, text_threshold=0.5, batch_size=4
+  )
+  expected = grounding_dino_model.predict_with_classes(
+    image=image, classes=CLASSES, box_threshold=0.5, text_threshold=0.5
+  )
+  np.testing.assert_array_equal(detections.xyxy, expected.xyxy)
+  np.testing.assert_array_equal(detections.class_id, expected.class_id)
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from ezsam.lib.metrics import boundary_f, mask_boundary, mask_iou
+
+
+def square(shape_hw: tuple[int, int], x0: int, y0: int, size: int) -> np.ndarray:
+  mask = np.zeros(shape_hw, dtype=bool)
+  mask[y0 : y0 + size, x0 : x0 + size] = True
+  return mask
+
+
+def test_mask_iou():
+  a = square((100, 100), 0, 0, 10)
+  assert mask_iou(a, a.copy()) == 1.0
+  # Half of each square overlaps the other: 50 / 150 pixels
+  assert mask_iou(a, square((100, 100), 5, 0, 10)) == pytest.approx(1 / 3)
+  assert mask_iou(a, square((100, 100), 50, 50, 10)) == 0.0
+
+
+def test_mask_iou_empty_masks():
+  a = square((100, 100), 0, 0, 10)
+  empty = np.zeros((100, 100), dtype=bool)
+  assert mask_iou(None, None) == 1.0
+  assert mask_iou(empty, empty) == 1.0
+  assert mask_iou(empty, None) == 1.0
+  assert mask_iou(a, None) == 0.0
+  assert mask_iou(None, a) == 0.0
+
+
+def test_mask_boundary():
+  boundary = mask_boundary(square((10, 10), 2, 2, 5))
+  # The outline of the 5 * 5 square, one pixel wide
+  assert boundary.sum() == 16
+  assert not boundary[3:6, 3:6].any()
+  # The edges of the image aren't a boundary
+  assert not mask_boundary(np.ones((10, 10), dtype=bool)).any()
+
+
+def test_boundary_f_identical_masks():
+  a = square((500, 500), 100, 100, 200)
+  assert boundary_f(a, a.copy()) == 1.0
+
+
+def test_boundary_f_empty_masks():
+  a = square((500, 500), 100, 100, 200)
+  empty = np.zeros((500, 500), dtype=bool)
+  assert boundary_f(None, None) == 1.0
+  assert boundary_f(empty, None) == 1.0
+  assert boundary_f(a, None) == 0.0
+  assert boundary_f(None, a) == 0.0
+  # Full masks have no boundaries either
+  assert boundary_f(np.ones((500, 500), dtype=bool), empty) == 1.0
+
+
+@pytest.mark.parametrize('shift_x, shift_y', [(1, 0), (0, 3), (6, 0), (4, 4)])
+def test_boundary_f_within_tolerance(shift_x, shift_y):
+  # The default tolerance for a 500 * 500 image is round(0.008 * 707) = 6 pixels
+  a = square((500, 500), 100, 100, 200)
+  b = square((500, 500), 100 + shift_x, 100 + shift_y, 200)
+  assert boundary_f(a, b) == 1.0
+  assert mask_iou(a, b) < 1.0
+
+
+def test_boundary_f_beyond_tolerance():
+  a = square((500, 500), 100, 100, 200)
+  shifted = square((500, 500), 120, 100, 200)
+  bf = boundary_f(a, shifted)
+  # Only the top and bottom edges still match, and not at the shifted ends
+  assert 0.3 < bf < 0.6
+  assert boundary_f(a, square((500, 500), 110, 100, 200)) > bf
+  # While IoU barely notices the shift for such a large square
+  assert mask_iou(a, shifted) > 0.8
+  # A larger tolerance forgives more
+  assert boundary_f(a, shifted, tolerance=20) == 1.0
+
+
+def test_boundary_f_is_symmetric():
+  a = square((300, 300), 50, 50, 100)
+  b = square((300, 300), 60, 40, 150)
+  assert boundary_f(a, b) == pytest.approx(boundary_f(b, a))
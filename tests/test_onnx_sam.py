@@ -0,0 +1,45 @@
+import cv2
+import numpy as np
+import pytest
+import segment_anything_hq as samhq
+import torch
+
+from ezsam.cli.predictor import predict_masks_for_boxes
+from ezsam.lib.metrics import mask_iou
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from ezsam.cli.onnx_sam import OnnxSamPredictor, export_sam  # noqa: E402
+
+EXAMPLES = ['examples/car-1.jpg', 'examples/animal-1.jpg']
+
+
+@pytest.fixture(scope='module')
+def predictors(tmp_path_factory):
+  # Untrained SAM-HQ ViT-tiny, which still gives deterministic, non-trivial masks
+  torch.manual_seed(0)
+  sam = samhq.sam_model_registry['vit_tiny']().eval()
+  encoder_path, decoder_path = export_sam(sam, str(tmp_path_factory.mktemp('onnx')))
+  return samhq.SamPredictor(sam), OnnxSamPredictor(sam, encoder_path=encoder_path, decoder_path=decoder_path)
+
+
+def example_boxes(shape_hw: tuple[int, int]) -> np.ndarray:
+  h, w = shape_hw
+  return np.array([[0.1, 0.1, 0.6, 0.7], [0.4, 0.3, 0.95, 0.9], [0, 0, 1, 1]], dtype=np.float32) * [w, h, w, h]
+
+
+@pytest.mark.parametrize('src', EXAMPLES)
+def test_onnx_predictor_matches_torch(predictors, src):
+  torch_predictor, onnx_predictor = predictors
+  image = cv2.imread(src)
+  boxes = example_boxes(image.shape[:2])
+  masks = []
+  with torch.no_grad():
+    for predictor in predictors:
+      predictor.set_image(image, 'BGR')
+      masks.append(predict_masks_for_boxes(sam_predictor=predictor, xyxy=boxes, batch_size=2))
+  assert torch.allclose(onnx_predictor.features, torch_predictor.features, atol=1e-3)
+  for torch_mask, onnx_mask in zip(*masks):
+    assert torch_mask.any()
+    assert mask_iou(torch_mask, onnx_mask) > 0.99
@@ -0,0 +1,131 @@
+import threading
+import time
+
+import pytest
+
+from ezsam.cli.pipeline import batches, run_pipeline
+
+
+class StageError(Exception):
+  pass
+
+
+@pytest.mark.parametrize('depth', [0, 1, 4])
+def test_run_pipeline_keeps_frame_order(depth):
+  written = []
+
+  def process(frame: int) -> int:
+    # Uneven processing times shouldn't reorder frames
+    time.sleep(0.001 * (frame % 3))
+    return frame * 10
+
+  run_pipeline(frames=range(50), process=process, write=written.append, depth=depth)
+  assert written == [frame * 10 for frame in range(50)]
+
+
+def test_run_pipeline_stages_run_on_threads():
+  threads = {}
+
+  def frames():
+    threads['decode'] = threading.current_thread()
+    yield from range(3)
+
+  def process(frame: int) -> int:
+    threads['process'] = threading.current_thread()
+    return frame
+
+  def write(frame: int) -> None:
+    threads['write'] = threading.current_thread()
+
+  run_pipeline(frames=frames(), process=process, write=write, depth=2)
+  assert threads['process'] is threading.main_thread()
+  assert threads['decode'] is not threading.main_thread()
+  assert threads['write'] is not threading.main_thread()
+
+
+def test_run_pipeline_limits_frames_in_flight():
+  depth = 2
+  decoded = 0
+  max_ahead = 0
+  written = 0
+  lock = threading.Lock()
+
+  def frames():
+    nonlocal decoded
+    for frame in range(30):
+      with lock:
+        decoded += 1
+      yield frame
+
+  def process(frame: int) -> int:
+    nonlocal max_ahead
+    time.sleep(0.002)
+    with lock:
+      max_ahead = max(max_ahead, decoded - written)
+    return frame
+
+  def write(frame: int) -> None:
+    nonlocal written
+    time.sleep(0.005)
+    with lock:
+      written += 1
+
+  run_pipeline(frames=frames(), process=process, write=write, depth=depth)
+  assert written == 30
+  # Each queue holds up to depth frames, plus one frame in each stage
+  assert max_ahead <= 2 * depth + 3
+
+
+def failing_frames():
+  yield 0
+  yield 1
+  raise StageError('decode')
+
+
+def failing_process(frame: int) -> int:
+  if frame == 5:
+    raise StageError('process')
+  return frame
+
+
+@pytest.mark.parametrize('depth', [0, 2])
+@pytest.mark.parametrize(
+  'stage, frames, process, fail_write',
+  [
+    ('decode', failing_frames, lambda frame: frame, False),
+    ('process', lambda: range(100), failing_process, False),
+    ('write', lambda: range(100), lambda frame: frame, True),
+  ],
+)
+def test_run_pipeline_raises_errors_from_any_stage(depth, stage, frames, process, fail_write):
+  written = []
+
+  def write(frame: int) -> None:
+    if fail_write and frame == 3:
+      raise StageError('write')
+    written.append(frame)
+
+  with pytest.raises(StageError, match=stage):
+    run_pipeline(frames=frames(), process=process, write=write, depth=depth)
+  # Frames after the error are never written
+  assert written == list(range(len(written)))
+  assert len(written) < 100
+
+
+def test_run_pipeline_stops_decoding_after_error():
+  decoded = []
+
+  def frames():
+    for frame in range(1000):
+      decoded.append(frame)
+      yield frame
+
+  with pytest.raises(StageError):
+    run_pipeline(frames=frames(), process=failing_process, write=lambda frame: None, depth=2)
+  assert len(decoded) < 1000
+
+
+def test_batches():
+  assert list(batches(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+  assert list(batches(range(6), 3)) == [[0, 1, 2], [3, 4, 5]]
+  assert list(batches([], 3)) == []
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import segment_anything_hq as samhq
+import torch
+
+from ezsam.cli.composite import SupermaskBuilder
+from ezsam.cli.predictor import predict_masks_for_boxes
+
+BOXES = np.array(
+  [[10, 10, 80, 60], [50, 30, 150, 110], [0, 0, 160, 120], [20, 70, 60, 115], [90, 5, 140, 50]], dtype=np.float32
+)
+
+
+@pytest.fixture(scope='module')
+def sam_predictor():
+  # Untrained SAM-HQ ViT-tiny, which still gives deterministic, non-trivial masks
+  torch.manual_seed(0)
+  sam = samhq.sam_model_registry['vit_tiny']().eval()
+  predictor = samhq.SamPredictor(sam)
+  image = np.random.default_rng(0).integers(0, 256, (120, 160, 3), dtype=np.uint8)
+  with torch.no_grad():
+    predictor.set_image(image, 'BGR')
+  return predictor
+
+
+def predict_each_box(sam_predictor, xyxy: np.ndarray) -> np.ndarray:
+  masks = []
+  for box in xyxy:
+    candidates, scores, _ = sam_predictor.predict(box=box, multimask_output=True)
+    masks.append(candidates[np.argmax(scores)])
+  return np.stack(masks)
+
+
+@pytest.mark.parametrize('batch_size', [1, 2, 16])
+def test_predict_masks_for_boxes_matches_per_box_prompts(sam_predictor, batch_size):
+  with torch.no_grad():
+    masks = predict_masks_for_boxes(sam_predictor=sam_predictor, xyxy=BOXES, batch_size=batch_size)
+    expected = predict_each_box(sam_predictor, BOXES)
+  assert masks.shape == (len(BOXES), 120, 160)
+  assert masks.dtype == bool
+  np.testing.assert_array_equal(masks, expected)
+
+
+def test_predict_masks_for_boxes_join(sam_predictor):
+  builder = SupermaskBuilder((120, 160))
+  with torch.no_grad():
+    result = predict_masks_for_boxes(sam_predictor=sam_predictor, xyxy=BOXES, batch_size=2, join=builder.add)
+    expected = predict_each_box(sam_predictor, BOXES)
+  assert result is None
+  np.testing.assert_array_equal(builder.mask, np.logical_or.reduce(expected, axis=0))
@@ -0,0 +1,111 @@
+import cv2
+import numpy as np
+import supervision as sv
+
+from ezsam.cli import process
+from ezsam.cli.process import split_detections
+
+
+def make_detections(class_id) -> sv.Detections:
+  n = len(class_id) if class_id is not None else 3
+  xyxy = np.array([[i, i, i + 10, i + 10] for i in range(n)], dtype=np.float32)
+  confidence = np.linspace(0.5, 0.9, n, dtype=np.float32)
+  return sv.Detections(xyxy=xyxy, confidence=confidence, class_id=class_id)
+
+
+def test_split_detections():
+  # Prompts 0 and 1 are positive, 2 and 3 negative
+  detections = make_detections(np.array([0, 2, 1, 3, 0]))
+  pos, neg = split_detections(detections, num_prompts=2)
+  np.testing.assert_array_equal(pos.class_id, [0, 1, 0])
+  np.testing.assert_array_equal(pos.xyxy[:, 0], [0, 2, 4])
+  np.testing.assert_array_equal(neg.class_id, [0, 1])
+  np.testing.assert_array_equal(neg.xyxy[:, 0], [1, 3])
+  np.testing.assert_array_equal(neg.confidence, detections.confidence[[1, 3]])
+
+
+def test_split_detections_drops_unmatched():
+  # GroundingDINO gives class id None for phrases that match no prompt, which could be positive or negative
+  detections = make_detections(np.array([0, None, 2, None], dtype=object))
+  pos, neg = split_detections(detections, num_prompts=2)
+  np.testing.assert_array_equal(pos.class_id, [0])
+  np.testing.assert_array_equal(pos.xyxy[:, 0], [0])
+  np.testing.assert_array_equal(neg.class_id, [0])
+  np.testing.assert_array_equal(neg.xyxy[:, 0], [2])
+  pos, neg = split_detections(make_detections(np.array([-1, 1, 3])), num_prompts=2)
+  np.testing.assert_array_equal(pos.class_id, [1])
+  np.testing.assert_array_equal(neg.class_id, [1])
+
+
+def test_split_detections_without_class_ids():
+  pos, neg = split_detections(make_detections(None), num_prompts=2)
+  assert len(pos) == 0
+  assert len(neg) == 0
+  pos, neg = split_detections(make_detections(np.array([None, None], dtype=object)), num_prompts=2)
+  assert (len(pos), len(neg)) == (0, 0)
+
+
+def test_split_detections_empty():
+  pos, neg = split_detections(sv.Detections.empty(), num_prompts=2)
+  assert (len(pos), len(neg)) == (0, 0)
+
+
+def test_process_files_decodes_batched_images_once(tmp_path, monkeypatch):
+  srcs = []
+  for i in range(3):
+    src = str(tmp_path / f'{i}.png')
+    cv2.imwrite(src, np.full((20, 30, 3), i, dtype=np.uint8))
+    srcs.append(src)
+  reads = []
+  imread = cv2.imread
+
+  def counting_imread(path, *args):
+    reads.append((path, *args))
+    return imread(path, *args)
+
+  processed = {}
+
+  def process_file(src, prior_detections, image, **kwargs):
+    processed[src] = (prior_detections, image)
+
+  monkeypatch.setattr(process.cv2, 'imread', counting_imread)
+  monkeypatch.setattr(process, 'process_file', process_file)
+  monkeypatch.setattr(
+    process, 'detect_prompts_batch', lambda images, **kwargs: [(sv.Detections.empty(), None) for _ in images]
+  )
+  args = {
+    'prompts': ['car'],
+    'neg_prompts': [],
+    'box_threshold': 0.3,
+    'text_threshold': 0.25,
+    'nms_threshold': 0.8,
+    'grounding_dino_model': None,
+    'debug': False,
+    'gd_batch_size': 4,
+  }
+  assert process.process_files(srcs, **args) == []
+  # Each image is read once for object detection, and handed on to be processed
+  assert reads == [(src,) for src in srcs]
+  for i, src in enumerate(srcs):
+    prior_detections, image = processed[src]
+    assert prior_detections is not None
+    assert image.shape == (20, 30, 3)
+    assert (image == i).all()
+
+
+def test_apply_supermask_upsampled_16_bit():
+  mask = np.zeros((400, 600), dtype=np.uint8)
+  cv2.circle(mask, (290, 210), 123, 1, -1)
+  image = np.where(mask[:, :, None] > 0, 220, 30).astype(np.uint8).repeat(3, axis=2)
+  # 16 bit BGRA, i.e. read from a 16 bit PNG with cv2.IMREAD_UNCHANGED
+  image_unchanged = np.concatenate([image.astype(np.uint16) * 257, np.full((400, 600, 1), 65535, np.uint16)], axis=2)
+  small_mask = cv2.resize(mask, (150, 100), interpolation=cv2.INTER_AREA) > 0
+  processed = process.apply_supermask(image=image, image_unchanged=image_unchanged, supermask=small_mask)
+  assert processed.dtype == np.uint16
+  np.testing.assert_array_equal(processed[:, :, :3], image_unchanged[:, :, :3])
+  assert processed[210, 290, 3] == 65535
+  assert processed[10, 10, 3] == 0
+  # Same mask as for the 8 bit image
+  processed_8_bit = process.apply_supermask(image=image, image_unchanged=None, supermask=small_mask)
+  assert processed_8_bit.dtype == np.uint8
+  assert np.abs(processed[:, :, 3] / 257 - processed_8_bit[:, :, 3]).max() <= 1
@@ -0,0 +1,123 @@
+import cv2
+import numpy as np
+
+from ezsam.cli.propagation import MaskPropagator, edge_error, warp
+from ezsam.lib.metrics import mask_iou
+
+SHAPE_HW = (240, 320)
+OBJECT_SIZE = 80
+
+
+def textured(shape_hw: tuple[int, int], seed: int, low: int, high: int) -> np.ndarray:
+  noise = np.random.default_rng(seed).random((*shape_hw, 3)).astype(np.float32)
+  smooth = cv2.GaussianBlur(noise, (7, 7), 2)
+  smooth = (smooth - smooth.min()) / (smooth.max() - smooth.min())
+  return (low + smooth * (high - low)).astype(np.uint8)
+
+
+# A bright object on a dark background, both textured for optical flow
+BACKGROUND = textured(SHAPE_HW, 0, 0, 100)
+OBJECT = textured((OBJECT_SIZE, OBJECT_SIZE), 1, 150, 255)
+
+
+def frame_with_object(x: int, y: int) -> np.ndarray:
+  frame = BACKGROUND.copy()
+  frame[y : y + OBJECT_SIZE, x : x + OBJECT_SIZE] = OBJECT
+  return frame
+
+
+def object_mask(x: int, y: int) -> np.ndarray:
+  mask = np.zeros(SHAPE_HW, dtype=bool)
+  mask[y : y + OBJECT_SIZE, x : x + OBJECT_SIZE] = True
+  return mask
+
+
+class CountingSegmenter:
+  """
+  Segmentation that returns the true mask of the object, and records which frames it ran on.
+  """
+
+  def __init__(self):
+    self.positions: list[tuple[int, int]] = []
+    self.segmented: list[int] = []
+
+  def __call__(self, frame: np.ndarray) -> np.ndarray | None:
+    self.segmented.append(len(self.positions) - 1)
+    return object_mask(*self.positions[-1])
+
+
+def test_warp_shifts_by_flow():
+  image = np.arange(100, dtype=np.float32).reshape(10, 10)
+  # Backward flow of (-2, -1): each pixel comes from 2 pixels to the left and 1 pixel up in the previous frame
+  flow = np.zeros((10, 10, 2), dtype=np.float32)
+  flow[..., 0] = -2
+  flow[..., 1] = -1
+  warped = warp(image, flow)
+  np.testing.assert_array_equal(warped[1:, 2:], image[:-1, :-2])
+
+
+def test_edge_error():
+  mask = object_mask(100, 80)
+  gray = cv2.cvtColor(frame_with_object(100, 80), cv2.COLOR_BGR2GRAY)
+  assert edge_error(mask, gray, gray) == 0.0
+  assert edge_error(np.zeros(SHAPE_HW, dtype=bool), gray, 255 - gray) == 0.0
+  assert edge_error(mask, gray, 255 - gray) > 0.2
+
+
+def test_propagates_shifted_mask():
+  segment = CountingSegmenter()
+  propagator = MaskPropagator(max_length=10, motion_threshold=10, edge_threshold=0.1)
+  masks = []
+  for i in range(4):
+    segment.positions.append((100 + 3 * i, 80 + 2 * i))
+    masks.append(propagator(frame_with_object(*segment.positions[-1]), segment))
+  assert segment.segmented == [0]
+  assert (propagator.num_segmented, propagator.num_propagated) == (1, 3)
+  for (x, y), mask in zip(segment.positions, masks):
+    assert mask.shape == SHAPE_HW
+    assert mask_iou(mask, object_mask(x, y)) > 0.97
+  # The warped mask follows the object, rather than staying where it was
+  assert mask_iou(masks[-1], object_mask(109, 86)) > mask_iou(masks[-1], object_mask(100, 80))
+
+
+def test_edge_error_segments_again():
+  segment = CountingSegmenter()
+  propagator = MaskPropagator(max_length=10, motion_threshold=100, edge_threshold=0.05)
+  segment.positions.append((100, 80))
+  propagator(frame_with_object(100, 80), segment)
+  # The object is replaced by background without moving, so the mask's edges no longer line up with anything
+  segment.positions.append((100, 80))
+  propagator(BACKGROUND.copy(), segment)
+  assert segment.segmented == [0, 1]
+
+
+def test_motion_segments_again():
+  segment = CountingSegmenter()
+  propagator = MaskPropagator(max_length=10, motion_threshold=0.5, edge_threshold=1.0)
+  segment.positions.append((100, 80))
+  propagator(frame_with_object(100, 80), segment)
+  segment.positions.append((130, 100))
+  propagator(frame_with_object(130, 100), segment)
+  assert segment.segmented == [0, 1]
+
+
+def test_max_length_segments_again():
+  segment = CountingSegmenter()
+  propagator = MaskPropagator(max_length=2, motion_threshold=10, edge_threshold=1.0)
+  for _ in range(7):
+    segment.positions.append((100, 80))
+    propagator(frame_with_object(100, 80), segment)
+  assert segment.segmented == [0, 3, 6]
+
+
+def test_propagates_nothing_detected():
+  calls = []
+
+  def segment(frame: np.ndarray) -> np.ndarray | None:
+    calls.append(frame)
+    return None
+
+  propagator = MaskPropagator(max_length=10, motion_threshold=10, edge_threshold=0.1)
+  for _ in range(3):
+    assert propagator(BACKGROUND.copy(), segment) is None
+  assert len(calls) == 1
@@ -0,0 +1,60 @@
+import cv2
+import numpy as np
+import supervision as sv
+
+from ezsam.cli.resolution import downscale_to_max_side, upsample_mask, upscale_detections
+from ezsam.lib.metrics import boundary_f, mask_iou
+
+SHAPE_HW = (400, 600)
+
+
+def disc_image() -> tuple[np.ndarray, np.ndarray]:
+  """
+  A bright disc on a dark background, and its mask at full resolution.
+  """
+  mask = np.zeros(SHAPE_HW, dtype=np.uint8)
+  cv2.circle(mask, (290, 210), 123, 1, -1)
+  image = np.where(mask[:, :, None] > 0, 220, 30).astype(np.uint8).repeat(3, axis=2)
+  return image, mask > 0
+
+
+def test_downscale_to_max_side():
+  image = np.zeros((400, 600, 3), dtype=np.uint8)
+  assert downscale_to_max_side(image, 150).shape == (100, 150, 3)
+  assert downscale_to_max_side(image, None) is image
+  assert downscale_to_max_side(image, 600) is image
+
+
+def test_upsample_mask():
+  image, full_mask = disc_image()
+  small = downscale_to_max_side(image, 150)
+  small_mask = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) > 125
+  soft_mask = upsample_mask(mask=small_mask, image=image)
+  assert soft_mask.shape == SHAPE_HW
+  assert soft_mask.dtype == np.uint8
+  # Solidly inside and outside of the disc
+  assert soft_mask[210, 290] == 255
+  assert soft_mask[10, 10] == 0
+  upsampled = soft_mask >= 128
+  blocky = cv2.resize(small_mask.astype(np.uint8), SHAPE_HW[::-1], interpolation=cv2.INTER_NEAREST) > 0
+  # Edges follow the full resolution image, instead of the blocks of the low resolution mask
+  assert mask_iou(upsampled, full_mask) > 0.995
+  assert boundary_f(upsampled, full_mask, tolerance=1) > boundary_f(blocky, full_mask, tolerance=1)
+
+
+def test_upsample_mask_empty():
+  image, _ = disc_image()
+  soft_mask = upsample_mask(mask=np.zeros((100, 150), dtype=bool), image=image)
+  assert soft_mask.max() == 0
+
+
+def test_upscale_detections():
+  image, _ = disc_image()
+  small = downscale_to_max_side(image, 150)
+  detections = sv.Detections(
+    xyxy=np.array([[10, 20, 50, 60]], dtype=np.float32),
+    confidence=np.array([0.9], dtype=np.float32),
+    class_id=np.array([0]),
+  )
+  upscaled = upscale_detections(detections, small, image)
+  np.testing.assert_allclose(upscaled.xyxy, [[40, 80, 200, 240]])
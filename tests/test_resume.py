@@ -0,0 +1,83 @@
+import json
+import os
+
+import pytest
+
+from ezsam.cli.resume import JobManifest, get_manifest_path
+
+OPTIONS = {'prompts': ['car'], 'box_threshold': 0.3, 'start_frame': 0, 'end_frame': None}
+
+
+@pytest.fixture
+def job(tmp_path):
+  src = tmp_path / 'in.mp4'
+  src.write_bytes(b'video')
+  return str(src), str(tmp_path / 'in.out.webm')
+
+
+def make_segments(tmp_path, count: int) -> list[str]:
+  paths = [str(tmp_path / f'in.out.seg{i}.webm') for i in range(count)]
+  for path in paths:
+    with open(path, 'wb') as f:
+      f.write(b'segment')
+  return paths
+
+
+def test_new_job(job):
+  src, out = job
+  manifest = JobManifest.load(out=out, src=src, options=OPTIONS)
+  assert manifest.path == get_manifest_path(out)
+  assert (manifest.num_frames, manifest.segments, manifest.complete) == (0, [], False)
+
+
+def test_resume_job(job, tmp_path):
+  src, out = job
+  segments = make_segments(tmp_path, 2)
+  JobManifest.load(out=out, src=src, options=OPTIONS).update(60, segments)
+  # Options are compared after a round trip through JSON, so tuples match lists
+  manifest = JobManifest.load(out=out, src=src, options={**OPTIONS, 'prompts': ('car',)})
+  assert (manifest.num_frames, manifest.segments, manifest.complete) == (60, segments, False)
+  manifest.finish()
+  manifest = JobManifest.load(out=out, src=src, options=OPTIONS)
+  assert manifest.complete
+  assert manifest.segments == []
+
+
+def test_changed_options_start_over(job, tmp_path):
+  src, out = job
+  segments = make_segments(tmp_path, 2)
+  JobManifest.load(out=out, src=src, options=OPTIONS).update(60, segments)
+  manifest = JobManifest.load(out=out, src=src, options={**OPTIONS, 'box_threshold': 0.35})
+  assert manifest.num_frames == 0
+  # Segments from the old job are useless, so they're removed
+  assert not any(os.path.exists(segment) for segment in segments)
+
+
+def test_changed_input_starts_over(job):
+  src, out = job
+  JobManifest.load(out=out, src=src, options=OPTIONS).update(60)
+  with open(src, 'wb') as f:
+    f.write(b'other video')
+  assert JobManifest.load(out=out, src=src, options=OPTIONS).num_frames == 0
+
+
+def test_missing_segments_start_over(job, tmp_path):
+  src, out = job
+  segments = make_segments(tmp_path, 2)
+  JobManifest.load(out=out, src=src, options=OPTIONS).update(60, segments)
+  os.remove(segments[1])
+  assert JobManifest.load(out=out, src=src, options=OPTIONS).num_frames == 0
+
+
+@pytest.mark.parametrize('contents', ['', '{"num_frames": ', json.dumps({'version': 0, 'num_frames': 60})])
+def test_unreadable_manifest_starts_over(job, contents):
+  src, out = job
+  with open(get_manifest_path(out), 'w') as f:
+    f.write(contents)
+  assert JobManifest.load(out=out, src=src, options=OPTIONS).num_frames == 0
+
+
+def test_save_leaves_no_temporary_file(job, tmp_path):
+  src, out = job
+  JobManifest.load(out=out, src=src, options=OPTIONS).update(10)
+  assert sorted(os.listdir(tmp_path)) == ['in.mp4', os.path.basename(get_manifest_path(out))]
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+import supervision as sv
+
+from ezsam.cli.tiling import TILE_EDGE_MARGIN, TiledDetector, inside_tile, tile_grid
+
+
+def covered(tiles: list[tuple[int, int, int, int]], shape_hw: tuple[int, int]) -> np.ndarray:
+  coverage = np.zeros(shape_hw, dtype=int)
+  for x0, y0, x1, y1 in tiles:
+    coverage[y0:y1, x0:x1] += 1
+  return coverage
+
+
+@pytest.mark.parametrize('shape_hw', [(1000, 1500), (1024, 2048), (700, 513), (513, 700)])
+@pytest.mark.parametrize('overlap', [0, 0.2, 0.5])
+def test_tile_grid_covers_image(shape_hw, overlap):
+  tile_size = 512
+  tiles = tile_grid(shape_hw, tile_size, overlap)
+  assert (covered(tiles, shape_hw) > 0).all()
+  for x0, y0, x1, y1 in tiles:
+    # Tiles are all the same size, and inside the image
+    assert (x1 - x0, y1 - y0) == (tile_size, tile_size)
+    assert 0 <= x0 and 0 <= y0 and x1 <= shape_hw[1] and y1 <= shape_hw[0]
+  assert len(set(tiles)) == len(tiles)
+
+
+def test_tile_grid_overlap():
+  tiles = tile_grid((100, 1000), 100, 0.2)
+  assert [tile[0] for tile in tiles] == [0, 80, 160, 240, 320, 400, 480, 560, 640, 720, 800, 880, 900]
+  assert all(tile[1] == 0 and tile[3] == 100 for tile in tiles)
+
+
+def test_tile_grid_small_image():
+  # Images smaller than a tile are a single tile, clipped to the image
+  assert tile_grid((300, 200), 512, 0.2) == [(0, 0, 200, 300)]
+  assert tile_grid((300, 800), 512, 0.5) == [(0, 0, 512, 300), (256, 0, 768, 300), (288, 0, 800, 300)]
+
+
+@pytest.mark.parametrize('tile_size, overlap', [(512, 1), (512, 1.5), (512, -0.1), (0, 0.2), (-512, 0.2)])
+def test_tile_grid_invalid(tile_size, overlap):
+  with pytest.raises(ValueError):
+    tile_grid((1000, 1500), tile_size, overlap)
+
+
+def test_inside_tile():
+  shape_hw = (1000, 1000)
+  xyxy = np.array(
+    [
+      [10, 10, 50, 50],  # Clear of all edges
+      [0, 10, 50, 50],  # On the left edge
+      [10, 0, 50, 50],  # On the top edge
+      [10, 10, 100, 50],  # On the right edge
+      [10, 10, 50, 100],  # On the bottom edge
+      [TILE_EDGE_MARGIN + 1, TILE_EDGE_MARGIN + 1, 100 - TILE_EDGE_MARGIN - 1, 100 - TILE_EDGE_MARGIN - 1],
+    ],
+    dtype=np.float32,
+  )
+  # A tile in the middle of the image cuts off boxes on any of its edges
+  np.testing.assert_array_equal(inside_tile(xyxy, (400, 400, 500, 500), shape_hw), [1, 0, 0, 0, 0, 1])
+  # Edges on the image's border don't cut off anything
+  np.testing.assert_array_equal(inside_tile(xyxy, (0, 0, 100, 100), shape_hw), [1, 1, 1, 0, 0, 1])
+  np.testing.assert_array_equal(inside_tile(xyxy, (900, 900, 1000, 1000), shape_hw), [1, 0, 0, 1, 1, 1])
+  assert inside_tile(np.empty((0, 4), dtype=np.float32), (400, 400, 500, 500), shape_hw).shape == (0,)
+
+
+class SmallObjectDetector:
+  """
+  Stand-in for a GroundingDINO model, which only detects the white square in images up to a certain size, i.e. once
+   the object is large enough after resizing the image for the model.
+  """
+
+  def __init__(self, max_size: int):
+    self.max_size = max_size
+    self.sizes = []
+
+  def predict_with_classes(self, image, classes, box_threshold, text_threshold) -> sv.Detections:
+    self.sizes.append(image.shape[:2])
+    ys, xs = np.nonzero(image[:, :, 0] == 255)
+    if max(image.shape[:2]) > self.max_size or len(xs) == 0:
+      return sv.Detections.empty()
+    xyxy = np.array([[xs.min(), ys.min(), xs.max() + 1, ys.max() + 1]], dtype=np.float32)
+    return sv.Detections(xyxy=xyxy, confidence=np.array([0.9], dtype=np.float32), class_id=np.array([0]))
+
+
+def test_tiled_detector_maps_tile_detections_to_image():
+  image = np.zeros((600, 900, 3), dtype=np.uint8)
+  image[250:280, 610:650] = 255
+  model = SmallObjectDetector(max_size=256)
+  detector = TiledDetector(model, tile_size=256, overlap=0.25, batch_size=4)
+  detections = detector.predict_with_classes(image=image, classes=['square'], box_threshold=0.3, text_threshold=0.3)
+  assert model.sizes[0] == (600, 900)
+  assert len(model.sizes) == 1 + len(tile_grid((600, 900), 256, 0.25))
+  # Tiles that cut off the square drop it, the rest all find it at the same place in the image
+  assert len(detections) > 0
+  np.testing.assert_array_equal(detections.xyxy, np.tile([[610, 250, 650, 280]], (len(detections), 1)))
+
+
+def test_tiled_detector_small_image():
+  image = np.zeros((200, 250, 3), dtype=np.uint8)
+  image[20:40, 30:60] = 255
+  model = SmallObjectDetector(max_size=256)
+  detector = TiledDetector(model, tile_size=256, overlap=0.25, batch_size=4)
+  detections = detector.predict_with_classes(image=image, classes=['square'], box_threshold=0.3, text_threshold=0.3)
+  # Images no larger than a tile are only detected in once
+  assert model.sizes == [(200, 250)]
+  np.testing.assert_array_equal(detections.xyxy, [[30, 20, 60, 40]])
@@ -0,0 +1,142 @@
+import cv2
+import numpy as np
+import supervision as sv
+
+from ezsam.cli.tracking import KeyframeDetector, track_detections, to_tracking_gray
+
+SHAPE_HW = (240, 320)
+OBJECT_SIZE = 60
+
+
+def textured(shape_hw: tuple[int, int], seed: int) -> np.ndarray:
+  noise = np.random.default_rng(seed).integers(0, 256, (*shape_hw, 3), dtype=np.uint8)
+  # Smooth noise has corners that track well
+  return cv2.GaussianBlur(noise, (5, 5), 1.5)
+
+
+BACKGROUND = textured(SHAPE_HW, 0)
+OBJECT = textured((OBJECT_SIZE, OBJECT_SIZE), 1)
+
+
+def frame_with_object(x: int, y: int, background: np.ndarray = BACKGROUND) -> np.ndarray:
+  frame = background.copy()
+  frame[y : y + OBJECT_SIZE, x : x + OBJECT_SIZE] = OBJECT
+  return frame
+
+
+def object_box(x: int, y: int) -> np.ndarray:
+  return np.array([x, y, x + OBJECT_SIZE, y + OBJECT_SIZE], dtype=np.float32)
+
+
+def make_detections(boxes: list[np.ndarray], class_id: list[int]) -> sv.Detections:
+  return sv.Detections(
+    xyxy=np.stack(boxes), confidence=np.linspace(0.9, 0.5, len(boxes), dtype=np.float32), class_id=np.array(class_id)
+  )
+
+
+class CountingDetector:
+  """
+  Object detection that finds the object wherever it was drawn, and counts how often it runs.
+  """
+
+  def __init__(self):
+    self.positions: list[tuple[int, int]] = []
+    self.calls = 0
+
+  def __call__(self, frame: np.ndarray) -> tuple[sv.Detections, sv.Detections | None]:
+    self.calls += 1
+    x, y = self.positions[-1]
+    return make_detections([object_box(x, y)], [0]), None
+
+
+def test_track_detections_follows_moving_object():
+  prev_gray, scale = to_tracking_gray(frame_with_object(100, 80))
+  gray, _ = to_tracking_gray(frame_with_object(106, 77))
+  # A second box on the static background, which should stay put
+  detections = make_detections([object_box(100, 80), np.array([10, 150, 70, 210], dtype=np.float32)], [1, 0])
+  tracked = track_detections(prev_gray, gray, scale, detections, (SHAPE_HW[1], SHAPE_HW[0]))
+  assert tracked is not None
+  np.testing.assert_allclose(tracked.xyxy[0], object_box(106, 77), atol=1.5)
+  np.testing.assert_allclose(tracked.xyxy[1], [10, 150, 70, 210], atol=1.5)
+  # Boxes keep their order, class and confidence from frame to frame
+  np.testing.assert_array_equal(tracked.class_id, [1, 0])
+  np.testing.assert_array_equal(tracked.confidence, detections.confidence)
+
+
+def test_track_detections_lost():
+  prev_gray, scale = to_tracking_gray(frame_with_object(100, 80))
+  # Nothing can be tracked into a blank frame
+  gray, _ = to_tracking_gray(np.full((*SHAPE_HW, 3), 128, dtype=np.uint8))
+  detections = make_detections([object_box(100, 80)], [0])
+  assert track_detections(prev_gray, gray, scale, detections, (SHAPE_HW[1], SHAPE_HW[0])) is None
+
+
+def test_keyframe_detector_tracks_between_keyframes():
+  detect = CountingDetector()
+  keyframes = KeyframeDetector(detect, interval=4, scene_threshold=0.5)
+  results = []
+  for i in range(10):
+    detect.positions.append((50 + 3 * i, 60 + 2 * i))
+    results.append(keyframes(frame_with_object(*detect.positions[-1])))
+  # Detection runs on frames 0, 4 and 8, boxes are tracked in between
+  assert detect.calls == 3
+  assert (keyframes.num_detected, keyframes.num_tracked) == (3, 7)
+  for (x, y), (detections, neg_detections) in zip(detect.positions, results):
+    assert neg_detections is None
+    assert len(detections) == 1
+    np.testing.assert_allclose(detections.xyxy[0], object_box(x, y), atol=1.5)
+    np.testing.assert_array_equal(detections.class_id, [0])
+
+
+def test_keyframe_detector_scene_change():
+  detect = CountingDetector()
+  keyframes = KeyframeDetector(detect, interval=100, scene_threshold=0.1)
+  detect.positions.append((50, 60))
+  keyframes(frame_with_object(50, 60))
+  detect.positions.append((52, 61))
+  keyframes(frame_with_object(52, 61))
+  assert detect.calls == 1
+  # A new background is a new scene, so objects are detected again
+  detect.positions.append((52, 61))
+  keyframes(frame_with_object(52, 61, background=255 - BACKGROUND))
+  assert detect.calls == 2
+
+
+def test_keyframe_detector_empty_detections():
+  calls = []
+
+  def detect(frame: np.ndarray) -> tuple[sv.Detections, sv.Detections | None]:
+    calls.append(frame)
+    return sv.Detections.empty(), None
+
+  keyframes = KeyframeDetector(detect, interval=3, scene_threshold=0.5)
+  for i in range(5):
+    detections, neg_detections = keyframes(frame_with_object(50 + i, 60))
+    assert len(detections) == 0
+    assert neg_detections is None
+  # Nothing to track is carried forward as nothing, until the next keyframe
+  assert len(calls) == 2
+  assert keyframes.num_tracked == 3
+
+
+def test_keyframe_detector_returns_copies():
+  detect = CountingDetector()
+  detect.positions.append((50, 60))
+  keyframes = KeyframeDetector(detect, interval=4, scene_threshold=0.5)
+  detections, _ = keyframes(frame_with_object(50, 60))
+  detections.xyxy[:] = 0
+  detect.positions.append((51, 60))
+  tracked, _ = keyframes(frame_with_object(51, 60))
+  np.testing.assert_allclose(tracked.xyxy[0], object_box(51, 60), atol=1.5)
+
+
+def test_keyframe_detector_lost_track():
+  detect = CountingDetector()
+  keyframes = KeyframeDetector(detect, interval=100, scene_threshold=1.0)
+  detect.positions.append((50, 60))
+  keyframes(frame_with_object(50, 60))
+  # Boxes can't be tracked into a blank frame, so objects are detected again before the next keyframe
+  detect.positions.append((200, 150))
+  detections, _ = keyframes(np.full((*SHAPE_HW, 3), 128, dtype=np.uint8))
+  assert detect.calls == 2
+  np.testing.assert_array_equal(detections.xyxy[0], object_box(200, 150))
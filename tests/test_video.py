@@ -0,0 +1,71 @@
+import os
+import subprocess
+
+import cv2
+import numpy as np
+import pytest
+
+from ezsam.cli import video
+from ezsam.cli.chunks import split_frame_range
+from ezsam.cli.formats import OutputImageFormat, OutputVideoCodec
+from ezsam.cli.video import TempFileFrameWriter, read_video_frames
+
+NUM_FRAMES = 12
+
+
+@pytest.fixture(scope='module')
+def video_path(tmp_path_factory):
+  path = str(tmp_path_factory.mktemp('video') / 'frames.avi')
+  writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 10, (32, 24))
+  for i in range(NUM_FRAMES):
+    # Each frame's brightness identifies it
+    writer.write(np.full((24, 32, 3), i * 20, dtype=np.uint8))
+  writer.release()
+  return path
+
+
+def frame_ids(frames) -> list[int]:
+  return [round(frame.mean() / 20) for frame in frames]
+
+
+def test_read_video_frames(video_path):
+  assert frame_ids(read_video_frames(video_path)) == list(range(NUM_FRAMES))
+  assert frame_ids(read_video_frames(video_path, start=3, end=7)) == [3, 4, 5, 6]
+  assert frame_ids(read_video_frames(video_path, start=9)) == [9, 10, 11]
+  # Past the end of the video, frames are read until decoding stops
+  assert frame_ids(read_video_frames(video_path, start=9, end=100)) == [9, 10, 11]
+
+
+def test_read_video_frames_chunks(video_path):
+  ranges = split_frame_range(0, NUM_FRAMES, 5)
+  frames = []
+  for i, (start, end) in enumerate(ranges):
+    frames += read_video_frames(video_path, start=start, end=None if i == len(ranges) - 1 else end)
+  assert frame_ids(frames) == list(range(NUM_FRAMES))
+
+
+def test_read_video_frames_missing_file(tmp_path):
+  with pytest.raises(RuntimeError, match='Could not open'):
+    next(read_video_frames(str(tmp_path / 'missing.avi')))
+
+
+@pytest.mark.parametrize('keep_on_abort', [False, True])
+def test_temp_file_writer_join_fails(tmp_path, monkeypatch, keep_on_abort):
+  monkeypatch.setattr(video.sub, 'run', lambda cmd: subprocess.CompletedProcess(cmd, returncode=1))
+  writer = TempFileFrameWriter(
+    out=str(tmp_path / 'out.webm'),
+    codec=OutputVideoCodec.vp9,
+    fps=10,
+    resolution_wh=(32, 24),
+    tmp_prefix=str(tmp_path / 'out'),
+    img_fmt=OutputImageFormat.png,
+    num_digits=1,
+    cleanup=True,
+    keep_on_abort=keep_on_abort,
+  )
+  with pytest.raises(RuntimeError, match='failed with code 1'):
+    with writer:
+      for i in range(3):
+        writer.write(np.full((24, 32, 4), i, dtype=np.uint8))
+  # Frames of a resumable job are kept to retry joining them
+  assert all(os.path.isfile(tmp) == keep_on_abort for tmp in writer.tmp_files)
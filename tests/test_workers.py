@@ -0,0 +1,38 @@
+import pytest
+
+from ezsam.cli import workers
+
+
+@pytest.fixture
+def worker(monkeypatch):
+  # Worker process state, as if init_worker() had just run in this process
+  monkeypatch.setattr(workers, '_worker_models', {})
+  monkeypatch.setattr(workers, '_worker_state', {'model_args': {'sam_model': 'vit_tiny'}, 'load_error': None})
+  monkeypatch.setattr(workers, 'process_file', lambda **kwargs: None)
+
+
+def test_run_job_loads_models_once(worker, monkeypatch):
+  calls = []
+
+  def load_models(**model_args):
+    calls.append(model_args)
+    return 'gd', 'sam', 'predictor'
+
+  monkeypatch.setattr(workers, 'load_models', load_models)
+  for src in ['a.jpg', 'b.jpg']:
+    assert workers.run_job({'src': src})[:2] == (src, None)
+  assert calls == [{'sam_model': 'vit_tiny'}]
+
+
+def test_run_job_reports_model_loading_errors(worker, monkeypatch):
+  calls = []
+
+  def load_models(**model_args):
+    calls.append(model_args)
+    raise RuntimeError('bad checkpoint')
+
+  monkeypatch.setattr(workers, 'load_models', load_models)
+  # Every job fails with the error, instead of the worker process dying
+  for src in ['a.jpg', 'b.jpg']:
+    assert workers.run_job({'src': src})[:2] == (src, 'Could not load models: bad checkpoint')
+  assert len(calls) == 1